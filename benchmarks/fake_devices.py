@@ -0,0 +1,373 @@
+# Simulated Network Devices for Benchmarks
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import argparse
+import asyncio
+import json
+import selectors
+import socket
+import threading
+import time
+import paramiko
+
+PLATFORMS = {
+    "cisco_ios": {"hostname": "Router", "config": "configure terminal", "config_prompt": "(config)#"},
+    "cisco_xe": {"hostname": "RouterXE", "config": "configure terminal", "config_prompt": "(config)#"},
+    "cisco_nxos": {"hostname": "switch", "config": "configure terminal", "config_prompt": "(config)#"},
+    "cisco_xr": {"hostname": "RP/0/RP0/CPU0:xr", "config": "configure terminal", "config_prompt": "(config)#"},
+    "arista_eos": {"hostname": "eos", "config": "configure terminal", "config_prompt": "(config)#"},
+    # VRP has no enable, '<HUAWEI>' is the user view and 'system-view' enters '[HUAWEI]'
+    "huawei": {"hostname": "HUAWEI", "config": "system-view", "user_view": "<HUAWEI>", "config_view": "[HUAWEI]", "config_exit": "return", "save": "save"},
+}
+
+# Show outputs follow each platform format, so the ntc-templates parse them as they parse real devices
+SHOW_IP_INT_BRIEF = {
+    "cisco_ios": ("Interface              IP-Address      OK? Method Status                Protocol", "GigabitEthernet0/{index:<8} 10.0.{octet}.1{pad:<8} YES manual up                    up      "),
+    "cisco_nxos": ("IP Interface Status for VRF \"default\"(1)\nInterface            IP Address      Interface Status", "Vlan{index:<16} 10.0.{octet}.1{pad:<8} protocol-up/link-up/admin-up"),
+    "arista_eos": ("Interface              IP Address         Status     Protocol         MTU    Owner", "Ethernet{index:<14} 10.0.{octet}.1/24{pad:<8} up         up              1500"),
+}
+SHOW_VERSION = {
+    "cisco_ios": "Cisco IOS Software, Simulated Device\n{hostname} uptime is 1 week",
+    "cisco_nxos": "Cisco Nexus Operating System (NX-OS) Software\nSoftware\n  NXOS: version 9.3(8)\nHardware\n  cisco Nexus9000 C93180YC-EX chassis\n  Device name: {hostname}\nKernel uptime is 7 day(s), 0 hour(s), 0 minute(s), 0 second(s)",
+    "arista_eos": "Arista DCS-7050TX-64\nHardware version: 01.11\nSerial number: JPE00000000\nSystem MAC address: 001c.7300.0001\n\nSoftware image version: 4.27.0F\nArchitecture: i686\nInternal build version: 4.27.0F\nInternal build ID: 00000000\n\nUptime: 1 week and 0 hours\nTotal memory: 3893984 kB\nFree memory: 2255060 kB",
+}
+
+
+class DeviceEmulator():
+    def __init__(self, profile: dict):
+        self.device_type = profile.get("device_type", "cisco_ios")
+        self.platform = PLATFORMS[self.device_type]
+        self.latency = profile.get("latency", 0.0)
+        self.output_lines = profile.get("output_lines", 20)
+        self.secret = profile.get("secret", "secret")
+        self.hostname = self.platform["hostname"]
+        self.enabled = "user_view" in self.platform
+        self.config_mode = False
+        self.paging = True
+        self.page_size = 24
+        self.awaiting_secret = False
+        self.awaiting_confirm = False
+        self.running_config = ["hostname " + self.hostname, "interface Loopback0", " ip address 10.0.0.1 255.255.255.255"] + profile.get("standard", [])
+
+    def prompt(self) -> str:
+        if self.awaiting_secret:
+            return "Password: "
+        if self.awaiting_confirm:
+            return "Are you sure to continue?[Y/N]:" if "save" in self.platform else "Destination filename [startup-config]? "
+        if self.config_mode:
+            return self.platform.get("config_view") or self.hostname + self.platform["config_prompt"]
+        if "user_view" in self.platform:
+            return self.platform["user_view"]
+        return self.hostname + ("#" if self.enabled else ">")
+
+    def show(self, command: str) -> str:
+        if command.startswith(("show ip int", "sh ip int")):
+            header, row = SHOW_IP_INT_BRIEF.get(self.device_type, SHOW_IP_INT_BRIEF["cisco_ios"])
+            rows = [row.format(index=index, octet=index % 250, pad="") for index in range(self.output_lines)]
+            return header + "\n" + "\n".join(rows)
+        if command.startswith(("show run", "sh run", "display current")):
+            return "Building configuration...\n\n" + "\n".join(self.running_config) + "\nend"
+        if command.startswith("show version"):
+            return SHOW_VERSION.get(self.device_type, SHOW_VERSION["cisco_ios"]).format(hostname=self.hostname)
+        return "\n".join(f"{command} output line {index}" for index in range(self.output_lines))
+
+    def execute(self, line: str) -> str:
+        command = line.strip()
+        if self.awaiting_secret:
+            self.awaiting_secret = False
+            if command == self.secret:
+                self.enabled = True
+                return ""
+            return "% Access denied"
+        if self.awaiting_confirm:
+            # Interactive commands, 'copy running-config startup-config' asks for the destination
+            self.awaiting_confirm = False
+            if "save" in self.platform:
+                return "Info: Save the configuration successfully."
+            return "Building configuration...\n[OK]"
+        if command == "":
+            return ""
+        if self.latency:
+            time.sleep(self.latency)
+        if command.startswith("terminal length 0") or command.startswith("terminal pager 0"):
+            self.paging = False
+            return "Pagination disabled." if self.device_type == "arista_eos" else ""
+        if command.startswith("terminal width") and self.device_type == "arista_eos":
+            return f"Width set to {command.split()[-1]} columns."
+        if command.startswith("terminal"):
+            return ""
+        if command.startswith("screen-length"):
+            self.paging = False
+            return "Info: The configuration takes effect on the current user terminal interface only."
+        if command == "enable":
+            if not self.enabled:
+                self.awaiting_secret = True
+            return ""
+        if command in ("disable",):
+            self.enabled = False
+            return ""
+        if command.startswith(("conf t", self.platform["config"])) and self.enabled:
+            self.config_mode = True
+            return "Enter configuration commands, one per line.  End with CNTL/Z."
+        if self.config_mode:
+            if command in ("end", "\x1a", self.platform.get("config_exit")):
+                self.config_mode = False
+                return ""
+            if command in ("exit", "quit"):
+                return ""
+            if command.startswith("invalid"):
+                return "                   ^\n% Invalid input detected at '^' marker."
+            self.running_config.append(command)
+            return ""
+        if command.startswith(("show", "sh ", "display")):
+            return self.show(command)
+        if command == self.platform.get("save") or command.startswith("copy run") and command.endswith(("start", "startup-config")):
+            self.awaiting_confirm = True
+            return ""
+        if command.startswith(("write", "copy run")):
+            return "Building configuration...\n[OK]"
+        if command in ("exit", "quit", "logout"):
+            return None
+        return "                   ^\n% Invalid input detected at '^' marker."
+
+
+def serve_lines(read_line, write, emulator: DeviceEmulator) -> None:
+    write("\r\n" + emulator.prompt())
+    while True:
+        line = read_line()
+        if line is None:
+            return
+        result = emulator.execute(line)
+        if result is None:
+            return
+        output = result.replace("\n", "\r\n")
+        lines = output.split("\r\n")
+        if emulator.paging and len(lines) > emulator.page_size:
+            for start in range(0, len(lines), emulator.page_size):
+                write("\r\n".join(lines[start:start + emulator.page_size]))
+                if start + emulator.page_size < len(lines):
+                    write("\r\n --More-- ")
+                    if read_line(single=True) is None:
+                        return
+                    write("\r\n")
+            write("\r\n" + emulator.prompt())
+        else:
+            write(("\r\n" + output if output else "") + "\r\n" + emulator.prompt())
+
+
+class SshServer(paramiko.ServerInterface):
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self.event = threading.Event()
+
+    def check_auth_password(self, username, password):
+        if username == self.profile.get("username", "admin") and password == self.profile.get("password", "admin"):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.event.set()
+        return True
+
+
+class ChannelLines():
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = b""
+
+    def read_line(self, single: bool = False):
+        while True:
+            if single and self.buffer:
+                self.buffer = self.buffer[1:]
+                return ""
+            index = self.buffer.find(b"\n")
+            if index < 0:
+                index = self.buffer.find(b"\r")
+            if index >= 0:
+                line, self.buffer = self.buffer[:index], self.buffer[index + 1:]
+                if self.buffer.startswith(b"\n"):
+                    self.buffer = self.buffer[1:]
+                text = line.decode(errors="ignore")
+                self.channel.sendall(text.encode())
+                return text
+            data = self.channel.recv(65535)
+            if not data:
+                return None
+            # The NUL of the netmiko is_alive() check is dropped, as the devices do
+            self.buffer += data.replace(b"\x00", b"")
+
+    def write(self, text: str) -> None:
+        self.channel.sendall(text.encode())
+
+
+class FakeSshFleet():
+    # All the listening sockets share one accept thread, a fleet of 1,000 devices does not need 1,000 threads
+    def __init__(self, profiles: list):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.selector = selectors.DefaultSelector()
+        self.ports = []
+        for profile in profiles:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("127.0.0.1", profile.get("port", 0)))
+            sock.listen(128)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, profile)
+            self.ports.append(sock.getsockname()[1])
+
+    def start(self) -> None:
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self) -> None:
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    client, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                client.setblocking(True)
+                threading.Thread(target=self.handle, args=(client, key.data), daemon=True).start()
+
+    def handle(self, client: socket.socket, profile: dict) -> None:
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        server = SshServer(profile)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(20)
+            if channel is None or not server.event.wait(10):
+                return
+            lines = ChannelLines(channel)
+            serve_lines(lines.read_line, lines.write, DeviceEmulator(profile))
+            channel.close()
+        except Exception:
+            pass
+        finally:
+            transport.close()
+
+
+class FakeTelnetDevice():
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self.server = None
+        self.port = profile.get("port", 0)
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def read_line(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> str | None:
+        data = await reader.readline()
+        if not data:
+            return None
+        # Drop telnet IAC negotiation sequences sent by the client
+        data = bytes(byte for byte in data if byte < 240)
+        line = data.decode(errors="ignore").rstrip("\r\n").replace("\x00", "")
+        writer.write(line.encode())
+        return line
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        emulator = DeviceEmulator(self.profile)
+        emulator.paging = False
+        # Telnet users land in privileged mode, as with a privilege 15 AAA user
+        emulator.enabled = True
+        try:
+            writer.write(b"\r\nUser Access Verification\r\n\r\nUsername: ")
+            username = await self.read_line(reader, writer)
+            while username == "":
+                # Empty lines at the login prompt are answered with the prompt again, as IOS does
+                writer.write(b"\r\nUsername: ")
+                username = await self.read_line(reader, writer)
+            writer.write(b"\r\nPassword: ")
+            password = await reader.readline()
+            if username != self.profile.get("username", "admin") or password.decode(errors="ignore").strip() != self.profile.get("password", "admin"):
+                writer.write(b"\r\n% Authentication failed\r\n")
+                return
+            writer.write(("\r\n" + emulator.prompt()).encode())
+            while True:
+                line = await self.read_line(reader, writer)
+                if line is None:
+                    return
+                if emulator.latency:
+                    await asyncio.sleep(emulator.latency)
+                    emulator.latency, latency = 0, emulator.latency
+                    result = emulator.execute(line)
+                    emulator.latency = latency
+                else:
+                    result = emulator.execute(line)
+                if result is None:
+                    return
+                output = result.replace("\n", "\r\n")
+                writer.write((("\r\n" + output if output else "") + "\r\n" + emulator.prompt()).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def standard_config(lines: int) -> list:
+    # A configuration standard of about this many lines, as it shows in the running config
+    config = []
+    for index in range(lines // 2):
+        config.extend([f"interface Loopback{1000 + index}", f" description cla standard {index}"])
+    return config
+
+
+def device_profiles(count: int, platforms: list, latency: float, output_lines: int, config_lines: int = 0) -> list:
+    # Platforms are assigned round robin, the benchmark runner builds the same inventory
+    standard = standard_config(config_lines)
+    return [
+        {"device_type": platforms[index % len(platforms)], "latency": latency, "output_lines": output_lines, "standard": standard}
+        for index in range(count)
+    ]
+
+
+async def serve(args: argparse.Namespace) -> None:
+    platforms = args.platforms.split(",")
+    ssh_fleet = FakeSshFleet(device_profiles(args.ssh, platforms, args.latency, args.output_lines, args.config_lines))
+    ssh_fleet.start()
+    telnet_fleet = []
+    for profile in device_profiles(args.telnet, platforms, args.latency, args.output_lines, args.config_lines):
+        device = FakeTelnetDevice(profile)
+        await device.start()
+        telnet_fleet.append(device)
+    fleet = {
+        "ssh": [{"port": port, "device_type": platforms[index % len(platforms)]} for index, port in enumerate(ssh_fleet.ports)],
+        "telnet": [{"port": device.port, "device_type": platforms[index % len(platforms)]} for index, device in enumerate(telnet_fleet)],
+    }
+    print (json.dumps(fleet), flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start a fleet of simulated SSH and Telnet devices on 127.0.0.1")
+    parser.add_argument("--ssh", type=int, default=10, help="number of SSH devices")
+    parser.add_argument("--telnet", type=int, default=0, help="number of Telnet devices")
+    parser.add_argument("--platforms", default="cisco_ios", help="comma separated device types: " + ",".join(PLATFORMS))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every command")
+    parser.add_argument("--output-lines", type=int, default=20, help="lines returned by show commands")
+    parser.add_argument("--config-lines", type=int, default=0, help="lines of the configuration standard in the running config")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
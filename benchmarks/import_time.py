@@ -0,0 +1,92 @@
+# CLI Cold Start Benchmark
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import argparse
+import json
+import statistics
+import subprocess
+import tempfile
+import time
+
+PACKAGE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Loaded only by the sub-commands that use them, never by 'cla --version' or the completion
+HEAVY_MODULES = ["netmiko", "paramiko", "textfsm", "requests", "socks", "asyncssh", "pydantic", "aiofiles"]
+COMMANDS = {
+    "version": ["--version"],
+    "help": ["--help"],
+    "complete": [],
+}
+CHECK_MODULES = "import sys, cli_automation.main; print(' '.join(name for name in {modules} if name in sys.modules))"
+
+
+def run_cla(args: list, work_dir: str, env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "cli_automation", *args], cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def command_env(name: str) -> dict:
+    env = {**os.environ, "PYTHONPATH": PACKAGE_DIR + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    if name == "complete":
+        # What the shell runs on every TAB press after 'cla '
+        env.update({"_CLA_COMPLETE": "complete_bash", "COMP_WORDS": "cla ", "COMP_CWORD": "1"})
+    return env
+
+
+def loaded_heavy_modules(work_dir: str) -> list:
+    check = subprocess.run(
+        [sys.executable, "-c", CHECK_MODULES.format(modules=HEAVY_MODULES)],
+        cwd=work_dir, env=command_env("import"), capture_output=True, text=True,
+    )
+    return check.stdout.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the cold start of the cla command")
+    parser.add_argument("--runs", type=int, default=10, help="runs of each command")
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if the median of a command is above this budget")
+    parser.add_argument("--json", dest="json_file", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="cla-import-") as work_dir:
+        heavy = loaded_heavy_modules(work_dir)
+        for name, cla_args in COMMANDS.items():
+            samples = sorted(run_cla(cla_args, work_dir, command_env(name)) for _ in range(args.runs))
+            results.append({
+                "command": name,
+                "runs": args.runs,
+                "median_ms": round(statistics.median(samples) * 1000, 1),
+                "min_ms": round(samples[0] * 1000, 1),
+                "max_ms": round(samples[-1] * 1000, 1),
+            })
+
+    columns = ["command", "runs", "median_ms", "min_ms", "max_ms"]
+    print ("  ".join(f"{column:>10}" for column in columns))
+    for result in results:
+        print ("  ".join(f"{str(result.get(column)):>10}" for column in columns))
+    if args.json_file:
+        with open(args.json_file, "w") as write_file:
+            json.dump({"heavy_modules": heavy, "results": results}, write_file, indent=2)
+        print (f"\n-> Results written to '{args.json_file}'")
+
+    failed = False
+    if heavy:
+        print (f"\n** Heavy modules loaded by 'import cli_automation.main': {', '.join(heavy)}")
+        failed = True
+    if args.max_ms is not None:
+        for result in results:
+            if result["median_ms"] > args.max_ms:
+                print (f"\n** 'cla {result['command']}' median {result['median_ms']} ms is above the {args.max_ms} ms budget")
+                failed = True
+    if failed:
+        sys.exit(1)
+    print ("\n-> Cold start check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# Service Classes Benchmarks
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import tempfile
+import time
+from fake_devices import standard_config
+
+SCENARIOS = ["ssh-pull", "ssh-push", "ssh-push-standard", "ssh-interactive", "telnet-pull", "telnet-push"]
+PULL_COMMANDS = ["show ip interface brief", "show version"]
+PUSH_COMMANDS = ["interface Loopback100", "description cla benchmark"]
+TELNET_PUSH_COMMANDS = ["configure terminal", "interface Loopback100", "description cla benchmark", "end", "write memory"]
+INTERACTIVE_COMMANDS = [["copy running-config startup-config", "Destination filename"], ["", "#"]]
+# The commands of the scenarios on the platforms with a different CLI
+PLATFORM_COMMANDS = {
+    "huawei": {
+        "ssh-pull": ["display ip interface brief", "display version"],
+        "telnet-pull": ["display ip interface brief", "display version"],
+        "telnet-push": ["system-view", "interface LoopBack100", "description cla benchmark", "return", "save", "y"],
+        "ssh-interactive": [["save", r"\[Y/N\]"], ["y", ">"]],
+    },
+}
+RESULT_MARK = "BENCHMARK-RESULT "
+
+
+def inventory(fleet: list, size: int) -> list:
+    return [
+        {"host": "127.0.0.1", "port": device["port"], "username": "admin", "password": "admin", "secret": None if device["device_type"] == "huawei" else "secret", "device_type": device["device_type"]}
+        for device in fleet[:size]
+    ]
+
+
+def commands(scenario: str, device: dict, default: list) -> list:
+    return PLATFORM_COMMANDS.get(device["device_type"], {}).get(scenario, default)
+
+
+def count_errors(scenario: str, result: str) -> int:
+    errors = 0
+    for entry in json.loads(result):
+        output = entry.get("Output")
+        if isinstance(output, str) and (output.startswith("**") or "failed" in output):
+            errors += 1
+    return errors
+
+
+def flat_commands(config: list) -> list:
+    # The standard as a configuration file lists it, one command per line without indentation
+    return [line.strip() for line in config]
+
+
+def run_scenario(scenario: str, size: int, fleet: dict, workers: int, engine: str, parse: str, delta: bool, config_lines: int) -> dict:
+    # Runs in a child process, so the peak RSS and the CPU time belong to this scenario only
+    from cli_automation import logger
+    from cli_automation.svc_ssh import AsyncNetmikoPull, AsyncNetmikoPush, AsyncNetmikoInteractive
+    from cli_automation.svc_telnet import AsyncNetmikoTelnetPull, AsyncNetmikoTelnetPush
+
+    inst_dict = {"verbose": 0, "single_host": False, "logger": logger, "workers": workers, "engine": engine, "parse": parse, "delta": delta}
+    if scenario.startswith("ssh"):
+        devices = inventory(fleet["ssh"], size)
+    else:
+        devices = inventory(fleet["telnet"], size)
+    if scenario == "ssh-pull":
+        service, data = AsyncNetmikoPull(inst_dict=inst_dict), [{"device": device, "commands": commands(scenario, device, PULL_COMMANDS)} for device in devices]
+    elif scenario == "ssh-push":
+        service, data = AsyncNetmikoPush(inst_dict=inst_dict), [{"device": device, "commands": commands(scenario, device, PUSH_COMMANDS)} for device in devices]
+    elif scenario == "ssh-push-standard":
+        standard = flat_commands(standard_config(config_lines))
+        service, data = AsyncNetmikoPush(inst_dict=inst_dict), [{"device": device, "commands": standard} for device in devices]
+    elif scenario == "ssh-interactive":
+        service, data = AsyncNetmikoInteractive(inst_dict=inst_dict), [{"device": device, "commands": commands(scenario, device, INTERACTIVE_COMMANDS)} for device in devices]
+    elif scenario == "telnet-pull":
+        service, data = AsyncNetmikoTelnetPull(inst_dict=inst_dict), [{"device": device, "commands": commands(scenario, device, PULL_COMMANDS)} for device in devices]
+    else:
+        service, data = AsyncNetmikoTelnetPush(inst_dict=inst_dict), [{"device": device, "commands": commands(scenario, device, TELNET_PUSH_COMMANDS)} for device in devices]
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    result = asyncio.run(service.run(data))
+    elapsed = time.perf_counter() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    return {
+        "scenario": scenario,
+        "devices": len(devices),
+        "workers": workers,
+        "engine": engine if scenario.startswith("ssh") else "netmiko",
+        "parse": parse if scenario.endswith("pull") else None,
+        "delta": delta if scenario == "ssh-push-standard" else None,
+        "errors": count_errors(scenario, result),
+        "seconds": round(elapsed, 3),
+        "devices_per_second": round(len(devices) / elapsed, 2) if elapsed else None,
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": round(usage_end.ru_maxrss / 1024, 1),
+    }
+
+
+def start_fleet(args: argparse.Namespace, ssh: int, telnet: int) -> tuple:
+    command = [
+        sys.executable, os.path.join(os.path.dirname(__file__), "fake_devices.py"),
+        "--ssh", str(ssh), "--telnet", str(telnet), "--platforms", args.platforms,
+        "--latency", str(args.latency), "--output-lines", str(args.output_lines), "--config-lines", str(args.config_lines),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.kill()
+        print ("** The simulated device fleet did not start")
+        sys.exit(1)
+    return process, json.loads(line)
+
+
+def print_table(results: list) -> None:
+    columns = ["scenario", "engine", "parse", "delta", "devices", "errors", "seconds", "devices_per_second", "cpu_seconds", "cpu_percent", "peak_rss_mb"]
+    print ("  ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print ("  ".join(f"{str(result.get(column)):>18}" for column in columns))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the CLA service classes against a simulated device fleet")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma separated fleet sizes")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios: " + ",".join(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=100, help="devices processed concurrently")
+    parser.add_argument("--engine", choices=["netmiko", "async"], default="netmiko", help="SSH engine used by the ssh scenarios")
+    parser.add_argument("--parse", choices=["inline", "process", "deferred"], default="process", help="TextFSM parse stage used by the pull scenarios")
+    parser.add_argument("--delta", action="store_true", help="push only the missing lines in the ssh-push-standard scenario")
+    parser.add_argument("--config-lines", type=int, default=500, help="lines of the configuration standard, in the running config of the devices and pushed by ssh-push-standard")
+    parser.add_argument("--platforms", default="cisco_ios,cisco_nxos,arista_eos", help="comma separated device types, assigned round robin, huawei adds VRP devices")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added by the devices to every command")
+    parser.add_argument("--output-lines", type=int, default=20, help="lines returned by show commands")
+    parser.add_argument("--json", dest="json_file", help="also write the results to this JSON file")
+    parser.add_argument("--child", nargs=3, metavar=("SCENARIO", "SIZE", "FLEET"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        scenario, size, fleet_file = args.child
+        with open(fleet_file) as read_file:
+            fleet = json.load(read_file)
+        print (RESULT_MARK + json.dumps(run_scenario(scenario, int(size), fleet, args.workers, args.engine, args.parse, args.delta, args.config_lines)), flush=True)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    scenarios = args.scenarios.split(",")
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        print (f"** Unknown scenarios {unknown}, valid scenarios are {SCENARIOS}")
+        sys.exit(1)
+    # Needed for 1,000 devices, each one holds a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    ssh_size = max(sizes) if any(scenario.startswith("ssh") for scenario in scenarios) else 0
+    telnet_size = max(sizes) if any(scenario.startswith("telnet") for scenario in scenarios) else 0
+    fleet_process, fleet = start_fleet(args, ssh_size, telnet_size)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="cla-bench-") as work_dir:
+            # The children run in an empty directory: default config.json, no tunnel, no cla agent
+            fleet_file = os.path.join(work_dir, "fleet.json")
+            with open(fleet_file, "w") as write_file:
+                json.dump(fleet, write_file)
+            for scenario in scenarios:
+                for size in sizes:
+                    print (f"-> Running {scenario} with {size} devices")
+                    child_args = ["--workers", str(args.workers), "--engine", args.engine, "--parse", args.parse, "--config-lines", str(args.config_lines)] + (["--delta"] if args.delta else [])
+                    child = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), *child_args, "--child", scenario, str(size), fleet_file],
+                        cwd=work_dir, capture_output=True, text=True,
+                    )
+                    lines = [line for line in child.stdout.splitlines() if line.startswith(RESULT_MARK)]
+                    if child.returncode != 0 or not lines:
+                        print (f"** {scenario} with {size} devices failed:\n{child.stderr.strip()}")
+                        continue
+                    results.append(json.loads(lines[-1][len(RESULT_MARK):]))
+    finally:
+        fleet_process.kill()
+        fleet_process.wait()
+
+    print ()
+    print_table(results)
+    if args.json_file:
+        with open(args.json_file, "w") as write_file:
+            json.dump(results, write_file, indent=2)
+        print (f"\n-> Results written to '{args.json_file}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import json
 from pathlib import Path
+import atexit
 import logging
 import logging.handlers
+import queue
+import threading
 from cli_automation.config_srv import *
 import os
 
@@ -10,6 +13,7 @@ DATA = {
     "app": "cla",
 }
 __version__ = "1.8.4 - XXI - By Ed Scrimaglia"
+LOG_LEVEL = None
 
 class ClaConfig():
     def __init__(self):
@@ -22,7 +26,7 @@ class ClaConfig():
             self.data.update(self.config)
             with open(self.config_path, "r") as read_file:
                 file_read = json.load(read_file)
-                return file_read
+                return {**self.data, **file_read}
         except FileNotFoundError:
             with open(self.config_path, "w") as write_file:
                 json.dump(self.data, write_file, indent=3)
@@ -31,14 +35,83 @@ class ClaConfig():
             print ("** Error creating the configuration file")
             SystemExit(1)
 
+class QueuedHandler(logging.handlers.QueueHandler):
+    # The queue is bounded by log_queue_size, when the writer falls behind (a slow disk) the new
+    # records are dropped and counted instead of piling up in memory or blocking the sessions.
+    # The writer logs the count once it drains the queue
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record is queued as is, its message is formatted by the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def take_dropped(self) -> int:
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class QueuedListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue: queue.Queue, handler: logging.Handler, source: QueuedHandler):
+        super().__init__(log_queue, handler)
+        self.source = source
+
+    def report_dropped(self) -> None:
+        dropped = self.source.take_dropped() if self.source.dropped else 0
+        if dropped:
+            super().handle(logging.makeLogRecord({"name": "ClaLogger", "levelno": logging.WARNING, "levelname": "WARNING", "msg": f"{dropped} log records dropped, the log writer fell behind"}))
+
+    def handle(self, record: logging.LogRecord) -> None:
+        super().handle(record)
+        if self.queue.empty():
+            self.report_dropped()
+
+    def enqueue_sentinel(self) -> None:
+        # A blocking put, with the queue full at exit the writer drains it before it stops
+        self.queue.put(self._sentinel)
+
+    def stop(self) -> None:
+        super().stop()
+        self.report_dropped()
+
+
+class LogOutput():
+    # Device output as a log argument, 'logger.debug("Output: %s", LogOutput(result))'. It is
+    # turned into text by the writer thread, only when the record is written, and cut to
+    # log_output_max characters
+    __slots__ = ("output",)
+
+    def __init__(self, output):
+        self.output = output
+
+    def __str__(self) -> str:
+        text = str(self.output)
+        limit = (globals().get("config_data") or CONFIG_PARAMS).get("log_output_max")
+        if limit and len(text) > limit:
+            return f"{text[:limit]} ... [{len(text) - limit} more characters]"
+        return text
+
+
 class Logger():
+    # The sessions only queue their records, a single writer thread formats them and writes
+    # them to the log file, no session thread waits on the file or its lock
     def __init__(self):
         self.log_dir = Path(__file__).parent / "logs"
         os.makedirs(self.log_dir, exist_ok=True)
         os.environ["PATH_LOG"] = str(self.log_dir)
         self.logger = logging.getLogger("ClaLogger")
-        self.logger.setLevel(logging.DEBUG)
-        self.log_file = self.log_dir / DATA.get("log_file")
+        self.logger.setLevel(str(LOG_LEVEL or configured("log_level")).upper())
+        self.log_file = self.log_dir / CONFIG_PARAMS.get("log_file")
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         file_handler = logging.handlers.TimedRotatingFileHandler(
                 filename=self.log_file,
@@ -50,11 +123,46 @@ class Logger():
             )
         file_handler.setFormatter(formatter)
         file_handler.setLevel(logging.DEBUG)
-        self.logger.addHandler(file_handler)
+        log_queue = queue.Queue(maxsize=configured("log_queue_size") or 0)
+        queued_handler = QueuedHandler(log_queue)
+        self.logger.addHandler(queued_handler)
+        self.listener = QueuedListener(log_queue, file_handler, queued_handler)
+        self.listener.start()
+        # The records still queued are written before the process exits
+        atexit.register(self.listener.stop)
 
     def get_logger(self):
         return self.logger
     
 
-config_data = ClaConfig().load_config()
-logger = Logger().get_logger()
+def configured(key: str):
+    # A setting of config.json, read without creating the file as load_config does, so
+    # 'cla --version' can log without leaving a config.json behind
+    if "config_data" in globals():
+        return globals()["config_data"].get(key)
+    try:
+        with open(ClaConfig().config_path, "r") as read_file:
+            return json.load(read_file).get(key, CONFIG_PARAMS.get(key))
+    except (OSError, ValueError):
+        return CONFIG_PARAMS.get(key)
+
+
+def set_log_level(level: str) -> None:
+    # 'cla --log-level' wins over the log_level of config.json, on the logger already in use too
+    global LOG_LEVEL
+    LOG_LEVEL = level
+    if "logger" in globals():
+        globals()["logger"].setLevel(level)
+
+
+def __getattr__(name: str):
+    # config.json is read and the log file opened on first use, so commands that do not
+    # need them, 'cla --version' or the shell completion, do not pay for them
+    if name == "config_data":
+        value = ClaConfig().load_config()
+    elif name == "logger":
+        value = Logger().get_logger()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -0,0 +1,111 @@
+# Persistent Sessions Agent Typer Application
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', ".")))
+
+import typer
+from typing_extensions import Annotated
+from .svc_progress import ProgressBar
+import asyncio
+import json
+from cli_automation import logger, config_data
+
+app = typer.Typer(no_args_is_help=True)
+
+@app.command("start", short_help="Start the agent in background")
+def start_agent(
+        timeout: Annotated[int, typer.Option("--timeout", "-t", help="timeout in seconds for the agent startup", rich_help_panel="Agent Parameters", min=1, max=60)] = 10,
+        verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 1,
+    ):
+
+    async def process():
+        from .svc_agent import AgentClient
+        inst_dict = {"verbose": verbose, "logger": logger}
+        agent = AgentClient(inst_dict=inst_dict)
+        if agent.is_running():
+            print (f"\n** Agent already running at socket '{agent.socket_path}'")
+        elif await agent.start(timeout=timeout):
+            print (f"\n** Agent started successfully at socket '{agent.socket_path}'")
+        else:
+            print (f"\n** Agent failed to start at socket '{agent.socket_path}', check the log file")
+
+    progress = ProgressBar()
+    asyncio.run(progress.run_with_spinner(process))
+
+
+@app.command("run", short_help="Run the agent in foreground", help="Runs the agent in foreground, useful under a service manager. 'cla agent start' runs this command in background")
+def run_agent(
+        workers: Annotated[int, typer.Option("--workers", "-w", help="maximum number of device requests processed concurrently", rich_help_panel="Agent Parameters", min=1)] = config_data.get("workers"),
+        verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+    ):
+
+    async def process():
+        from .svc_agent import SessionAgent
+        from .svc_sessions import NetmikoSessions
+        from .svc_ssh import AsyncNetmikoPull, AsyncNetmikoPush, AsyncNetmikoInteractive
+        sessions = NetmikoSessions(inst_dict={"verbose": verbose, "logger": logger, "persistent": True})
+        inst_dict = {"verbose": 0, "single_host": True, "logger": logger, "sessions": sessions}
+        services = {
+            # Raw outputs, each client parses them with its own --parse mode
+            "pull": AsyncNetmikoPull(inst_dict={**inst_dict, "parse": "deferred"}).netmiko_connection,
+            "push": AsyncNetmikoPush(inst_dict=inst_dict).netmiko_connection,
+            "interactive": AsyncNetmikoInteractive(inst_dict=inst_dict).netmiko_connection
+        }
+        agent = SessionAgent(inst_dict={"verbose": verbose, "logger": logger, "workers": workers, "sessions": sessions, "services": services})
+        await agent.serve()
+
+    asyncio.run(process())
+
+
+@app.command("stop", short_help="Stop the agent")
+def stop_agent(
+        verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 1,
+    ):
+
+    async def process():
+        from .svc_agent import AgentClient
+        inst_dict = {"verbose": verbose, "logger": logger}
+        agent = AgentClient(inst_dict=inst_dict)
+        if not agent.is_running():
+            print (f"\n** No agent running at socket '{agent.socket_path}'")
+            return
+        await agent.request({"action": "stop"})
+        logger.info(f"Agent at socket {agent.socket_path} stopped")
+        print (f"\n** Agent at socket '{agent.socket_path}' stopped")
+
+    progress = ProgressBar()
+    asyncio.run(progress.run_with_spinner(process))
+
+
+@app.command("status", short_help="Check the agent status and its sessions")
+def check_agent(
+        verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 1,
+    ):
+
+    async def process():
+        from .svc_agent import AgentClient
+        inst_dict = {"verbose": verbose, "logger": logger}
+        agent = AgentClient(inst_dict=inst_dict)
+        if not agent.is_running():
+            print (f"\n** Agent is not running at socket '{agent.socket_path}'")
+            return
+        response = await agent.request({"action": "status"})
+        print (f"\n** Agent is running at socket '{agent.socket_path}'")
+        if verbose in [1,2]:
+            print (json.dumps(response.get("output"), indent=2))
+
+    progress = ProgressBar()
+    asyncio.run(progress.run_with_spinner(process))
+
+
+@app.callback(invoke_without_command=True, short_help="Manage the persistent sessions agent")
+def callback(ctx: typer.Context):
+    """
+    Every `cla ssh` command opens a new SSH session per device, and the connection setup (TCP, key exchange, authentication, enable and paging) is often
+    longer than the commands themselves. `cla agent` starts a local daemon, listening on a Unix socket, that keeps authenticated sessions open between
+    CLA invocations, keyed by host and credentials. While the agent is running, `cla ssh` commands send their work through it. Sessions idle for more
+    than `agent_idle_timeout` seconds (config.json) are closed.
+    """
+    typer.echo(f"-> About to execute sub-command: {ctx.invoked_subcommand}")
@@ -7,14 +7,13 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', ".
 
 import typer
 from typing_extensions import Annotated
-from .svc_ssh import AsyncNetmikoPull, AsyncNetmikoPush, AsyncNetmikoInteractive
 import asyncio
 from typing import List
-from .svc_enums import DeviceType
+from .svc_enums import DeviceType, Engine, ParseMode
 import json
 from .svc_progress import ProgressBar
 from datetime import datetime
-from cli_automation import logger
+from cli_automation import logger, config_data
 
 
 app = typer.Typer(no_args_is_help=True)
@@ -29,13 +28,19 @@ def pull_single_host(
         device_type: Annotated[DeviceType, typer.Option("--type", "-t", help="device type", rich_help_panel="Connection Parameters", case_sensitive=False)],
         port: Annotated[int, typer.Option("--port", "-p", help="port", rich_help_panel="Connection Parameters")] = 22,
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+        engine: Annotated[Engine, typer.Option("--engine", "-e", help="SSH engine, async runs all the sessions on a single event loop", rich_help_panel="Additional Parameters", case_sensitive=False)] = config_data.get("engine"),
+        learn: Annotated[bool, typer.Option("--learn", help="record the command latencies of each device to derive its delay factor and read timeout", rich_help_panel="Additional Parameters")] = False,
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device with --learn", rich_help_panel="Additional Parameters")] = False,
         output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file", rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.json",
-        global_delay: Annotated[float, typer.Option("--delay", "-d", help="global delay", rich_help_panel="Connection Parameters", min=.1, max=4)] = 0.1,
+        cache: Annotated[bool, typer.Option("--cache", help="serve repeated commands from the local output cache (TTL in config.json)", rich_help_panel="Additional Parameters")] = False,
+        parse: Annotated[ParseMode, typer.Option("--parse", help="TextFSM parsing, process uses a process pool for large outputs, deferred keeps the raw text for 'cla ssh parse'", rich_help_panel="Additional Parameters", case_sensitive=False)] = config_data.get("parse"),
+        global_delay: Annotated[float, typer.Option("--delay", "-d", help="global delay, by default 0.1, or the learned delay profile of the device with --profile", rich_help_panel="Connection Parameters", min=.1, max=4)] = None,
         ssh_config: Annotated[str, typer.Option("--cfg", "-s", help="ssh config file", rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
 
     ):
     
     async def process():
+        from .svc_ssh import AsyncNetmikoPull
         datos = {
             "device": {
                 "host": host,
@@ -51,7 +56,7 @@ def pull_single_host(
         }
 
         
-        inst_dict = {"verbose": verbose, "single_host": True, "logger": logger}
+        inst_dict = {"verbose": verbose, "single_host": True, "logger": logger, "cache": cache, "engine": engine.value, "learn": learn, "profile": profile, "parse": parse.value}
         if verbose == 2:
             print (f"--> data: {json.dumps(datos, indent=3)}")
         start = datetime.now()
@@ -74,7 +79,15 @@ def pull_multiple_host(
         commands: Annotated[List[str], typer.Option("--cmd", "-c", help="commands to execute on the device", metavar="Multiple -c parameter", rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
         cmd_file: Annotated[typer.FileText, typer.Option("--cmdf", "-f", help="commands to execute on the device", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level", rich_help_panel="Additional parameters", min=0, max=2)] = 0,
+        engine: Annotated[Engine, typer.Option("--engine", "-e", help="SSH engine, async runs all the sessions on a single event loop", rich_help_panel="Additional Parameters", case_sensitive=False)] = config_data.get("engine"),
+        learn: Annotated[bool, typer.Option("--learn", help="record the command latencies of each device to derive its delay factor and read timeout", rich_help_panel="Additional Parameters")] = False,
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device with --learn", rich_help_panel="Additional Parameters")] = False,
+        workers: Annotated[int, typer.Option("--workers", "-w", help="maximum number of devices processed concurrently", rich_help_panel="Additional parameters", min=1)] = config_data.get("workers"),
+        preflight: Annotated[bool, typer.Option("--preflight", help="probe every host with a short TCP connect and skip the unreachable ones before connecting", rich_help_panel="Additional parameters")] = config_data.get("preflight"),
         output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file", rich_help_panel="Additional parameters", case_sensitive=False)] = "output.json",
+        cache: Annotated[bool, typer.Option("--cache", help="serve repeated commands from the local output cache (TTL in config.json)", rich_help_panel="Additional parameters")] = False,
+        parse: Annotated[ParseMode, typer.Option("--parse", help="TextFSM parsing, process uses a process pool for large outputs, deferred keeps the raw text for 'cla ssh parse'", rich_help_panel="Additional parameters", case_sensitive=False)] = config_data.get("parse"),
+        stream: Annotated[bool, typer.Option("--stream", help="write each device result as a JSON line (NDJSON) as soon as the device completes", rich_help_panel="Additional parameters")] = False,
 
     ):
 
@@ -83,7 +96,9 @@ def pull_multiple_host(
         raise typer.Exit(code=1)
     
     async def process():
-        datos = []
+        from .svc_ssh import AsyncNetmikoPull
+        from .svc_files import StreamOutput
+        from .svc_inventory import InventoryReader
         if commands == None:
             file_name = cmd_file.name
             try:
@@ -92,49 +107,26 @@ def pull_multiple_host(
                 typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
                 raise typer.Exit(code=1)
         else:        
-            datos_cmds = commands
+            datos_cmds = None
 
-        file_name = devices.name
-        try:
-            datos_hosts = json.loads(devices.read())
-        except Exception:
-            typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
-            raise typer.Exit(code=1)
-        
-        if "devices" not in datos_hosts:
-            typer.echo(f"Error reading json file: 'devices' key not found in '{devices.name}' or reading an incorrect json file")
-            raise typer.Exit(code=1)
-        
-        if commands == None:
-            list_devices = datos_hosts.get("devices")
-            for device in list_devices:
-                if device.get("host") not in datos_cmds:
-                    typer.echo(f"Error reading json file: 'commands' not found for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                    raise typer.Exit(code=1)
-                else:
-                    if "commands" not in datos_cmds.get(device.get("host")):
-                        typer.echo(f"Error reading json file: 'commands' key not found in '{cmd_file.name}' for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                        raise typer.Exit(code=1)
-        
-                dic = {
-                    "device": device,
-                    "commands": datos_cmds.get(device.get("host")).get('commands')
-                }
-                datos.append(dic)
-        
-        datos_hosts["commands"] = datos_cmds
-        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger}
-        if verbose == 2:
-            print (f"--> data: {json.dumps(datos, indent=3)}")  
+        reader = InventoryReader({"verbose": verbose, "logger": logger})
+        datos = reader.device_commands(devices, commands=commands, commands_data=datos_cmds, commands_name=cmd_file.name if cmd_file else None)
+        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger, "cache": cache, "workers": workers, "preflight": preflight, "engine": engine.value, "learn": learn, "profile": profile, "parse": parse.value}
         start = datetime.now()
         logger.info(f"Running SSH command pullconfig on devices '{devices.name}'")
         netm = AsyncNetmikoPull(inst_dict=inst_dict)
-        result = await netm.run(data=datos)
+        stream_output = StreamOutput(output, logger) if stream else None
+        result = await netm.run(data=datos, stream=stream_output)
         end = datetime.now()
-        output.write(result)
+        if stream_output:
+            result = f"-> {stream_output.count} results streamed to '{output.name}'"
+        else:
+            output.write(result)
         if verbose in [1,2]:
             print (f"\n{result}")
             print (f"-> Execution time: '{end - start}'")
+        if reader.error:
+            raise typer.Exit(code=1)
        
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
@@ -151,9 +143,14 @@ def push_single_host(
         cmd_file: Annotated[typer.FileText, typer.Option("--cmdf", "-f", help="commands to configure the device", metavar="FILENAME Json file",rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
         port: Annotated[int, typer.Option("--port", "-p", help="port", rich_help_panel="Connection Parameters")] = 22,        
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+        engine: Annotated[Engine, typer.Option("--engine", "-e", help="SSH engine, async runs all the sessions on a single event loop", rich_help_panel="Additional Parameters", case_sensitive=False)] = config_data.get("engine"),
+        learn: Annotated[bool, typer.Option("--learn", help="record the command latencies of each device to derive its delay factor and read timeout", rich_help_panel="Additional Parameters")] = False,
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device with --learn", rich_help_panel="Additional Parameters")] = False,
         output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file", rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.json",
-        global_delay: Annotated[float, typer.Option("--delay", "-d", help="global delay factor", rich_help_panel="Connection Parameters", min=.1, max=4)] = .1,
+        global_delay: Annotated[float, typer.Option("--delay", "-d", help="global delay factor, by default 0.1, or the learned delay profile of the device with --profile", rich_help_panel="Connection Parameters", min=.1, max=4)] = None,
         ssh_config: Annotated[str, typer.Option("--cfg", "-s", help="ssh config file", rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
+        delta: Annotated[bool, typer.Option("--delta", help="push only the commands missing from the running config, commands are compared written in full ('shutdown', not 'shut')", rich_help_panel="Additional Parameters")] = False,
+        cache: Annotated[bool, typer.Option("--cache", help="with --delta, reuse a running config from the local output cache (TTL in config.json)", rich_help_panel="Additional Parameters")] = False,
 
     ):
 
@@ -162,6 +159,7 @@ def push_single_host(
         raise typer.Exit(code=1)
 
     async def process():
+        from .svc_ssh import AsyncNetmikoPush
         if commands == None:
             file_name = cmd_file.name
             try:
@@ -196,7 +194,7 @@ def push_single_host(
             "commands": datos_cmds
         }
 
-        inst_dict = {"verbose": verbose, "single_host": True, "logger": logger}
+        inst_dict = {"verbose": verbose, "single_host": True, "logger": logger, "engine": engine.value, "learn": learn, "profile": profile, "delta": delta, "cache": cache}
         if verbose == 2:
             print (f"--> data: {json.dumps(datos, indent=3)}")
         start = datetime.now()
@@ -218,49 +216,33 @@ def push_multiple_host(
         devices: Annotated[typer.FileText, typer.Option("--hosts", "-h", help="group of hosts", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)],
         cmd_file: Annotated[typer.FileText, typer.Option("--cmd", "-f", help="commands to configure the device", metavar="FILENAME Json file",rich_help_panel="Connection Parameters", case_sensitive=False)],
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+        engine: Annotated[Engine, typer.Option("--engine", "-e", help="SSH engine, async runs all the sessions on a single event loop", rich_help_panel="Additional Parameters", case_sensitive=False)] = config_data.get("engine"),
+        learn: Annotated[bool, typer.Option("--learn", help="record the command latencies of each device to derive its delay factor and read timeout", rich_help_panel="Additional Parameters")] = False,
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device with --learn", rich_help_panel="Additional Parameters")] = False,
+        workers: Annotated[int, typer.Option("--workers", "-w", help="maximum number of devices processed concurrently", rich_help_panel="Additional Parameters", min=1)] = config_data.get("workers"),
+        preflight: Annotated[bool, typer.Option("--preflight", help="probe every host with a short TCP connect and skip the unreachable ones before connecting", rich_help_panel="Additional Parameters")] = config_data.get("preflight"),
         output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file", rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.json",
+        delta: Annotated[bool, typer.Option("--delta", help="push only the commands missing from the running config, commands are compared written in full ('shutdown', not 'shut')", rich_help_panel="Additional Parameters")] = False,
+        cache: Annotated[bool, typer.Option("--cache", help="with --delta, reuse a running config from the local output cache (TTL in config.json)", rich_help_panel="Additional Parameters")] = False,
+        waves: Annotated[bool, typer.Option("--waves", help="push in waves, a canary batch and then growing batches, stopping when a wave fails too often", rich_help_panel="Rollout Parameters")] = False,
+        canary: Annotated[int, typer.Option("--canary", help="devices in the first wave", rich_help_panel="Rollout Parameters", min=1)] = config_data.get("wave_canary"),
+        max_failure_rate: Annotated[float, typer.Option("--max-failure-rate", help="failure rate of a wave above which the rollout stops", rich_help_panel="Rollout Parameters", min=0, max=1)] = config_data.get("wave_failure_rate"),
 
     ):
 
     async def process():
-        datos = []
-        file_name = devices.name
-        try:
-            datos_devices = json.loads(devices.read())
-        except Exception:
-            typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
-            raise typer.Exit(code=1)
-        
-        if "devices" not in datos_devices:
-            typer.echo(f"Error reading json file: 'devices' key not found or reading an incorrect json file '{devices.name}'")
-            raise typer.Exit(code=1)
-        list_devices = datos_devices.get("devices")
-
+        from .svc_ssh import AsyncNetmikoPush
+        from .svc_inventory import InventoryReader
         file_name = cmd_file.name
         try:
             datos_cmds = json.loads(cmd_file.read())
         except Exception:
             typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
             raise typer.Exit(code=1)
-        
-        for device in list_devices:
-            if device.get("host") not in datos_cmds:
-                typer.echo(f"Error reading json file: 'commands' not found for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                raise typer.Exit(code=1)
-            else:
-                if "commands" not in datos_cmds.get(device.get("host")):
-                    typer.echo(f"Error reading json file: 'commands' key not found in '{cmd_file.name}' for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                    raise typer.Exit(code=1)
-        
-            dic = {
-                "device": device,
-                "commands": datos_cmds.get(device.get("host")).get('commands')
-            }
-            datos.append(dic)
 
-        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger}
-        if verbose == 2:
-            print (f"--> data: {json.dumps(datos, indent=3)}")
+        reader = InventoryReader({"verbose": verbose, "logger": logger})
+        datos = reader.device_commands(devices, commands_data=datos_cmds, commands_name=cmd_file.name)
+        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger, "workers": workers, "preflight": preflight, "engine": engine.value, "learn": learn, "profile": profile, "delta": delta, "cache": cache, "waves": waves, "canary": canary, "max_failure_rate": max_failure_rate}
         start = datetime.now()
         logger.info(f"Running SSH command pushconfig on devices '{devices.name}'")
         netm = AsyncNetmikoPush(inst_dict=inst_dict)
@@ -270,6 +252,8 @@ def push_multiple_host(
         if verbose in [1,2]:
             print (f"\n{result}")
             print (f"-> Execution time: '{end - start}'")
+        if reader.error:
+            raise typer.Exit(code=1)
 
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
@@ -280,55 +264,36 @@ def push_interactive_config(
         devices: Annotated[typer.FileText, typer.Option("--hosts", "-h", help="group of hosts", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)],
         cmd_file: Annotated[typer.FileText, typer.Option("--cmd", "-f", help="interactive commands to configure the device", metavar="FILENAME Json file",rich_help_panel="Connection Parameters", case_sensitive=False)],
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+        engine: Annotated[Engine, typer.Option("--engine", "-e", help="SSH engine, async runs all the sessions on a single event loop", rich_help_panel="Additional Parameters", case_sensitive=False)] = config_data.get("engine"),
+        learn: Annotated[bool, typer.Option("--learn", help="record the command latencies of each device to derive its delay factor and read timeout", rich_help_panel="Additional Parameters")] = False,
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device with --learn", rich_help_panel="Additional Parameters")] = False,
+        workers: Annotated[int, typer.Option("--workers", "-w", help="maximum number of devices processed concurrently", rich_help_panel="Additional Parameters", min=1)] = config_data.get("workers"),
+        preflight: Annotated[bool, typer.Option("--preflight", help="probe every host with a short TCP connect and skip the unreachable ones before connecting", rich_help_panel="Additional Parameters")] = config_data.get("preflight"),
         output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file", rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.json",
 
     ):
 
     async def process():
-        datos = []
-        file_name = devices.name
-        try:
-            datos_devices = json.loads(devices.read())
-        except Exception:
-            typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
-            raise typer.Exit(code=1)
-        
-        if "devices" not in datos_devices:
-            typer.echo(f"Error reading json file: 'devices' key not found or reading an incorrect json file '{devices.name}'")
-            raise typer.Exit(code=1)
-        list_devices = datos_devices.get("devices")
-
+        from .svc_ssh import AsyncNetmikoInteractive
+        from .svc_inventory import InventoryReader
         file_name = cmd_file.name
         try:
             datos_cmds = json.loads(cmd_file.read())
         except Exception:
             typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
             raise typer.Exit(code=1)
-        
-        for device in list_devices:
-            if device.get('host') not in datos_cmds:
-                typer.echo(f"Error reading json file: 'commands' not found for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                raise typer.Exit(code=1)
-            else:
-                if "commands" not in datos_cmds.get(device.get("host")):
-                    typer.echo(f"Error reading json file: 'commands' key not found in '{cmd_file.name}' for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                    raise typer.Exit(code=1)
-                else:
-                    commands = datos_cmds.get(device.get("host")).get("commands")
-                    has_patterns = [cmd for cmd in commands if "r" in cmd]
-                    if len(has_patterns) == 0:
-                        typer.echo(f"Error reading json file: 'commands' key does not have any regex pattern 'r' in '{cmd_file.name}' for host '{device.get('host')}'")
-                        multi_line_command = "send_multiline_timing"
-        
-            dic = {
-                "device": device,
-                "commands": datos_cmds.get(device.get("host")).get('commands')
-            }
-            datos.append(dic)
 
-        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger}
-        if verbose == 2:
-            print (f"--> data: {json.dumps(datos, indent=3)}")
+        reader = InventoryReader({"verbose": verbose, "logger": logger})
+
+        async def inventory():
+            async for device in reader.device_commands(devices, commands_data=datos_cmds, commands_name=cmd_file.name):
+                has_patterns = [cmd for cmd in device.get("commands") if "r" in cmd]
+                if len(has_patterns) == 0:
+                    typer.echo(f"Error reading json file: 'commands' key does not have any regex pattern 'r' in '{cmd_file.name}' for host '{device.get('device').get('host')}'")
+                yield device
+
+        datos = inventory()
+        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger, "workers": workers, "preflight": preflight, "engine": engine.value, "learn": learn, "profile": profile}
         start = datetime.now()
         logger.info(f"Running SSH command pushinteractive on devices '{devices.name}'")
         netm = AsyncNetmikoInteractive(inst_dict=inst_dict)
@@ -338,6 +303,42 @@ def push_interactive_config(
         if verbose in [1,2]:
             print (f"\n{result}")
             print (f"-> Execution time: '{end - start}'")
+        if reader.error:
+            raise typer.Exit(code=1)
+
+    progress = ProgressBar()
+    asyncio.run(progress.run_with_spinner(process))
+
+
+@app.command("parse", short_help="Parse the raw outputs of a pullconfig run", help="parses with TextFSM the outputs kept by pullconfig or onepull --parse deferred", no_args_is_help=True)
+def parse_results(
+        results: Annotated[typer.FileText, typer.Option("--input", "-i", help="results of a deferred pull, JSON or NDJSON (--stream)", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)],
+        verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level", rich_help_panel="Additional parameters", min=0, max=2)] = 0,
+        output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file", rich_help_panel="Additional parameters", case_sensitive=False)] = "output.json",
+
+    ):
+
+    async def process():
+        from .svc_textfsm import TextfsmParser
+        file_name = results.name
+        text = results.read()
+        try:
+            if text.lstrip().startswith("["):
+                datos = json.loads(text)
+            else:
+                datos = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except Exception:
+            typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
+            raise typer.Exit(code=1)
+        start = datetime.now()
+        logger.info(f"Running SSH command parse on results '{file_name}'")
+        parser = TextfsmParser({"verbose": verbose, "logger": logger, "parse": "process"})
+        result = json.dumps(await parser.parse_results(datos), indent=2)
+        end = datetime.now()
+        output.write(result)
+        if verbose in [1,2]:
+            print (f"\n{result}")
+            print (f"-> Execution time: '{end - start}'")
 
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
@@ -7,49 +7,65 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', ".
 
 import typer
 from typing_extensions import Annotated
+from typing import List
 from .svc_progress import ProgressBar
 from datetime import datetime
-from .svc_telnet import AsyncNetmikoTelnetPull, AsyncNetmikoTelnetPush
 import asyncio
 import json
-from cli_automation import logger
+from cli_automation import logger, config_data
 
 app = typer.Typer(no_args_is_help=True)
 
 @app.command("pullconfig", help="Pull config from multiple hosts", no_args_is_help=True)
 def pull_multiple_host(
         devices: Annotated[typer.FileText, typer.Option("--hosts", "-h", help="group of hosts", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)],
-        command: Annotated[str, typer.Option("--cmd", "-c", help="command to execute on the device", metavar="Single -c parameter", rich_help_panel="Connection Parameters", case_sensitive=False)],
+        commands: Annotated[List[str], typer.Option("--cmd", "-c", help="commands to execute on the device", metavar="Multiple -c parameter", rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
+        cmd_file: Annotated[typer.FileText, typer.Option("--cmdf", "-f", help="commands to execute on the device", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)] = None,
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
-        output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME text file",rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.txt",
+        workers: Annotated[int, typer.Option("--workers", "-w", help="maximum number of devices processed concurrently", rich_help_panel="Additional Parameters", min=1)] = config_data.get("workers"),
+        preflight: Annotated[bool, typer.Option("--preflight", help="probe every host with a short TCP connect and skip the unreachable ones before connecting", rich_help_panel="Additional Parameters")] = config_data.get("preflight"),
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device by 'cla ssh --learn'", rich_help_panel="Additional Parameters")] = False,
+        output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME Json file",rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.json",
+        stream: Annotated[bool, typer.Option("--stream", help="write each device result as a JSON line (NDJSON) as soon as the device completes", rich_help_panel="Additional Parameters")] = False,
     ):
 
+    if commands == None and cmd_file == None:
+        typer.echo("** Error, you must provide commands or a file with commands")
+        raise typer.Exit(code=1)
+
     async def process():
-        file_name = devices.name
-        try:
-            datos = json.loads(devices.read())
-        except Exception:
-            typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
-            raise typer.Exit(code=1)
-        
-        if "devices" not in datos:
-            typer.echo(f"** Error reading json file: 'devices' key not found or reading an incorrect json file '{file_name}'")
-            raise typer.Exit(code=1)
-        
-        datos["command"] = command
-        inst_dict = {"verbose": verbose, "logger": logger}
-        if verbose == 2:
-            print (f"--> data: {json.dumps(datos, indent=3)}")
+        from .svc_files import StreamOutput
+        from .svc_inventory import InventoryReader
+        from .svc_telnet import AsyncNetmikoTelnetPull
+        if commands == None:
+            file_name = cmd_file.name
+            try:
+                datos_cmds = json.loads(cmd_file.read())
+            except Exception:
+                typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
+                raise typer.Exit(code=1)
+        else:
+            datos_cmds = None
+
+        reader = InventoryReader({"verbose": verbose, "logger": logger})
+        datos = reader.device_commands(devices, commands=commands, commands_data=datos_cmds, commands_name=cmd_file.name if cmd_file else None)
+        inst_dict = {"verbose": verbose, "logger": logger, "workers": workers, "preflight": preflight, "profile": profile}
         start = datetime.now()
         logger.info(f"Running Telnet command pullconfig on devices '{devices.name}'")
         device = AsyncNetmikoTelnetPull(inst_dict)
-        result = await device.run(datos)
+        stream_output = StreamOutput(output, logger) if stream else None
+        result = await device.run(datos, stream=stream_output)
         end = datetime.now()
-        output.write(result)
+        if stream_output:
+            result = f"-> {stream_output.count} results streamed to '{output.name}'"
+        else:
+            output.write(result)
         logger.info(f"File '{output.name}' created")
         if verbose in [1,2]:
             print (f"\n{result}")  
             print (f"-> Execution time: '{end - start}'")
+        if reader.error:
+            raise typer.Exit(code=1)
 
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
@@ -59,48 +75,25 @@ def push_multiple_host(
         devices: Annotated[typer.FileText, typer.Option("--hosts", "-h", help="group of hosts", metavar="FILENAME Json file", rich_help_panel="Connection Parameters", case_sensitive=False)],
         cmd_file: Annotated[typer.FileText, typer.Option("--cmdf", "-f", help="commands to configure on the device", metavar="FILENAME Json file",rich_help_panel="Connection Parameters", case_sensitive=False)],
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+        workers: Annotated[int, typer.Option("--workers", "-w", help="maximum number of devices processed concurrently", rich_help_panel="Additional Parameters", min=1)] = config_data.get("workers"),
+        preflight: Annotated[bool, typer.Option("--preflight", help="probe every host with a short TCP connect and skip the unreachable ones before connecting", rich_help_panel="Additional Parameters")] = config_data.get("preflight"),
+        profile: Annotated[bool, typer.Option("--profile", help="apply the delay factor and read timeout learned for each device by 'cla ssh --learn'", rich_help_panel="Additional Parameters")] = False,
         output: Annotated[typer.FileTextWrite, typer.Option("--output", "-o", help="output file", metavar="FILENAME text file", rich_help_panel="Additional Parameters", case_sensitive=False)] = "output.txt",
     ):
 
     async def process():
-        datos = []
-        file_name = devices.name
-        try:
-            datos_devices = json.loads(devices.read())
-        except Exception:
-            typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
-            raise typer.Exit(code=1)
-        
-        if "devices" not in datos_devices:
-            typer.echo(f"Error reading json file: 'devices' key not found or reading an incorrect json file '{file_name}'")
-            raise typer.Exit(code=1)
-        list_devices = datos_devices.get("devices")
-
+        from .svc_inventory import InventoryReader
+        from .svc_telnet import AsyncNetmikoTelnetPush
         file_name = cmd_file.name
         try:
             datos_cmds = json.loads(cmd_file.read())
         except Exception:
             typer.echo(f"** Error reading the json file '{file_name}', check the syntax")
             raise typer.Exit(code=1)
-        
-        for device in list_devices:
-            if device.get("host") not in datos_cmds:
-                typer.echo(f"Error reading json file: commands not found for host '{device.get('host')}' or reading an incorrect json file '{file_name}'")
-                raise typer.Exit(code=1)
-            else:
-                if "commands" not in datos_cmds.get(device.get("host")):
-                    typer.echo(f"Error reading json file: 'commands' key not found in '{cmd_file.name}' for host '{device.get('host')}' or reading an incorrect json file '{cmd_file.name}'")
-                    raise typer.Exit(code=1)
-        
-            dic = {
-                "device": device,
-                "commands": datos_cmds.get(device.get("host")).get('commands')
-            }
-            datos.append(dic)
 
-        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger}
-        if verbose == 2:
-            print (f"--> data: {json.dumps(datos, indent=3)}")
+        reader = InventoryReader({"verbose": verbose, "logger": logger})
+        datos = reader.device_commands(devices, commands_data=datos_cmds, commands_name=cmd_file.name)
+        inst_dict = {"verbose": verbose, "single_host": False, "logger": logger, "workers": workers, "preflight": preflight, "profile": profile}
         start = datetime.now()
         logger.info(f"Running Telnet command pushconfig on devices '{devices.name}'")
         netm = AsyncNetmikoTelnetPush(inst_dict=inst_dict)
@@ -110,6 +103,8 @@ def push_multiple_host(
         if verbose in [1,2]:
             print (f"\n{result}")
             print (f"-> Execution time: '{end - start}'")
+        if reader.error:
+            raise typer.Exit(code=1)
 
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
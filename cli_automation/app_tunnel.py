@@ -7,9 +7,10 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', ".
 
 import typer
 from typing_extensions import Annotated
+from typing import List
 from .svc_progress import ProgressBar
 import asyncio
-from .svc_tunnel import SetSocks5Tunnel
+import json
 from cli_automation import logger, config_data
 
 app = typer.Typer(no_args_is_help=True)
@@ -17,31 +18,56 @@ app = typer.Typer(no_args_is_help=True)
 @app.command("setup", short_help="Setup a tunnel to the Bastion Host", no_args_is_help=True)
 def set_tunnel(
         bastion_user: Annotated[str, typer.Option("--user", "-u", help="bastion host username", rich_help_panel="Tunnel Parameters", case_sensitive=False)],
-        bastion_host: Annotated[str, typer.Option("--bastion", "-b", help="bastion name or ip address", rich_help_panel="Tunnel Parameters", case_sensitive=False)],
-        local_port: Annotated[int, typer.Option("--port", "-p", help="local port", rich_help_panel="Tunnel Parameters", min=1000, max=1100)] = config_data.get("tunnel_local_port", 1080),
+        bastion_hosts: Annotated[List[str], typer.Option("--bastion", "-b", help="bastion name or ip address, one tunnel pool across several bastions", metavar="Multiple -b parameter", rich_help_panel="Tunnel Parameters", case_sensitive=False)],
+        local_port: Annotated[int, typer.Option("--port", "-p", help="local port, next tunnels use the next ports", rich_help_panel="Tunnel Parameters", min=1000, max=1100)] = config_data.get("tunnel_local_port", 1080),
+        count: Annotated[int, typer.Option("--count", "-n", help="tunnels to each bastion host", rich_help_panel="Tunnel Parameters", min=1, max=16)] = 1,
+        daemon: Annotated[bool, typer.Option("--daemon", "-d", help="run the tunnels in the cla tunnel daemon instead of ssh processes", rich_help_panel="Tunnel Parameters")] = False,
         timeout: Annotated[int, typer.Option("--timeout", "-t", help="timeout in seconds for the tunnel startup", rich_help_panel="Tunnel Parameters", min=3, max=25)] = config_data.get("tunnel_timeout", 10),
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 1,
     ):
 
+    if local_port + len(bastion_hosts) * count - 1 > 1100:
+        print (f"** {len(bastion_hosts) * count} tunnels starting at local-port {local_port} go beyond local-port 1100")
+        raise typer.Exit(code=1)
+
     async def process():
+        from .svc_tunnel import SetSocks5Tunnel
         inst_dict = {"verbose": verbose, "logger": logger}
         tunnel = SetSocks5Tunnel(inst_dict)
-        tunnel_pid, msg = await tunnel.start_tunnel(timeout=timeout, bastion_user=bastion_user, bastion_host=bastion_host, local_port=local_port)
-        if tunnel_pid:    
-            print (f"\n** Tunnel started successfully for user: '{bastion_user}', bastion host: '{bastion_host}', local-port: '{local_port}', PID: '{tunnel_pid}'")
-        else:
-            print (f"\n** Tunnel failed to start for user: '{bastion_user}', bastion host: '{bastion_host}', local-port: '{local_port}'. \n{msg}")
+        start = tunnel.start_daemon if daemon else tunnel.start_tunnels
+        results = await start(timeout=timeout, bastion_user=bastion_user, bastion_hosts=bastion_hosts, local_port=local_port, count=count)
+        for result in results:
+            if result["pid"]:
+                print (f"\n** Tunnel started successfully for user: '{bastion_user}', bastion host: '{result['bastion_host']}', local-port: '{result['local_port']}', PID: '{result['pid']}'")
+            else:
+                print (f"\n** Tunnel failed to start for user: '{bastion_user}', bastion host: '{result['bastion_host']}', local-port: '{result['local_port']}'. \n{result['msg']}")
+        if len(results) > 1:
+            print (f"\n** Tunnel pool ready with {len([result for result in results if result['pid']])} of {len(results)} tunnels")
 
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
 
 
-@app.command("kill", short_help="Kill the tunnel to the bastion Host")
+@app.command("run", short_help="Run the tunnel daemon in foreground", help="Runs the tunnels of config.json in foreground, useful under a service manager. 'cla tunnel setup --daemon' runs this command in background")
+def run_daemon(
+        verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 0,
+    ):
+
+    async def process():
+        from .svc_forwarder import TunnelDaemon
+        daemon = TunnelDaemon(inst_dict={"verbose": verbose, "logger": logger})
+        await daemon.serve()
+
+    asyncio.run(process())
+
+
+@app.command("kill", short_help="Kill the tunnels to the bastion Hosts")
 def kill_tunnel(
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 1,
     ):
    
     async def process():
+        from .svc_tunnel import SetSocks5Tunnel
         inst_dict = {"verbose": verbose, "logger": logger}
         tunnel = SetSocks5Tunnel(inst_dict)
         await tunnel.kill_tunnel()
@@ -49,22 +75,32 @@ def kill_tunnel(
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
 
-@app.command("status", short_help="Check the tunnel status", no_args_is_help=True)
+@app.command("status", short_help="Check the tunnel status")
 def check_tunnel(
-        local_port: Annotated[int, typer.Option("--port", "-p", help="local port", rich_help_panel="Tunnel Parameters", min=1000, max=1100)] = config_data.get("tunnel_local_port", 1080),
+        local_port: Annotated[int, typer.Option("--port", "-p", help="local port of the tunnel to check, all the tunnels of the pool by default", rich_help_panel="Tunnel Parameters", min=1000, max=1100)] = None,
         timeout: Annotated[int, typer.Option("--timeout", "-t", help="timeout in seconds for the tunnel return its status", rich_help_panel="Tunnel Parameters", min=3, max=20)] = config_data.get("tunnel_timeout", 10),
         test_port: Annotated[int, typer.Option("--test", "-r", help="remote port for testing the tunnel", rich_help_panel="Tunnel Parameters")] = config_data.get("tunnel_port_test", 22),
         verbose: Annotated[int, typer.Option("--verbose", "-v", count=True, help="verbose level",rich_help_panel="Additional Parameters", min=0, max=2)] = 1,
     ):
     
     async def process():
+        from .svc_tunnel import SetSocks5Tunnel
         inst_dict = {"verbose": verbose, "logger": logger}
         tunnel = SetSocks5Tunnel(inst_dict)
         tunnel_status = await tunnel.tunnel_status(timeout=timeout,test_port=test_port, local_port=local_port)
-        if tunnel_status:
-            typer.echo (f"\n** Tunnel is running at local-port '{local_port}'")
-        else:
-            typer.echo (f"\n** Tunnel is not running at local-port '{local_port}'. Check the log file if you suspect inconsistencies")
+        if not tunnel_status:
+            typer.echo (f"\n** No tunnel is configured, start one with 'cla tunnel setup'")
+        elif tunnel_status[0].get("state") and verbose in [1,2]:
+            typer.echo (f"-> Tunnels run by the tunnel daemon, PID {tunnel_status[0]['pid']}")
+            if verbose in [2]:
+                typer.echo (json.dumps(tunnel_status, indent=2))
+        for status in tunnel_status:
+            if status["healthy"]:
+                typer.echo (f"\n** Tunnel is running at local-port '{status['local_port']}', bastion host '{status['bastion_host']}'")
+            elif status.get("state"):
+                typer.echo (f"\n** Tunnel is {status['state']} at local-port '{status['local_port']}', bastion host '{status['bastion_host']}', the tunnel daemon keeps retrying. Last error: {status['last_error']}")
+            else:
+                typer.echo (f"\n** Tunnel is not running at local-port '{status['local_port']}', bastion host '{status['bastion_host']}', dropped from the pool. Check the log file if you suspect inconsistencies")
 
     progress = ProgressBar()
     asyncio.run(progress.run_with_spinner(process))
@@ -76,7 +112,7 @@ def callback(ctx: typer.Context):
     Sometimes, the machine running CLA doesn’t have direct access to the devices and must go through a Bastion Host or Jump Host. To connect via a Bastion Host, 
     you can either configure SSH specifically or set up a tunnel (CLA supports both modes of operation). Personally, I think creating a tunnel is more efficient since it avoids SSH configuration, 
     specially when using `Telnet` commands. 
-    Using `cla tunnel`, you can create or remove a SOCKS5 tunnel. For `cla tunnel` to function properly, the host running CLA must have easy access to the 
+    Using `cla tunnel`, you can create or remove a SOCKS5 tunnel, or a pool of them to one or several Bastion Hosts, run by ssh or by the cla tunnel daemon. For `cla tunnel` to function properly, the host running CLA must have easy access to the 
     Bastion Host (it should be listed in the Bastion Host's known_hosts file). CLA constantly monitors the tunnel’s status, but you can also manually check it using 
     the Linux command `lsof -i:{local_port}`.
     """
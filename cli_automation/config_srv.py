@@ -1,9 +1,62 @@
 
 CONFIG_PARAMS = {
     "log_file": "cla.log",
+    "log_level": "DEBUG",
+    "log_output_max": 4096,
+    "log_queue_size": 10000,
     "telnet_prompts": [">", "#", "(config)#", "(config-if)#", "$", "%", "> (doble)","# (doble)", "?", ")", "!", "*", "~", ":]", "]", ">", "##"],
+    "telnet_read_timeout": 20,
     "tunnel_port_test": 22,
     "tunnel_timeout": 10,
+    "tunnel_max_channels": 10,
+    "tunnel_queue_timeout": 300,
+    "tunnel_balance": "least-loaded",
+    "tunnels": [],
+    "tunnel_subnets": [],
+    "tunnel_state_file": "cla-tunnel.json",
+    "tunnel_state_ttl": 60,
+    "tunnel_socket": "cla-tunnel.sock",
+    "tunnel_pid_file": "cla-tunnel.pid",
+    "tunnel_keepalive": 15,
+    "tunnel_reconnect_min": 1,
+    "tunnel_reconnect_max": 60,
     "proxy_host": "localhost",
-    "tunnel_local_port": 1080
+    "tunnel_local_port": 1080,
+    "workers": 32,
+    "workers_per_type": {},
+    "workers_per_site": {},
+    "scheduler_monitor_interval": 5,
+    "scheduler_backlog": 1024,
+    "agent_socket": "cla-agent.sock",
+    "agent_idle_timeout": 300,
+    "agent_summary_requests": 100,
+    "cache_file": "cla-cache.json",
+    "cache_ttl": 300,
+    "cache_ttl_commands": {},
+    "cache_max_entries": 10000,
+    "engine": "netmiko",
+    "async_connect_timeout": 10,
+    "async_read_timeout": 10,
+    "async_host_key_check": True,
+    "parse": "inline",
+    "parse_workers": None,
+    "parse_pool_min_chars": 4096,
+    "textfsm_index_file": "cla-textfsm-index.json",
+    "preflight": False,
+    "preflight_timeout": 2,
+    "preflight_banner": False,
+    "preflight_concurrency": 256,
+    "profile_file": "cla-profiles.json",
+    "profile_samples": 20,
+    "profile_delay_reference": 0.5,
+    "profile_timeout_factor": 3,
+    "profile_min_read_timeout": 10,
+    "profile_max_read_timeout": 600,
+    "wave_canary": 1,
+    "wave_growth": 2,
+    "wave_max": None,
+    "wave_failure_rate": 0.1,
+    "jump_multiplex": True,
+    "jump_timeout": 10,
+    "jump_keepalive": 15
 }
\ No newline at end of file
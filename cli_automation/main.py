@@ -3,23 +3,51 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), ".", "..")))
 
 import typer
+from typer.core import TyperCommand, TyperGroup
 from typing_extensions import Annotated
-from cli_automation import config_data
-from cli_automation.svc_progress import ProgressBar
-from cli_automation.svc_templates import Templates
+import importlib
 import asyncio
-from cli_automation import logger, __version__
-from cli_automation import app_telnet
-from cli_automation import app_tunnel
-from cli_automation import app_ssh
+import cli_automation
+from cli_automation import __version__
+from cli_automation.svc_progress import ProgressBar
 from cli_automation.svc_logs import ReadLogs
+from cli_automation.svc_enums import LogLevel
 from pathlib import Path
 
-app = typer.Typer(no_args_is_help=True, pretty_exceptions_short=True)
+# Sub-commands are imported when they are invoked, 'cla --version', 'cla logs' and the
+# shell completion of the main commands do not load netmiko, paramiko or textfsm
+SUBCOMMANDS = {
+    "ssh": ("cli_automation.app_ssh", "Accesses devices via the SSH protocol"),
+    "telnet": ("cli_automation.app_telnet", "Accesses devices via the Telnet protocol"),
+    "tunnel": ("cli_automation.app_tunnel", "Manage tunnel with Bastion Host"),
+    "agent": ("cli_automation.app_agent", "Manage the persistent sessions agent"),
+}
+
+
+class LazyCommand(TyperCommand):
+    def __init__(self, name: str, module: str, short_help: str):
+        super().__init__(name, short_help=short_help, help=short_help, rich_help_panel="Main Commands")
+        self.module = module
+
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        command = typer.main.get_group(importlib.import_module(self.module).app)
+        command.name = self.name
+        return command.make_context(info_name, args, parent=parent, **extra)
+
+
+class LazyGroup(TyperGroup):
+    def list_commands(self, ctx) -> list:
+        return super().list_commands(ctx) + list(SUBCOMMANDS)
+
+
+    def get_command(self, ctx, name: str):
+        if name in SUBCOMMANDS:
+            return LazyCommand(name, *SUBCOMMANDS[name])
+        return super().get_command(ctx, name)
+
 
-app.add_typer(app_ssh.app, name="ssh", rich_help_panel="Main Commands")
-app.add_typer(app_telnet.app, name="telnet", rich_help_panel="Main Commands")
-app.add_typer(app_tunnel.app, name="tunnel", rich_help_panel="Main Commands")
+app = typer.Typer(cls=LazyGroup, no_args_is_help=True, pretty_exceptions_short=True)
 
 def complete_log_files(incomplete: str):
     log_dir = Path(__file__).parent / "logs"
@@ -41,7 +69,7 @@ def complete_log_files(incomplete: str):
 def check_version(value: bool):
     if value:
         typer.echo (f"version: {__version__}")
-        logger.info(f"Checked version: {__version__}")
+        cli_automation.logger.info(f"Checked version: {__version__}")
         raise typer.Exit()
 
 
@@ -57,6 +85,8 @@ def download_templates(
     ):
    
     async def process():
+        from cli_automation.svc_templates import Templates
+        logger = cli_automation.logger
         inst_dict = {"logger": logger, "verbose": verbose}
         template = Templates(inst_dict=inst_dict)
         try:
@@ -77,6 +107,7 @@ def read_logs(
         log_file: Annotated[str, typer.Option("--log-file", "-l", help="Path to the log file (use Tab for completion)", rich_help_panel="Additional parameters", autocompletion=complete_log_files)] = "cla.log",
     ):
     async def process():
+        logger = cli_automation.logger
         inst_dict = {"logger": logger, "verbose": verbose}
         log_reader = ReadLogs(inst_dict=inst_dict)
         log_content = log_reader.read_log_file(file_path="logs/" + log_file)
@@ -108,8 +139,11 @@ def main(ctx: typer.Context,
             typer.Option("--version", "-V", 
             rich_help_panel="Check the version",
             callback=check_version,
-            is_eager=True)] = None):
+            is_eager=True)] = None,
+            log_level: Annotated[LogLevel, typer.Option("--log-level", help="log file level, INFO and above leave the device outputs out of the log. Overrides log_level in config.json", case_sensitive=False)] = None):
     
+    if log_level:
+        cli_automation.set_log_level(log_level.value)
     if ctx.invoked_subcommand is None:
         typer.echo("Please specify a command, try --help")
         raise typer.Exit(1)
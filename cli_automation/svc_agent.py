@@ -0,0 +1,185 @@
+# Persistent Sessions Agent Service Classes
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import json
+import logging
+import socket
+import subprocess
+import time
+from pathlib import Path
+from cli_automation import config_data
+from .svc_scheduler import DeviceScheduler
+from .svc_timing import PhaseTimer, TimingSummary
+
+STREAM_LIMIT = 2**24
+
+
+class AgentClient():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.socket_path = config_data.get("agent_socket")
+
+
+    def connect_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+    def is_running(self) -> bool:
+        if not Path(self.socket_path).exists():
+            return False
+        try:
+            self.connect_socket().close()
+            return True
+        except OSError:
+            return False
+
+
+    async def request(self, payload: dict) -> dict:
+        reader, writer = await asyncio.open_unix_connection(sock=self.connect_socket(), limit=STREAM_LIMIT)
+        try:
+            writer.write((json.dumps(payload) + "\n").encode())
+            await writer.drain()
+            response = await reader.readline()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        return json.loads(response)
+
+
+    async def submit(self, action: str, device: dict, commands: list, timer: PhaseTimer = None) -> any:
+        self.logger.debug("Sending %s for device %s through the cla agent", action, device['host'])
+        try:
+            response = await self.request({"action": action, "device": device, "commands": commands})
+        except (OSError, ValueError) as error:
+            self.logger.error(f"Error sending {action} for device {device['host']} through the cla agent: {error}")
+            return f"** Error connecting to {device['host']}, cla agent error: {error}"
+        if response.get("error"):
+            self.logger.error(f"cla agent error for device {device['host']}: {response.get('error')}")
+            return f"** Error connecting to {device['host']}, cla agent error: {response.get('error')}"
+        if timer:
+            timer.merge(response.get("timing"))
+        return response.get("output")
+
+
+    async def start(self, timeout: float) -> bool:
+        if self.is_running():
+            return True
+        # The daemon logs at the level of the command that starts it
+        command = [sys.executable, "-m", "cli_automation", "--log-level", logging.getLevelName(self.logger.getEffectiveLevel()), "agent", "run"]
+        self.logger.info(f"Starting the cla agent, socket {self.socket_path}")
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            if self.is_running():
+                return True
+        return False
+
+
+class SessionAgent():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.sessions = inst_dict.get('sessions')
+        self.services = inst_dict.get('services')
+        self.scheduler = DeviceScheduler(inst_dict=inst_dict)
+        self.socket_path = config_data.get("agent_socket")
+        self.idle_timeout = config_data.get("agent_idle_timeout")
+        self.summary_requests = config_data.get("agent_summary_requests")
+        self.started = time.time()
+        self.requests = 0
+        self.stop_event = asyncio.Event()
+
+
+    def listen_socket(self) -> socket.socket:
+        path = Path(self.socket_path)
+        if path.exists():
+            path.unlink()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket is created owner-only, other users never get a window to connect before the chmod
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        return sock
+
+
+    async def evict_idle(self) -> None:
+        while True:
+            await asyncio.sleep(max(1, self.idle_timeout / 2))
+            evicted = await self.sessions.evict_idle(self.idle_timeout)
+            if evicted:
+                self.logger.info(f"cla agent evicted {evicted} idle sessions")
+
+
+    async def dispatch(self, request: dict) -> dict:
+        action = request.get("action")
+        if action == "status":
+            return {"output": {"pid": os.getpid(), "uptime": round(time.time() - self.started), "requests": self.requests, "sessions": self.sessions.stats()}}
+        if action == "stop":
+            self.stop_event.set()
+            return {"output": "cla agent stopping"}
+        if action not in self.services:
+            return {"error": f"unknown action '{action}'"}
+        device = request.get("device")
+        self.requests += 1
+        self.logger.info(f"cla agent executing {action} on device {device.get('host')}")
+        timer = PhaseTimer()
+        output = await self.scheduler.run(device, self.services[action], device, request.get("commands"), timer=timer)
+        if self.summary_requests and self.requests % self.summary_requests == 0:
+            self.summary()
+        return {"output": output, "timing": timer.result()}
+
+
+    def summary(self) -> None:
+        # The agent never ends a run, its timings are reported every agent_summary_requests
+        # requests and at shutdown, each summary covers the requests since the previous one
+        self.scheduler.summary()
+        self.scheduler.timings = TimingSummary()
+
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            response = await self.dispatch(request)
+        except Exception as error:
+            self.logger.error(f"cla agent request error: {error}")
+            response = {"error": str(error)}
+        try:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+    async def serve(self) -> None:
+        server = await asyncio.start_unix_server(self.handle_client, sock=self.listen_socket(), limit=STREAM_LIMIT)
+        eviction = asyncio.create_task(self.evict_idle())
+        self.logger.info(f"cla agent listening on {self.socket_path}, PID {os.getpid()}, idle timeout {self.idle_timeout}s")
+        if self.verbose in [1,2]:
+            print (f"-> cla agent listening on {self.socket_path}, PID {os.getpid()}")
+        try:
+            async with server:
+                await self.stop_event.wait()
+        finally:
+            eviction.cancel()
+            if self.scheduler.timings.report():
+                self.summary()
+            await self.sessions.close_all()
+            if Path(self.socket_path).exists():
+                Path(self.socket_path).unlink()
+            self.logger.info(f"cla agent stopped")
@@ -0,0 +1,266 @@
+# Async SSH Sessions Service Classes
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import re
+import socket
+from contextlib import asynccontextmanager
+from netmiko import NetmikoAuthenticationException, NetMikoTimeoutException
+from netmiko.exceptions import ReadTimeout
+from cli_automation import config_data
+from .svc_jump import AsyncJumpHosts, jump_route
+from .svc_platforms import platform_profile
+from .svc_proxy import open_connection, via_tunnel
+from .svc_sessions import SessionError
+from .svc_timing import PhaseTimer, phase
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+MORE = re.compile(r"-+\s*\(?more\)?[^\n]*$", re.IGNORECASE)
+
+
+class AsyncsshConnection():
+    # Exposes the netmiko methods used by the SSH services as coroutines, every session
+    # runs on the event loop instead of holding a worker thread
+    def __init__(self, device: dict, logger, jumps: AsyncJumpHosts = None):
+        self.device = device
+        self.logger = logger
+        self.jumps = jumps
+        self.host = device['host']
+        self.port = device.get('port') or 22
+        self.profile = platform_profile(device['device_type'])
+        self.terminator = self.profile["prompt"]
+        self.connect_timeout = config_data.get("async_connect_timeout")
+        self.read_timeout = device.get('read_timeout') or config_data.get("async_read_timeout")
+        self.connection = None
+        self.stdin = None
+        self.stdout = None
+        self.buffer = ""
+        self.prompt = ""
+        self.prompt_pattern = None
+
+
+    async def open_socket(self) -> socket.socket:
+        loop = asyncio.get_running_loop()
+        if via_tunnel(self.device):
+            # The SOCKS handshake of the tunnel socket is blocking
+            return await asyncio.to_thread(open_connection, self.device, self.port, self.connect_timeout)
+        family, sock_type, proto, _, address = (await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM))[0]
+        sock = socket.socket(family, sock_type, proto)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, address), self.connect_timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+
+    async def open(self, timer: PhaseTimer = None) -> None:
+        options = {
+            "username": self.device.get('username'),
+            "password": self.device.get('password'),
+            "client_keys": None,
+            "agent_path": None,
+            "connect_timeout": self.connect_timeout,
+        }
+        if not config_data.get("async_host_key_check"):
+            # Host keys are checked against the known_hosts of the user unless config.json turns it off
+            options["known_hosts"] = None
+        try:
+            route = jump_route(self.device) if self.jumps else None
+            if route:
+                # The jump host connection is shared, the ssh config file still gives the device hostname
+                with phase(timer, "connect"):
+                    tunnel = await self.jumps.connection(route)
+                with phase(timer, "auth"):
+                    self.connection = await asyncssh.connect(self.host, self.port, config=[route["config"]], tunnel=tunnel, **options)
+            elif self.device.get('ssh_config_file'):
+                # Proxies and jump hosts of the ssh config file are handled by asyncssh
+                with phase(timer, "auth"):
+                    self.connection = await asyncssh.connect(self.host, self.port, config=[self.device.get('ssh_config_file')], **options)
+            else:
+                with phase(timer, "connect"):
+                    sock = await self.open_socket()
+                with phase(timer, "auth"):
+                    self.connection = await asyncssh.connect(sock=sock, host=self.host, **options)
+        except asyncssh.PermissionDenied as error:
+            raise NetmikoAuthenticationException(f"Authentication to device failed: {error}")
+        except asyncssh.HostKeyNotVerifiable as error:
+            raise SessionError(f"Error connecting to {self.host}, host key not verified, add it to known_hosts or set async_host_key_check to false: {error}")
+        except (OSError, asyncio.TimeoutError, asyncssh.ConnectionLost) as error:
+            raise NetMikoTimeoutException(f"TCP connection to device failed, {self.host}:{self.port}: {error}")
+        with phase(timer, "auth"):
+            self.stdin, self.stdout, _ = await self.connection.open_session(term_type="vt100", term_size=(511, 1000))
+            # The login banner ends with a first prompt, it is consumed before looking for the prompt
+            await self.read_until(re.compile(self.terminator + r"\s*$"))
+            await self.find_prompt()
+            for command in self.profile["paging"]:
+                await self.send_command(command)
+
+
+    def write(self, data: str) -> None:
+        self.stdin.write(data)
+
+
+    async def read_until(self, pattern: re.Pattern, timeout: float = None) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.read_timeout)
+        while True:
+            match = pattern.search(self.buffer)
+            if match:
+                data, self.buffer = self.buffer[:match.end()], self.buffer[match.end():]
+                return data
+            if MORE.search(self.buffer):
+                self.buffer = MORE.sub("", self.buffer)
+                self.write(" ")
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise ReadTimeout(f"Pattern not detected: {pattern.pattern!r} in output from {self.host}")
+            try:
+                chunk = await asyncio.wait_for(self.stdout.read(65535), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if not chunk:
+                raise SessionError(f"Connection to device {self.host} closed")
+            self.buffer += chunk.replace("\r", "")
+
+
+    async def find_prompt(self) -> str:
+        self.buffer = ""
+        self.write("\n")
+        data = await self.read_until(re.compile(self.terminator + r"\s*$"))
+        self.prompt = data.strip().splitlines()[-1].strip()
+        base = re.sub(r"\(.*\)", "", self.prompt[:-1]).lstrip("<[")
+        # Config mode prompts, 'Router(config-if)#' or '[~HUAWEI-GigabitEthernet0/0/1]' after '<HUAWEI>',
+        # also match the base prompt
+        self.prompt_pattern = re.compile(r"[<\[]?~?" + re.escape(base) + r"[^\n]{0,64}?" + self.terminator + r"\s*$")
+        return self.prompt
+
+
+    def strip_output(self, command: str, data: str) -> str:
+        lines = data.split("\n")
+        if lines and command and command.strip() in lines[0]:
+            lines = lines[1:]
+        if lines and self.prompt_pattern.search(lines[-1]):
+            lines = lines[:-1]
+        return "\n".join(lines)
+
+
+    async def read_echo(self, command: str) -> str:
+        # As netmiko cmd_verify, the output starts after the echo of the command
+        if not command.strip():
+            return ""
+        return await self.read_until(re.compile(re.escape(command.strip()) + r"[^\n]*\n"))
+
+
+    async def send_command(self, command: str, expect_string: str = None) -> str:
+        self.write(command + "\n")
+        await self.read_echo(command)
+        pattern = re.compile(expect_string) if expect_string else self.prompt_pattern
+        return self.strip_output(None, await self.read_until(pattern))
+
+
+    async def enable(self) -> None:
+        if not self.profile["enable"] or not self.prompt.endswith(self.profile["unprivileged"]):
+            return
+        self.write(self.profile["enable"] + "\n")
+        data = await self.read_until(re.compile(r"(ssword|" + self.terminator + r")\s*:?\s*$"))
+        if "ssword" in data:
+            self.write((self.device.get('secret') or "") + "\n")
+            await self.read_until(re.compile(self.terminator + r"\s*$"))
+        if (await self.find_prompt()).endswith(self.profile["unprivileged"]):
+            raise SessionError(f"Failed to enter enable mode on device {self.host}")
+
+
+    async def send_config_set(self, commands: list) -> str:
+        output = []
+        steps = ([self.profile["config"]] if self.profile["config"] else []) + list(commands) + ([self.profile["config_exit"]] if self.profile["config_exit"] else [])
+        for command in steps:
+            self.write(command + "\n")
+            output.append(await self.read_echo(command) + await self.read_until(self.prompt_pattern))
+        return "".join(output)
+
+
+    async def send_multiline(self, commands: list) -> str:
+        output = []
+        for command in commands:
+            if isinstance(command, (list, tuple)):
+                command, expect_string = command[0], (command[1] if len(command) > 1 else None)
+            else:
+                expect_string = None
+            output.append(await self.send_command(command, expect_string=expect_string or None))
+        return "\n".join(output)
+
+
+    async def is_alive(self) -> bool:
+        return self.connection is not None and not self.stdout.at_eof()
+
+
+    async def disconnect(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            await self.connection.wait_closed()
+            self.connection = None
+
+
+class AsyncsshSessions():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.persistent = False
+        if asyncssh is None:
+            self.logger.error(f"The async engine requires the asyncssh package")
+            print (f"** The async engine requires the asyncssh package, install it with 'pip install asyncssh'")
+            sys.exit(1)
+        self.jumps = AsyncJumpHosts(inst_dict=inst_dict)
+
+
+    async def open(self, device: dict, timer: PhaseTimer = None) -> AsyncsshConnection:
+        connection = AsyncsshConnection(device, self.logger, self.jumps)
+        try:
+            await connection.open(timer)
+            with phase(timer, "enable"):
+                await connection.enable()
+        except BaseException:
+            await self.close(connection)
+            raise
+        self.logger.debug("Connection to %s is active, prompt %s", device['host'], connection.prompt)
+        return connection
+
+
+    async def close(self, connection: AsyncsshConnection, timer: PhaseTimer = None) -> None:
+        try:
+            with phase(timer, "disconnect"):
+                await connection.disconnect()
+        except Exception as error:
+            self.logger.debug("Error closing the connection to %s: %s", connection.host, error)
+
+
+    async def call(self, connection: AsyncsshConnection, method: str, *args) -> any:
+        return await getattr(connection, method)(*args)
+
+
+    @asynccontextmanager
+    async def connection(self, device: dict, timer: PhaseTimer = None):
+        connection = await self.open(device, timer)
+        try:
+            yield connection
+        finally:
+            await self.close(connection, timer)
+
+
+    async def finish(self) -> None:
+        stats = self.jumps.stats()
+        if stats["authentications"]:
+            self.logger.info(f"Jump hosts: {stats['jump_hosts']}, authentications: {stats['authentications']}, device channels: {stats['channels']}")
+            if self.verbose in [1,2]:
+                print (f"-> Jump hosts: {stats['jump_hosts']}, authentications: {stats['authentications']}, device channels: {stats['channels']}")
+        await self.jumps.close_all()
@@ -0,0 +1,96 @@
+# Device Output Cache Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+from cli_automation import config_data
+from .svc_inventory import device_key
+
+
+class OutputCache():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.cache_file = Path(config_data.get("cache_file"))
+        self.default_ttl = config_data.get("cache_ttl")
+        self.command_ttl = config_data.get("cache_ttl_commands") or {}
+        self.max_entries = config_data.get("cache_max_entries")
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+
+    def load(self) -> None:
+        try:
+            self.entries = OrderedDict(json.loads(self.cache_file.read_text()))
+            self.logger.debug(f"Output cache loaded from {self.cache_file}, {len(self.entries)} entries")
+        except FileNotFoundError:
+            self.entries = OrderedDict()
+        except (OSError, ValueError) as error:
+            self.logger.error(f"Output cache {self.cache_file} not loaded, starting empty: {error}")
+            self.entries = OrderedDict()
+
+
+    def save(self) -> None:
+        temp_file = self.cache_file.with_suffix(".tmp")
+        try:
+            # Cached outputs can hold running configs, the file is readable by its owner only
+            fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as file:
+                file.write(json.dumps(self.entries))
+            os.replace(temp_file, self.cache_file)
+            self.logger.debug(f"Output cache saved to {self.cache_file}, {len(self.entries)} entries")
+        except OSError as error:
+            self.logger.error(f"Output cache {self.cache_file} not saved: {error}")
+
+
+    def ttl(self, command: str) -> float:
+        # The longest configured prefix wins, 'show run' can differ from 'show'
+        matches = [prefix for prefix in self.command_ttl if command.startswith(prefix)]
+        if matches:
+            return self.command_ttl[max(matches, key=len)]
+        return self.default_ttl
+
+
+    def key(self, device: dict, command: str) -> str:
+        return f"{device_key(device)}|{command}"
+
+
+    def get(self, device: dict, command: str) -> dict | None:
+        key = self.key(device, command)
+        entry = self.entries.get(key)
+        if entry is not None:
+            age = time.time() - entry["stored"]
+            if age <= self.ttl(command):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return {**entry["output"], "cached": True, "age": round(age, 1)}
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+
+    def put(self, device: dict, command: str, output: dict) -> None:
+        if self.ttl(command) <= 0:
+            return
+        key = self.key(device, command)
+        self.entries[key] = {"stored": time.time(), "output": output}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+    def drop(self, device: dict, command: str) -> None:
+        self.entries.pop(self.key(device, command), None)
+
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,124 @@
+# Output Classifier Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import re
+from functools import lru_cache
+
+# Error signatures of the CLI of each DeviceType, every platform also gets the COMMON ones.
+# The names are the regex group names, the one that matches tells why a command failed
+COMMON = {
+    "invalid_input": r"Invalid input",
+    "invalid_command": r"% ?Invalid command",
+    "incomplete_command": r"Incomplete command",
+    "ambiguous_command": r"Ambiguous command",
+    "authentication_failed": r"Authentication to device failed",
+    "error": r"\bError\b",
+}
+SIGNATURES = {
+    "cisco_ios": {"bad_mask": r"% ?Bad mask", "overlaps": r"% ?\S+ overlaps with"},
+    "cisco_xe": {"bad_mask": r"% ?Bad mask", "overlaps": r"% ?\S+ overlaps with"},
+    "cisco_xr": {"commit_failed": r"% ?Failed to commit", "xr_error": r"^!!% "},
+    "cisco_nxos": {"permission_denied": r"% ?Permission denied", "nxos_failed": r"^ERROR: "},
+    "arista_eos": {"not_supported": r"% ?Not supported", "unavailable": r"% ?Unavailable command"},
+    "juniper": {"syntax_error": r"syntax error", "unknown_command": r"unknown command", "missing_argument": r"missing argument", "junos_error": r"^error: "},
+    "huawei": {"unrecognized_command": r"Unrecognized command", "wrong_parameter": r"Wrong parameter", "too_many_parameters": r"Too many parameters"},
+    "alcatel_sros": {"sros_error": r"^(?:MINOR|MAJOR|CRITICAL): "},
+    "vyos": {"vyos_invalid": r"is not valid", "set_failed": r"Set failed", "commit_failed": r"Commit failed"},
+    "extreme_exos": {"exos_invalid": r"^%% Invalid", "exos_error": r"^Error: "},
+}
+SIGNATURES["juniper_junos"] = SIGNATURES["juniper"]
+SIGNATURES["huawei_vrp"] = SIGNATURES["huawei"]
+SIGNATURES["vyatta_vyos"] = SIGNATURES["vyos"]
+SIGNATURES["extreme"] = SIGNATURES["extreme_exos"]
+
+# The echo of a command after the device prompt, 'Router(config-if)#description x', '[~HUAWEI]undo x'
+ECHO = re.compile(r"^[^\s>#$%]*[>#$\]]\s?(?P<command>\S.*)$")
+ECHO_LOOKBACK = 20
+
+
+def first_chars(regex: str) -> str | None:
+    # The characters a signature can start with, None when they can not be told apart
+    regex = re.sub(r"^(?:\^|\\b)+", "", regex)
+    if regex.startswith("(?:"):
+        branches = regex[3:regex.index(")")].split("|")
+        chars = [first_chars(branch) for branch in branches]
+        return None if None in chars else "".join(chars)
+    if not regex or regex[0] in ".[(\\":
+        return None
+    return regex[0]
+
+
+class OutputClassifier():
+    # All the signatures of a DeviceType compiled into a single pattern, one pass over the
+    # output finds every error whatever its size, and each one is traced back to the echo
+    # of the command that caused it
+    def __init__(self, device_type: str):
+        self.device_type = device_type
+        signatures = {**COMMON, **SIGNATURES.get(device_type, {})}
+        pattern = "|".join(f"(?P<{name}>{regex})" for name, regex in signatures.items())
+        chars = [first_chars(regex) for regex in signatures.values()]
+        if None not in chars:
+            # Positions that can not start a signature are skipped by a single character test
+            pattern = f"(?=[{re.escape(''.join(sorted(set(''.join(chars)))))}])(?:{pattern})"
+        self.pattern = re.compile(pattern, re.MULTILINE)
+
+
+    def search(self, text: str) -> dict | None:
+        match = self.pattern.search(text)
+        if match is None:
+            return None
+        return {"reason": match.lastgroup, "error": self.line(text, match.start())}
+
+
+    def line(self, text: str, position: int) -> str:
+        start = text.rfind("\n", 0, position) + 1
+        end = text.find("\n", position)
+        return text[start:end if end != -1 else len(text)].strip()
+
+
+    def command(self, text: str, position: int) -> str | None:
+        # Walks back, line by line, to the closest command echo before the error
+        end = text.rfind("\n", 0, position)
+        for _ in range(ECHO_LOOKBACK):
+            if end <= 0:
+                return None
+            start = text.rfind("\n", 0, end) + 1
+            echo = ECHO.match(text[start:end].rstrip("\r"))
+            if echo:
+                return echo.group("command").strip()
+            end = start - 1
+        return None
+
+
+    def classify(self, output: str | list) -> list:
+        # Every error of a transcript, as {"command", "reason", "error"}
+        text = "\n".join(output) if isinstance(output, list) else str(output)
+        failures = []
+        last_line = -1
+        for match in self.pattern.finditer(text):
+            line_start = text.rfind("\n", 0, match.start()) + 1
+            if line_start == last_line:
+                # One failure per line, 'Error: Invalid input' is a single error
+                continue
+            last_line = line_start
+            failures.append({"command": self.command(text, line_start), "reason": match.lastgroup, "error": self.line(text, match.start())})
+        return failures
+
+
+    def classify_commands(self, commands: list, outputs: list) -> list:
+        # Outputs already split by command, as the Telnet sessions return them
+        failures = []
+        for command, output in zip(commands, outputs):
+            failure = self.search(output)
+            if failure:
+                failures.append({"command": command, **failure})
+        return failures
+
+
+@lru_cache(maxsize=None)
+def output_classifier(device_type: str) -> OutputClassifier:
+    return OutputClassifier(device_type)
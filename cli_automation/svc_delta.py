@@ -0,0 +1,230 @@
+# Configuration Delta Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import re
+
+# How the running config of each DeviceType is read and structured. 'indent' configs nest the
+# lines of a context under its parent, 'set' configs are flat lists of complete statements
+IOS_CONTEXTS = (
+    "interface ", "router ", "line ", "vlan ", "vrf ", "ip vrf ", "ip access-list ", "ipv6 access-list ",
+    "route-map ", "class-map ", "policy-map ", "key chain ", "crypto ", "object-group ", "controller ",
+    "track ", "aaa group server ", "ip dhcp pool ", "management ", "spanning-tree mst configuration",
+)
+IOS_NESTED = ("address-family ", "class ", "key ")
+# Interface types in the order the IOS parser tries them, 'int gi0/1' is 'interface GigabitEthernet0/1'.
+# The types found in the running config are tried first
+IOS_INTERFACES = (
+    "GigabitEthernet", "FastEthernet", "TenGigabitEthernet", "TwentyFiveGigE", "FortyGigabitEthernet", "HundredGigE",
+    "Ethernet", "Loopback", "Port-channel", "Vlan", "Tunnel", "Serial", "BDI", "mgmt", "Management",
+)
+INTERFACE = re.compile(r"^(?P<negation>no |undo )?(?P<keyword>int[a-z]*) (?P<type>[a-z][a-z-]*?) ?(?P<number>\d[\w/.:-]*)$", re.IGNORECASE)
+CISCO = {
+    "command": "show running-config",
+    "style": "indent",
+    "comment": "!",
+    "skip": ("Building configuration", "Current configuration", "end", "Last configuration change", "NVRAM config last updated"),
+    "contexts": IOS_CONTEXTS,
+    "nested": IOS_NESTED,
+    "interfaces": IOS_INTERFACES,
+    "negation": "no ",
+    "exit": "exit",
+}
+
+DELTA_PLATFORMS = {
+    "cisco_ios": CISCO,
+    "cisco_xe": CISCO,
+    "cisco_xr": CISCO,
+    "cisco_nxos": CISCO,
+    "arista_eos": CISCO,
+    "huawei": {**CISCO, "command": "display current-configuration", "comment": "#", "skip": ("return",), "contexts": ("interface ", "bgp ", "ospf ", "acl ", "vlan ", "aaa", "user-interface ", "ip vpn-instance "), "nested": ("ipv4-family ", "area "), "interfaces": ("GigabitEthernet", "XGigabitEthernet", "Ethernet", "Eth-Trunk", "LoopBack", "Vlanif", "Tunnel", "MEth"), "negation": "undo ", "exit": "quit"},
+    "alcatel_sros": {**CISCO, "command": "admin display-config", "comment": "#", "skip": ("exit", "echo "), "contexts": ("configure",), "nested": (), "negation": "no ", "exit": "exit"},
+    "juniper": {"command": "show configuration | display set", "style": "set", "comment": "#", "skip": (), "negation": "delete ", "statement": "set "},
+    "vyos": {"command": "show configuration commands", "style": "set", "comment": "#", "skip": (), "negation": "delete ", "statement": "set "},
+    "extreme_exos": {"command": "show configuration", "style": "set", "comment": "#", "skip": (), "negation": "unconfigure ", "statement": "configure "},
+}
+DELTA_PLATFORMS["juniper_junos"] = DELTA_PLATFORMS["juniper"]
+DELTA_PLATFORMS["huawei_vrp"] = DELTA_PLATFORMS["huawei"]
+DELTA_PLATFORMS["vyatta_vyos"] = DELTA_PLATFORMS["vyos"]
+DELTA_PLATFORMS["extreme"] = DELTA_PLATFORMS["extreme_exos"]
+
+SPACES = re.compile(r"\s+")
+
+
+def delta_profile(device_type: str) -> dict:
+    return DELTA_PLATFORMS.get(device_type, CISCO)
+
+
+def normalize(line: str) -> str:
+    return SPACES.sub(" ", line.strip())
+
+
+def keyword(line: str, negation: str = "no ") -> str:
+    # 'description', 'ip address', 'logging event', the negation is not part of it
+    if line.startswith(negation):
+        line = line[len(negation):]
+    words = line.split()
+    return " ".join(words[:2] if words and words[0] in ("ip", "ipv6", "logging") else words[:1])
+
+
+class ConfigDelta():
+    # Compares the intended commands of a device with its running config and returns the
+    # commands that are missing, each one preceded by the context lines it needs
+    def __init__(self, device_type: str):
+        self.profile = delta_profile(device_type)
+        self.command = self.profile["command"]
+        self.ambiguous = []
+
+
+    def relevant(self, line: str) -> bool:
+        text = line.strip()
+        if not text or text.startswith(self.profile["comment"]):
+            return False
+        return not any(text == skip.strip() or text.startswith(skip) for skip in self.profile["skip"])
+
+
+    def running_tree(self, running: str) -> dict:
+        # {line: {child line: {...}}}, built from the indentation of the running config
+        tree = {}
+        if self.profile["style"] == "set":
+            for line in running.splitlines():
+                if self.relevant(line):
+                    tree[normalize(line)] = {}
+            return tree
+        stack = [(-1, tree)]
+        for line in running.splitlines():
+            if not self.relevant(line):
+                continue
+            indent = len(line) - len(line.lstrip())
+            while stack[-1][0] >= indent:
+                stack.pop()
+            children = stack[-1][1].setdefault(normalize(line), {})
+            stack.append((indent, children))
+        return tree
+
+
+    def expand(self, line: str, tree: dict) -> str:
+        # Abbreviated interface lines, as the device would complete them. Other commands must be
+        # written in full to be found in the running config
+        match = INTERFACE.match(line)
+        if not match or not "interface".startswith(match["keyword"].lower()):
+            return line
+        running = [existing.split()[1] for existing in tree if existing.startswith("interface ") and len(existing.split()) > 1]
+        types = [re.sub(r"\d.*$", "", name) for name in running] + list(self.profile.get("interfaces", ()))
+        typed = match["type"].lower()
+        for name in types:
+            if name.lower().startswith(typed):
+                return f"{match['negation'] or ''}interface {name}{match['number']}"
+        return line
+
+
+    def child_keywords(self, tree: dict, parent: str) -> set:
+        # Two word keywords of the lines found in the running config under every context of the same
+        # kind, 'logging event' under an interface does not take 'logging host'
+        kind = parent.split()[0]
+        keywords = set()
+        nodes = [tree]
+        while nodes:
+            for line, children in nodes.pop().items():
+                if children and line.split()[0] == kind:
+                    keywords.update(keyword(child, self.profile["negation"]) for child in children)
+                nodes.append(children)
+        return keywords
+
+
+    def intended_paths(self, commands: list, tree: dict) -> list:
+        # Each command becomes the tuple of its context lines plus the command. Indented commands
+        # use their indentation, flat ones (as sent to send_config_set) their context commands and
+        # explicit exits. A flat line that follows a context without being known there, or at the top
+        # of the running config, is recorded as ambiguous instead of being placed by a guess
+        paths = []
+        self.ambiguous = []
+        if self.profile["style"] == "set":
+            return [(normalize(command),) for command in commands if self.relevant(command)]
+        if any(command[:1].isspace() for command in commands if command.strip()):
+            stack = []
+            for command in commands:
+                if not self.relevant(command):
+                    continue
+                line = self.expand(normalize(command), tree)
+                indent = len(command) - len(command.lstrip())
+                while stack and stack[-1][0] >= indent:
+                    stack.pop()
+                path = tuple(line for _, line in stack) + (line,)
+                paths.append(path)
+                stack.append((indent, line))
+            return paths
+        context = ()
+        known = {}
+        for command in commands:
+            line = self.expand(normalize(command), tree)
+            if line == "end":
+                context = ()
+                continue
+            if line in (self.profile["exit"], "exit-address-family"):
+                context = context[:-1]
+                continue
+            if not self.relevant(command):
+                continue
+            if line.startswith(self.profile["contexts"]) or line in tree:
+                # A context command, or a command found at the top of the running config
+                context = ()
+            elif len(context) > 1 and line.startswith(self.profile["nested"]):
+                context = context[:1]
+            elif context and not line.startswith(self.profile["nested"]):
+                parent = context[-1]
+                if parent not in known:
+                    known[parent] = self.child_keywords(tree, parent)
+                if keyword(line, self.profile["negation"]) not in known[parent]:
+                    self.ambiguous.append(line)
+            paths.append(context + (line,))
+            if line.startswith(self.profile["contexts"]) or (context and line.startswith(self.profile["nested"])):
+                context = context + (line,)
+        return paths
+
+
+    def present(self, path: tuple, tree: dict) -> bool:
+        node = tree
+        for parent in path[:-1]:
+            node = node.get(parent)
+            if node is None:
+                return False
+        line = path[-1]
+        negation = self.profile["negation"]
+        if line.startswith(negation):
+            # 'no shutdown' is met when no 'shutdown' line exists in the same context
+            removed = line[len(negation):]
+            if self.profile["style"] == "set":
+                removed = self.profile["statement"] + removed
+            return not any(existing == removed or existing.startswith(removed + " ") for existing in node)
+        return line in node
+
+
+    def missing(self, commands: list, running: str) -> list:
+        # With ambiguous flat lines every command is returned, a full push places them as the device does
+        tree = self.running_tree(running)
+        paths = self.intended_paths(commands, tree)
+        if self.ambiguous:
+            return list(commands)
+        if self.profile["style"] == "set":
+            return [path[-1] for path in paths if not self.present(path, tree)]
+        contexts = {path[:-1] for path in paths}
+        delta = []
+        current = ()
+        for path in paths:
+            if self.present(path, tree):
+                continue
+            parents = path[:-1]
+            if current != parents:
+                # Leave the contexts not shared with the command, then enter the missing ones
+                common = 0
+                while common < min(len(current), len(parents)) and current[common] == parents[common]:
+                    common += 1
+                delta.extend([self.profile["exit"]] * (len(current) - common))
+                delta.extend(parents[common:])
+            delta.append(path[-1])
+            current = path if path in contexts else parents
+        return delta
@@ -15,3 +15,21 @@ class DeviceType(Enum):
     vyatta_vyos = "vyatta_vyos"
     extreme_exos = "extreme_exos"
     extreme = "extreme"
+
+
+class Engine(Enum):
+    netmiko = "netmiko"
+    native = "async"
+
+
+class ParseMode(Enum):
+    inline = "inline"
+    process = "process"
+    deferred = "deferred"
+
+
+class LogLevel(Enum):
+    debug = "DEBUG"
+    info = "INFO"
+    warning = "WARNING"
+    error = "ERROR"
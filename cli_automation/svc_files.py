@@ -6,6 +6,7 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
 
 import aiofiles
+import json
 
 class ManageFiles():
     def __init__(self, logger):
@@ -15,7 +16,7 @@ class ManageFiles():
         try:
             async with aiofiles.open(file_name, "w") as file:
                 await file.write(content)
-            self.logger.debug(f"File {file_name} created")
+            self.logger.debug("File %s created", file_name)
         except Exception as error:
             self.logger.error(f"File {file_name} not created, error {error}")
             print (f"\n** File {file_name} not created, error: {error}")
@@ -25,10 +26,29 @@ class ManageFiles():
         try:
             async with aiofiles.open(file_name, "r") as file:
                 content = await file.read()
-            self.logger.debug(f"File {file_name} read")
+            self.logger.debug("File %s read", file_name)
             return content
         except Exception as error:
             self.logger.error(f"File {file_name} not read, error {error}")
             print (f"\n** File {file_name} not read, error: {error}")
             return None
-            
\ No newline at end of file
+
+
+class StreamOutput():
+    def __init__(self, output, logger):
+        self.output = output
+        self.logger = logger
+        self.count = 0
+
+    def write(self, device: str, result: any, timing: dict = None) -> None:
+        line = {"Device": device, "Output": result}
+        if timing is not None:
+            line["Timing"] = timing
+        self.output.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.output.flush()
+        self.count += 1
+        self.logger.debug("Result for device %s streamed to %s", device, self.output.name)
+
+    async def collect(self, device: str, job, timer=None) -> None:
+        result = await job
+        self.write(device, result, timer.result() if timer else None)
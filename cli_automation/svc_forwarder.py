@@ -0,0 +1,243 @@
+# SOCKS5 Forwarder Service Classes
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import json
+import logging
+import random
+import signal
+import subprocess
+import time
+from pathlib import Path
+from cli_automation import config_data
+from .svc_agent import AgentClient, STREAM_LIMIT
+from .svc_tunnel import TunnelHealth, configured_tunnels
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+class TunnelForwarder():
+    # One dynamic forward, as 'ssh -N -D', on an asyncssh connection to the bastion. When the
+    # connection drops, the local port is closed and the connection is opened again after a
+    # backoff growing from tunnel_reconnect_min to tunnel_reconnect_max seconds
+    def __init__(self, tunnel: dict, health: TunnelHealth, logger):
+        self.tunnel = tunnel
+        self.health = health
+        self.logger = logger
+        self.bastion_host = tunnel["bastion_host"]
+        self.bastion_user = tunnel.get("bastion_user")
+        self.local_port = tunnel["local_port"]
+        self.listen_host = config_data.get("proxy_host")
+        self.connect_timeout = config_data.get("tunnel_timeout")
+        self.keepalive = config_data.get("tunnel_keepalive")
+        self.backoff_min = config_data.get("tunnel_reconnect_min")
+        self.backoff_max = config_data.get("tunnel_reconnect_max")
+        self.state = "connecting"
+        self.since = time.time()
+        self.connects = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.backoff = self.backoff_min
+
+
+    def set_state(self, state: str, error: str = None) -> None:
+        self.state = state
+        self.since = time.time()
+        if error:
+            self.last_error = error
+        # The cla commands take the tunnel health from here instead of testing the bastion
+        self.health.record(self.tunnel, state == "up")
+        self.health.save()
+
+
+    async def forward(self) -> None:
+        options = {"username": self.bastion_user, "connect_timeout": self.connect_timeout, "keepalive_interval": self.keepalive, "keepalive_count_max": 3}
+        async with asyncssh.connect(self.bastion_host, **options) as connection:
+            listener = await connection.forward_socks(self.listen_host, self.local_port)
+            self.connects += 1
+            self.backoff = self.backoff_min
+            self.set_state("up")
+            self.logger.info(f"Tunnel to the Bastion Host {self.bastion_host} up, local-port {self.local_port}")
+            refresh = asyncio.create_task(self.refresh_health())
+            try:
+                await connection.wait_closed()
+            finally:
+                refresh.cancel()
+                listener.close()
+
+
+    async def refresh_health(self) -> None:
+        # Keeps the tunnel state fresh while the connection is up, keepalives detect a dead bastion
+        while True:
+            await asyncio.sleep(max(1, (config_data.get("tunnel_state_ttl") or 60) / 2))
+            self.health.record(self.tunnel, True)
+            self.health.save()
+
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.forward()
+                error = "connection to the bastion closed"
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.TimeoutError, asyncssh.Error) as error_detail:
+                error = str(error_detail) or type(error_detail).__name__
+            self.reconnects += 1
+            self.set_state("down", error)
+            delay = self.backoff * random.uniform(0.8, 1.2)
+            self.logger.error(f"Tunnel to the Bastion Host {self.bastion_host}, local-port {self.local_port} down: {error}. Reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+            self.set_state("connecting")
+
+
+    def stats(self) -> dict:
+        return {
+            "bastion_host": self.bastion_host,
+            "bastion_user": self.bastion_user,
+            "local_port": self.local_port,
+            "state": self.state,
+            "since": round(time.time() - self.since),
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+        }
+
+
+class TunnelDaemon():
+    # Long-lived process running the forwarders of the tunnels in config.json, with a PID file
+    # and a Unix control socket answering 'status' and 'stop'
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.socket_path = config_data.get("tunnel_socket")
+        self.pid_file = Path(config_data.get("tunnel_pid_file"))
+        self.health = TunnelHealth(inst_dict=inst_dict)
+        self.forwarders = [TunnelForwarder(tunnel, self.health, self.logger) for tunnel in configured_tunnels(config_data)]
+        self.started = time.time()
+        self.stop_event = asyncio.Event()
+        if asyncssh is None:
+            self.logger.error(f"The tunnel daemon requires the asyncssh package")
+            print (f"** The tunnel daemon requires the asyncssh package, install it with 'pip install asyncssh'")
+            sys.exit(1)
+
+
+    def status(self) -> dict:
+        return {"pid": os.getpid(), "uptime": round(time.time() - self.started), "tunnels": [forwarder.stats() for forwarder in self.forwarders]}
+
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            if request.get("action") == "status":
+                response = {"output": self.status()}
+            elif request.get("action") == "stop":
+                self.stop_event.set()
+                response = {"output": "cla tunnel daemon stopping"}
+            else:
+                response = {"error": f"unknown action {request.get('action')}"}
+        except Exception as error:
+            self.logger.error(f"cla tunnel daemon request error: {error}")
+            response = {"error": str(error)}
+        try:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+    async def serve(self) -> None:
+        if not self.forwarders:
+            self.logger.error(f"cla tunnel daemon not started, no tunnel is configured")
+            print (f"** No tunnel is configured, set them up with 'cla tunnel setup --daemon'")
+            return
+        path = Path(self.socket_path)
+        if path.exists():
+            path.unlink()
+        # The socket is created owner-only, other users never get a window to connect before the chmod
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path, limit=STREAM_LIMIT)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        self.pid_file.write_text(str(os.getpid()))
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop_event.set)
+        tasks = [asyncio.create_task(forwarder.run()) for forwarder in self.forwarders]
+        self.logger.info(f"cla tunnel daemon listening on {self.socket_path}, PID {os.getpid()}, tunnels at local-ports {[forwarder.local_port for forwarder in self.forwarders]}")
+        if self.verbose in [1,2]:
+            print (f"-> cla tunnel daemon listening on {self.socket_path}, PID {os.getpid()}")
+        try:
+            async with server:
+                await self.stop_event.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.health.forget([forwarder.tunnel for forwarder in self.forwarders])
+            self.health.save()
+            for file in (path, self.pid_file):
+                if file.exists():
+                    file.unlink()
+            self.logger.info(f"cla tunnel daemon stopped")
+
+
+class TunnelDaemonClient(AgentClient):
+    def __init__(self, inst_dict: dict):
+        super().__init__(inst_dict)
+        self.socket_path = config_data.get("tunnel_socket")
+        self.pid_file = Path(config_data.get("tunnel_pid_file"))
+
+
+    async def start(self, timeout: float) -> bool:
+        if self.is_running():
+            return True
+        # The daemon logs at the level of the command that starts it
+        command = [sys.executable, "-m", "cli_automation", "--log-level", logging.getLevelName(self.logger.getEffectiveLevel()), "tunnel", "run"]
+        self.logger.info(f"Starting the cla tunnel daemon, socket {self.socket_path}")
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            if self.is_running():
+                return True
+        return False
+
+
+    async def wait_up(self, timeout: float) -> list:
+        # The tunnels once they are all up, or as they are when the timeout expires
+        deadline = time.monotonic() + timeout
+        while True:
+            tunnels = (await self.request({"action": "status"})).get("output", {}).get("tunnels", [])
+            if all(tunnel["state"] == "up" for tunnel in tunnels) or time.monotonic() >= deadline:
+                return tunnels
+            await asyncio.sleep(0.2)
+
+
+    async def stop(self, timeout: float = 10) -> bool:
+        # Through the control socket, with SIGTERM to the PID of the PID file as the fallback
+        if self.is_running():
+            await self.request({"action": "stop"})
+        elif self.pid_file.exists():
+            try:
+                os.kill(int(self.pid_file.read_text()), signal.SIGTERM)
+            except (OSError, ValueError) as error:
+                self.logger.error(f"cla tunnel daemon PID file {self.pid_file} is stale: {error}")
+                self.pid_file.unlink()
+                return False
+        else:
+            return False
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and (self.pid_file.exists() or Path(self.socket_path).exists()):
+            await asyncio.sleep(0.1)
+        return True
@@ -0,0 +1,176 @@
+# Streaming Inventory Service Classes
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import json
+from pydantic import ValidationError
+from .svc_model import Device
+
+CHUNK_SIZE = 65536
+
+
+def device_key(device: dict) -> str:
+    # What sets a device apart in the local state files. Devices behind one address (NAT, console
+    # servers) differ by port, and the outputs and latencies of a device by the privilege of its user
+    return f"{device.get('host')}|{device.get('port')}|{device.get('username')}|{device.get('device_type')}"
+
+
+async def iterate(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class JsonStream():
+    def __init__(self, file, chunk_size: int = CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+
+    def read_more(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ""
+
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"expecting '{char}' but found '{found or 'end of file'}'")
+        self.pos += 1
+
+
+    def value(self) -> any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer could continue in the next chunk
+                if end == len(self.buffer) and self.read_more():
+                    continue
+                self.pos = end
+                return value
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+
+
+    def items(self, key: str):
+        # Yields the elements of the top level array 'key' one at a time, other keys are skipped
+        found = False
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+        else:
+            while True:
+                name = self.value()
+                self.expect(":")
+                if name == key and self.peek() == "[":
+                    found = True
+                    self.expect("[")
+                    if self.peek() == "]":
+                        self.pos += 1
+                    else:
+                        while True:
+                            yield self.value()
+                            if self.peek() == ",":
+                                self.pos += 1
+                                continue
+                            self.expect("]")
+                            break
+                else:
+                    self.value()
+                if self.peek() == ",":
+                    self.pos += 1
+                    continue
+                self.expect("}")
+                break
+        if not found:
+            raise KeyError(key)
+
+
+class InventoryReader():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.index = 0
+        self.valid = 0
+        self.invalid = 0
+        self.error = None
+
+
+    def skip(self, index: int, host: str, reason: str) -> None:
+        self.invalid += 1
+        self.logger.error(f"Inventory entry #{index} (host '{host}') skipped: {reason}")
+        print (f"\n** Inventory entry #{index} (host '{host}') skipped: {reason}")
+
+
+    async def devices(self, file):
+        # Devices are parsed and validated one at a time, each one is yielded as soon as it is valid
+        try:
+            for device in JsonStream(file).items("devices"):
+                self.index += 1
+                host = device.get("host") if isinstance(device, dict) else None
+                try:
+                    if not isinstance(device, dict):
+                        raise ValueError("device entry is not a JSON object")
+                    Device(**device)
+                except ValidationError as error:
+                    self.skip(self.index, host, "; ".join(f"{'.'.join(str(loc) for loc in item['loc'])}: {item['msg']}" for item in error.errors()))
+                    continue
+                except ValueError as error:
+                    self.skip(self.index, host, str(error))
+                    continue
+                self.valid += 1
+                if self.verbose == 2:
+                    print (f"--> device: {json.dumps(device)}")
+                yield device
+                await asyncio.sleep(0)
+        except KeyError:
+            self.error = f"'devices' key not found in '{file.name}' or reading an incorrect json file"
+        except ValueError as error:
+            self.error = f"Error reading the json file '{file.name}' after {self.index} devices, check the syntax: {error}"
+        if self.error:
+            self.logger.error(self.error)
+            print (f"\n** {self.error}")
+        self.logger.info(f"Inventory '{file.name}' read, valid devices: {self.valid}, invalid devices: {self.invalid}")
+
+
+    async def device_commands(self, file, commands: list = None, commands_data: dict = None, commands_name: str = None):
+        async for device in self.devices(file):
+            if commands is None:
+                host_commands = commands_data.get(device.get("host")) if isinstance(commands_data, dict) else None
+                if not isinstance(host_commands, dict) or "commands" not in host_commands:
+                    self.skip(self.index, device.get("host"), f"'commands' not found for the host in '{commands_name}'")
+                    self.valid -= 1
+                    continue
+                yield {"device": device, "commands": host_commands.get("commands")}
+            else:
+                yield {"device": device, "commands": commands}
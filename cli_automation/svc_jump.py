@@ -0,0 +1,193 @@
+# Jump Host Service Classes
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import threading
+import paramiko
+from functools import lru_cache
+from cli_automation import config_data
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+@lru_cache(maxsize=32)
+def load_ssh_config(path: str, mtime: float) -> paramiko.SSHConfig:
+    return paramiko.SSHConfig.from_path(path)
+
+
+def parse_hop(hop: str) -> dict:
+    # 'user@host:port' as ProxyJump writes it, the missing parts come from the ssh config file
+    user, _, address = hop.strip().rpartition("@")
+    host, _, port = address.partition(":")
+    return {"user": user or None, "host": host, "port": int(port) if port else None}
+
+
+def jump_route(device: dict) -> dict | None:
+    # The jump host of a device with an ssh config file. None when it has no ProxyJump, or when
+    # it goes through a ProxyCommand or several hops, those are left to the SSH client
+    if not config_data.get("jump_multiplex") or not device.get('ssh_config_file'):
+        return None
+    path = os.path.abspath(os.path.expanduser(device.get('ssh_config_file')))
+    if not os.path.exists(path):
+        return None
+    config = load_ssh_config(path, os.path.getmtime(path))
+    source = config.lookup(device['host'])
+    jump = source.get("proxyjump")
+    if "proxycommand" in source or not jump or jump.lower() == "none" or "," in jump:
+        return None
+    hop = parse_hop(jump)
+    jump_source = config.lookup(hop["host"])
+    # As netmiko does, a port set for the device wins over the one of the ssh config file
+    port = device.get('port') if device.get('port') not in (None, 22) else int(source.get("port", 22))
+    return {
+        "config": path,
+        "jump": jump,
+        "jump_alias": hop["host"],
+        "jump_host": jump_source.get("hostname", hop["host"]),
+        "jump_port": hop["port"] or int(jump_source.get("port", 22)),
+        "jump_user": hop["user"] or jump_source.get("user"),
+        "jump_keys": [os.path.expanduser(key) for key in jump_source.get("identityfile", [])] or None,
+        "jump_strict": str(jump_source.get("stricthostkeychecking", "yes")).lower() != "no",
+        "explicit_user": hop["user"],
+        "explicit_port": hop["port"],
+        "host": source.get("hostname", device['host']),
+        "port": port,
+        "user": source.get("user"),
+    }
+
+
+def jump_key(route: dict) -> str:
+    return f"{route['jump_user']}@{route['jump_host']}:{route['jump_port']}"
+
+
+class JumpHosts():
+    # One authenticated transport per jump host, shared by the devices behind it. Each device
+    # gets a direct-tcpip channel over it, instead of an 'ssh -W' process authenticating to the
+    # jump host once per device
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.timeout = config_data.get("jump_timeout")
+        self.keepalive = config_data.get("jump_keepalive")
+        self.clients = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.authentications = 0
+        self.channels = 0
+
+
+    def key_lock(self, key: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+
+    def transport(self, route: dict) -> paramiko.Transport:
+        key = jump_key(route)
+        with self.key_lock(key):
+            client = self.clients.get(key)
+            if client is not None and client.get_transport() is not None and client.get_transport().is_active():
+                return client.get_transport()
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.RejectPolicy() if route["jump_strict"] else paramiko.AutoAddPolicy())
+            client.connect(route["jump_host"], port=route["jump_port"], username=route["jump_user"], key_filename=route["jump_keys"], timeout=self.timeout, banner_timeout=self.timeout, auth_timeout=self.timeout)
+            client.get_transport().set_keepalive(self.keepalive)
+            self.clients[key] = client
+            with self.lock:
+                self.authentications += 1
+            self.logger.info(f"Jump host {key} authenticated, shared by the devices behind it")
+            return client.get_transport()
+
+
+    def open_channel(self, route: dict) -> paramiko.Channel:
+        for attempt in (1, 2):
+            transport = self.transport(route)
+            try:
+                channel = transport.open_channel("direct-tcpip", (route["host"], route["port"]), ("127.0.0.1", 0), timeout=self.timeout)
+            except paramiko.ChannelException:
+                # The jump host could not reach the device
+                raise
+            except (paramiko.SSHException, EOFError, OSError) as error:
+                if attempt == 2:
+                    raise
+                self.logger.debug("Jump host %s transport lost, authenticating again: %s", jump_key(route), error)
+                self.drop(route, transport)
+                continue
+            with self.lock:
+                self.channels += 1
+            return channel
+
+
+    def drop(self, route: dict, transport: paramiko.Transport) -> None:
+        # Only the transport that failed is closed, another device may have authenticated again already
+        key = jump_key(route)
+        with self.key_lock(key):
+            client = self.clients.get(key)
+            if client is not None and client.get_transport() is transport:
+                del self.clients[key]
+                client.close()
+
+
+    def close_all(self) -> None:
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+
+
+    def stats(self) -> dict:
+        return {"jump_hosts": len(self.locks), "authentications": self.authentications, "channels": self.channels}
+
+
+class AsyncJumpHosts():
+    # The same for the async engine, one asyncssh connection per jump host used as the
+    # tunnel of the connections to the devices behind it
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.timeout = config_data.get("jump_timeout")
+        self.keepalive = config_data.get("jump_keepalive")
+        self.connections = {}
+        self.locks = {}
+        self.authentications = 0
+        self.channels = 0
+
+
+    async def connection(self, route: dict) -> "asyncssh.SSHClientConnection":
+        key = jump_key(route)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            connection = self.connections.get(key)
+            if connection is None or connection.is_closed():
+                # The alias is looked up in the ssh config file for its hostname, user and keys
+                options = {"config": [route["config"]], "connect_timeout": self.timeout, "keepalive_interval": self.keepalive}
+                if route["explicit_user"]:
+                    options["username"] = route["explicit_user"]
+                if route["explicit_port"]:
+                    options["port"] = route["explicit_port"]
+                if not route["jump_strict"] or not config_data.get("async_host_key_check"):
+                    # Only with StrictHostKeyChecking no in the ssh config file, or async_host_key_check false
+                    options["known_hosts"] = None
+                connection = await asyncssh.connect(route["jump_alias"], **options)
+                self.connections[key] = connection
+                self.authentications += 1
+                self.logger.info(f"Jump host {key} authenticated, shared by the devices behind it")
+            self.channels += 1
+            return connection
+
+
+    async def close_all(self) -> None:
+        for connection in self.connections.values():
+            connection.close()
+            await connection.wait_closed()
+        self.connections.clear()
+
+
+    def stats(self) -> dict:
+        return {"jump_hosts": len(self.locks), "authentications": self.authentications, "channels": self.channels}
@@ -4,15 +4,34 @@
 from pydantic import BaseModel, Field
 from typing import List
 
+CLA_DEVICE_KEYS = ["site", "via_tunnel"]
+
+DEFAULT_DELAY_FACTOR = .1
+
+
+def connection_params(device: dict) -> dict:
+    params = {key: value for key, value in device.items() if key not in CLA_DEVICE_KEYS}
+    if "global_delay_factor" in params and params["global_delay_factor"] is None:
+        # No --delay and no learned profile for the device
+        params["global_delay_factor"] = DEFAULT_DELAY_FACTOR
+    read_timeout = params.pop("read_timeout", None)
+    if read_timeout is not None:
+        # read_timeout in the hosts file, or learned, applies to every command of the device
+        params["read_timeout_override"] = read_timeout
+    return params
+
 class Device(BaseModel):
     host: str
     username: str
     password: str
     secret: str | None = None
     device_type: str
-    global_delay_factor: float = Field(default=.1)
+    global_delay_factor: float | None = Field(default=.1)
     port: int | None = Field(default=22)
+    read_timeout: float | None = None
     ssh_config_file: str | None = None
+    site: str | None = None
+    via_tunnel: bool | None = None
 
 class ModelSingleSsh(BaseModel):
     device: Device
@@ -30,8 +49,8 @@ class ModelTelnetPush(BaseModel):
     device: List[TelnetPush]
 
 class ModelTelnetPull(BaseModel):
-    devices: List[Device]
-    command: str
+    device: Device
+    commands: List[str]
 
 class MultipleSsh(BaseModel):
     device: Device
@@ -0,0 +1,73 @@
+# Platform Profiles for the async engine
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+# What the async engine needs to drive the CLI of each DeviceType, the same steps netmiko
+# performs in session_preparation(), enable(), config_mode() and exit_config_mode()
+CISCO = {
+    "prompt": r"[>#]",
+    "paging": ["terminal width 511", "terminal length 0"],
+    "unprivileged": ">",
+    "enable": "enable",
+    "config": "configure terminal",
+    "config_exit": "end",
+}
+
+PLATFORMS = {
+    "cisco_ios": CISCO,
+    "cisco_xe": CISCO,
+    "cisco_xr": {**CISCO, "unprivileged": None, "enable": None},
+    "cisco_nxos": {**CISCO, "paging": ["terminal length 0", "terminal width 511"]},
+    "arista_eos": CISCO,
+    "juniper": {
+        "prompt": r"[>#%]",
+        "paging": ["set cli screen-length 0", "set cli screen-width 511"],
+        "unprivileged": None,
+        "enable": None,
+        "config": "configure",
+        "config_exit": "exit configuration-mode",
+    },
+    "huawei": {
+        "prompt": r"[>\]]",
+        "paging": ["screen-length 0 temporary"],
+        "unprivileged": None,
+        "enable": None,
+        "config": "system-view",
+        "config_exit": "return",
+    },
+    "alcatel_sros": {
+        "prompt": r"[#$]",
+        "paging": ["environment no more"],
+        "unprivileged": None,
+        "enable": None,
+        "config": "configure",
+        "config_exit": "exit all",
+    },
+    "vyos": {
+        "prompt": r"[$#]",
+        "paging": ["set terminal length 0", "set terminal width 511"],
+        "unprivileged": None,
+        "enable": None,
+        "config": "configure",
+        "config_exit": "exit",
+    },
+    "extreme_exos": {
+        "prompt": r"[#>]",
+        "paging": ["disable clipaging"],
+        "unprivileged": None,
+        "enable": None,
+        "config": None,
+        "config_exit": None,
+    },
+}
+PLATFORMS["juniper_junos"] = PLATFORMS["juniper"]
+PLATFORMS["huawei_vrp"] = PLATFORMS["huawei"]
+PLATFORMS["vyatta_vyos"] = PLATFORMS["vyos"]
+PLATFORMS["extreme"] = PLATFORMS["extreme_exos"]
+
+
+def platform_profile(device_type: str) -> dict:
+    return PLATFORMS.get(device_type, CISCO)
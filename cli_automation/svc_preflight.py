@@ -0,0 +1,97 @@
+# Pre-flight Reachability Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import socket
+from cli_automation import config_data
+from .svc_proxy import ChannelTimeout, open_connection, tunnel_pool, via_tunnel
+
+
+class PreflightProbe():
+    # Async TCP connect (and optional SSH banner read) to each device before it takes a
+    # worker slot, an unreachable device is reported in preflight_timeout seconds instead
+    # of holding a worker for the whole netmiko connection timeout
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.protocol = inst_dict.get('protocol') or "ssh"
+        self.default_port = 23 if self.protocol == "telnet" else 22
+        self.timeout = config_data.get("preflight_timeout")
+        self.banner = config_data.get("preflight_banner") and self.protocol == "ssh"
+        self.slots = asyncio.Semaphore(config_data.get("preflight_concurrency"))
+        self.tunnel_slots = None
+        self.reachable = 0
+        self.unreachable = 0
+
+
+    def tunnel_probe(self, device: dict, port: int) -> None:
+        # The SOCKS handshake of the tunnel socket is blocking, the probe runs in a thread. It waits
+        # for a tunnel channel no longer than the probe timeout, so no thread outlives its probe
+        with open_connection(device, port, self.timeout, queue_timeout=self.timeout) as sock:
+            if self.banner:
+                sock.settimeout(self.timeout)
+                if not sock.recv(256).startswith(b"SSH-"):
+                    raise ConnectionError("no SSH banner received")
+
+
+    async def direct_probe(self, host: str, port: int) -> None:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        try:
+            if self.banner:
+                banner = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not banner.startswith(b"SSH-"):
+                    raise ConnectionError("no SSH banner received")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+    def slots_for(self, tunneled: bool) -> asyncio.Semaphore:
+        # Tunneled probes are capped to the channels of the tunnel pool, more would only wait for them
+        if not tunneled:
+            return self.slots
+        if self.tunnel_slots is None:
+            capacity = tunnel_pool().capacity()
+            self.tunnel_slots = asyncio.Semaphore(min(capacity, config_data.get("preflight_concurrency")) if capacity else config_data.get("preflight_concurrency"))
+        return self.tunnel_slots
+
+
+    async def check(self, device: dict) -> str | None:
+        # Returns the reason a device is unreachable, None when it answers
+        if device.get('ssh_config_file'):
+            # Proxies and jump hosts of the ssh config file are not probed
+            return None
+        host, port = device['host'], device.get('port') or self.default_port
+        tunneled = via_tunnel(device)
+        async with self.slots_for(tunneled):
+            try:
+                if tunneled:
+                    # Channel wait, connect and banner read, each one bounded by the probe timeout
+                    await asyncio.wait_for(asyncio.to_thread(self.tunnel_probe, device, port), self.timeout * 3)
+                else:
+                    await self.direct_probe(host, port)
+            except ChannelTimeout as error:
+                # The tunnel channels are busy with device sessions, the device itself was not tried
+                self.logger.debug("Pre-flight probe, device %s not probed: %s", host, error)
+                return None
+            except (asyncio.TimeoutError, socket.timeout):
+                reason = f"no answer from {host}:{port} in {self.timeout}s"
+            except OSError as error:
+                reason = f"{host}:{port} {os.strerror(error.errno) if error.errno else error}"
+            else:
+                self.reachable += 1
+                return None
+        self.unreachable += 1
+        self.logger.error(f"Pre-flight probe, device {host} unreachable: {reason}")
+        return reason
+
+
+    def stats(self) -> dict:
+        return {"reachable": self.reachable, "unreachable": self.unreachable}
@@ -0,0 +1,96 @@
+# Learned Delay Profiles Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import json
+import statistics
+import time
+from pathlib import Path
+from cli_automation import config_data
+from .svc_timing import PhaseTimer
+from .svc_inventory import device_key
+
+
+class DelayProfiles():
+    # Command latencies observed per host and device type with --learn. Later runs derive the
+    # global_delay_factor and read_timeout of each device from them, values set in the hosts
+    # file always win
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.learn = inst_dict.get('learn')
+        # Opt-in with --profile. The async engine reads until the prompt, a delay factor does not apply to it
+        self.use = inst_dict.get('profile') and inst_dict.get('engine') != "async"
+        self.profile_file = Path(config_data.get("profile_file"))
+        self.samples = config_data.get("profile_samples")
+        self.delay_reference = config_data.get("profile_delay_reference")
+        self.timeout_factor = config_data.get("profile_timeout_factor")
+        self.min_read_timeout = config_data.get("profile_min_read_timeout")
+        self.max_read_timeout = config_data.get("profile_max_read_timeout")
+        self.profiles = {}
+        self.applied = 0
+        self.learned = 0
+        self.load()
+
+
+    def load(self) -> None:
+        try:
+            self.profiles = json.loads(self.profile_file.read_text())
+            self.logger.debug("Delay profiles loaded from %s, %s hosts", self.profile_file, len(self.profiles))
+        except FileNotFoundError:
+            self.profiles = {}
+        except (OSError, ValueError) as error:
+            self.logger.error(f"Delay profiles {self.profile_file} not loaded, starting empty: {error}")
+            self.profiles = {}
+
+
+    def save(self) -> None:
+        temp_file = self.profile_file.with_suffix(".tmp")
+        try:
+            temp_file.write_text(json.dumps(self.profiles, indent=2))
+            os.replace(temp_file, self.profile_file)
+            self.logger.debug("Delay profiles saved to %s, %s hosts", self.profile_file, len(self.profiles))
+        except OSError as error:
+            self.logger.error(f"Delay profiles {self.profile_file} not saved: {error}")
+
+
+    def key(self, device: dict) -> str:
+        return device_key(device)
+
+
+    def derive(self, profile: dict) -> dict:
+        # The typical latency sets the delay factor, the slowest one the read timeout
+        latencies = profile["latencies"]
+        delay_factor = min(4.0, max(0.1, statistics.median(latencies) / self.delay_reference))
+        read_timeout = min(self.max_read_timeout, max(self.min_read_timeout, max(latencies) * self.timeout_factor))
+        return {"global_delay_factor": round(delay_factor, 2), "read_timeout": round(read_timeout, 1)}
+
+
+    def apply(self, device: dict) -> None:
+        if not self.use:
+            return
+        profile = self.profiles.get(self.key(device))
+        if not profile:
+            return
+        values = self.derive(profile)
+        for name, value in values.items():
+            if device.get(name) is None:
+                device[name] = value
+        self.applied += 1
+        self.logger.debug("Delay profile applied to device %s: %s", device.get('host'), values)
+
+
+    def record(self, device: dict, timer: PhaseTimer) -> None:
+        if not self.learn or not timer.commands:
+            return
+        profile = self.profiles.setdefault(self.key(device), {"latencies": []})
+        profile["latencies"] = (profile["latencies"] + [round(seconds, 4) for seconds in timer.commands.values()])[-self.samples:]
+        profile["updated"] = round(time.time())
+        self.learned += 1
+
+
+    def stats(self) -> dict:
+        return {"hosts": len(self.profiles), "applied": self.applied, "learned": self.learned}
@@ -7,8 +7,242 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', ".
 
 import socks
 import socket
+import threading
+import time
+import hashlib
+import ipaddress
+from functools import lru_cache
 from cli_automation import config_data
-from .svc_tunnel import SetSocks5Tunnel
+from .svc_tunnel import SetSocks5Tunnel, TunnelHealth, configured_tunnels
+from .svc_timing import PhaseTimer, TimingSummary
+
+
+class ChannelTimeout(socket.timeout):
+    # No channel of the tunnel was free in time, the device itself was not tried
+    pass
+
+
+class TunnelChannels():
+    # Every connection through a tunnel is a channel of its bastion SSH session. At most
+    # tunnel_max_channels are open at once, the next connections wait for a free one instead
+    # of being refused by the bastion MaxSessions/MaxStartups limits
+    def __init__(self, max_channels: int | None, queue_timeout: float, tunnel: dict = None):
+        self.max_channels = max_channels
+        self.queue_timeout = queue_timeout
+        self.bastion_host = (tunnel or {}).get("bastion_host")
+        self.local_port = (tunnel or {}).get("local_port")
+        self.healthy = True
+        self.slots = threading.BoundedSemaphore(max_channels) if max_channels else None
+        self.lock = threading.Lock()
+        self.timings = TimingSummary()
+        self.active = 0
+        self.waiting = 0
+        self.peak_active = 0
+        self.opened = 0
+        self.queued = 0
+        self.failed = 0
+
+
+    def acquire(self, timeout: float = None) -> float:
+        # timeout, a shorter wait than tunnel_queue_timeout for the connections that can not wait that long
+        start = time.perf_counter()
+        queue_timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        if self.slots and not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.queued += 1
+                self.waiting += 1
+            try:
+                if not self.slots.acquire(timeout=queue_timeout):
+                    with self.lock:
+                        self.failed += 1
+                    raise ChannelTimeout(f"no tunnel channel free in {queue_timeout}s, {self.max_channels} channels in use at local-port {self.local_port}")
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+        with self.lock:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        return time.perf_counter() - start
+
+
+    def release(self) -> None:
+        with self.lock:
+            self.active -= 1
+        if self.slots:
+            self.slots.release()
+
+
+    def load(self) -> float:
+        # Channels in use or waiting, relative to the channels of the tunnel
+        return (self.active + self.waiting) / (self.max_channels or 1)
+
+
+    def record(self, wait: float, connect: float | None) -> None:
+        timer = PhaseTimer()
+        timer.add("queue", wait)
+        if connect is None:
+            with self.lock:
+                self.failed += 1
+        else:
+            timer.add("connect", connect)
+        with self.lock:
+            if connect is not None:
+                self.opened += 1
+            self.timings.add(timer)
+
+
+    def stats(self) -> dict:
+        return {"local_port": self.local_port, "bastion_host": self.bastion_host, "healthy": self.healthy, "max_channels": self.max_channels, "opened": self.opened, "queued": self.queued, "failed": self.failed, "peak_active": self.peak_active}
+
+
+class TunnelPool():
+    # The healthy tunnels, each with its own channels. A connection goes to the least loaded
+    # tunnel or, with tunnel_balance 'hash', to the tunnel its host:port hashes to (rendezvous
+    # hashing, a device keeps its tunnel while the pool does not change). A tunnel whose
+    # local SOCKS port refuses a connection is dropped from the pool
+    def __init__(self, tunnels: list, logger, verbose, health: TunnelHealth = None):
+        self.logger = logger
+        self.verbose = verbose
+        self.health = health
+        self.proxy_host = config_data.get("proxy_host")
+        self.balance = config_data.get("tunnel_balance")
+        self.tunnels = [TunnelChannels(config_data.get("tunnel_max_channels"), config_data.get("tunnel_queue_timeout"), tunnel) for tunnel in tunnels]
+        self.lock = threading.Lock()
+
+
+    def healthy(self) -> list:
+        return [tunnel for tunnel in self.tunnels if tunnel.healthy]
+
+
+    def capacity(self) -> int | None:
+        # Channels of the healthy tunnels, None when they are not limited
+        limits = [tunnel.max_channels for tunnel in self.healthy()]
+        return sum(limits) if limits and all(limits) else None
+
+
+    def select(self, destination: str) -> TunnelChannels:
+        with self.lock:
+            healthy = self.healthy()
+            if not healthy:
+                raise socks.ProxyConnectionError(f"no healthy tunnel left in the pool of {len(self.tunnels)} tunnels")
+            if self.balance == "hash":
+                return max(healthy, key=lambda tunnel: hashlib.md5(f"{destination}|{tunnel.bastion_host}|{tunnel.local_port}".encode()).digest())
+            return min(healthy, key=lambda tunnel: (tunnel.load(), tunnel.opened))
+
+
+    def drop(self, tunnel: TunnelChannels, error: Exception) -> None:
+        with self.lock:
+            if not tunnel.healthy:
+                return
+            tunnel.healthy = False
+            left = len(self.healthy())
+        self.logger.error(f"Tunnel at local-port {tunnel.local_port} to {tunnel.bastion_host} dropped from the pool, {left} tunnels left: {error}")
+        if self.health:
+            # The next runs test it again instead of trusting its last healthy check
+            self.health.record({"bastion_host": tunnel.bastion_host, "local_port": tunnel.local_port}, False)
+            self.health.save()
+        if self.verbose in [1,2]:
+            print (f"** Tunnel at local-port {tunnel.local_port} to {tunnel.bastion_host} dropped from the pool, {left} tunnels left")
+
+
+    def timings(self) -> TimingSummary:
+        summary = TimingSummary()
+        for tunnel in self.tunnels:
+            for name, samples in tunnel.timings.samples.items():
+                summary.samples.setdefault(name, []).extend(samples)
+        return summary
+
+
+    def stats(self) -> dict:
+        totals = {"tunnels": len(self.tunnels), "healthy": len(self.healthy()), "balance": self.balance}
+        for name in ("opened", "queued", "failed"):
+            totals[name] = sum(getattr(tunnel, name) for tunnel in self.tunnels)
+        return totals
+
+
+class TunnelSocket(socks.socksocket):
+    # The socket of a tunneled device. Each connection picks its tunnel from the pool and
+    # holds one of its channels from connect() to close()
+    pool = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channel = None
+        self.queue_timeout = None
+
+
+    def connect(self, dest_pair, *args, **kwargs):
+        pool = TunnelSocket.pool
+        if pool is None or self.channel is not None:
+            return super().connect(dest_pair, *args, **kwargs)
+        tunnel = pool.select(f"{dest_pair[0]}:{dest_pair[1]}")
+        self.set_proxy(socks.SOCKS5, pool.proxy_host, tunnel.local_port)
+        wait = tunnel.acquire(self.queue_timeout)
+        start = time.perf_counter()
+        try:
+            super().connect(dest_pair, *args, **kwargs)
+        except socks.ProxyConnectionError as error:
+            # The tunnel itself failed, not the device, the next connections use the other tunnels
+            tunnel.release()
+            tunnel.record(wait, None)
+            pool.drop(tunnel, error)
+            raise
+        except BaseException:
+            tunnel.release()
+            tunnel.record(wait, None)
+            raise
+        self.channel = tunnel
+        tunnel.record(wait, time.perf_counter() - start)
+
+
+    def close(self):
+        if self.channel is not None:
+            channel, self.channel = self.channel, None
+            channel.release()
+        super().close()
+
+
+def tunnel_pool() -> TunnelPool | None:
+    return TunnelSocket.pool
+
+
+@lru_cache(maxsize=None)
+def tunnel_networks(subnets: tuple) -> tuple:
+    return tuple(ipaddress.ip_network(subnet, strict=False) for subnet in subnets)
+
+
+def via_tunnel(device: dict) -> bool:
+    # Devices go through the tunnel pool while it is in use, unless their hosts file entry
+    # says otherwise with via_tunnel, or tunnel_subnets is set and their address is outside
+    if TunnelSocket.pool is None or device.get('ssh_config_file'):
+        return False
+    if device.get('via_tunnel') is not None:
+        return bool(device.get('via_tunnel'))
+    subnets = config_data.get("tunnel_subnets")
+    if not subnets:
+        return True
+    try:
+        address = ipaddress.ip_address(device['host'])
+    except ValueError:
+        # Names are resolved by the bastion, they stay on the tunnel
+        return True
+    return any(address in network for network in tunnel_networks(tuple(subnets)))
+
+
+def open_connection(device: dict, port: int, timeout: float, queue_timeout: float = None) -> socket.socket:
+    # The socket of a device session, through a tunnel of the pool or straight to the device.
+    # Only this socket is proxied, socket.socket is left as it is for the rest of the process
+    if not via_tunnel(device):
+        return socket.create_connection((device['host'], port), timeout)
+    sock = TunnelSocket()
+    sock.queue_timeout = queue_timeout
+    sock.settimeout(timeout)
+    try:
+        sock.connect((device['host'], port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
 
 
 class TunnelProxy():
@@ -20,14 +254,22 @@ class TunnelProxy():
         
     def set_proxy(self):
         if self.cfg.get("tunnel"):
-            self.logger.debug(f"Setting up the application to use the tunnel at local-port {self.cfg.get('tunnel_local_port')}")
+            try:
+                tunnel_networks(tuple(self.cfg.get("tunnel_subnets") or ()))
+            except ValueError as error:
+                self.logger.error(f"Invalid tunnel_subnets in config.json: {error}")
+                print (f"** Invalid tunnel_subnets in config.json: {error}")
+                sys.exit(1)
+            tunnels = configured_tunnels(self.cfg)
+            self.logger.debug("Setting up the application to use the tunnels at local-ports %s", [tunnel['local_port'] for tunnel in tunnels])
             inst_dict = {'verbose': self.verbose, 'logger': self.logger}
             tunnel = SetSocks5Tunnel(inst_dict=inst_dict)
-            status = tunnel.is_tunnel_active(local_port=self.cfg.get('tunnel_local_port'))
+            # A local connect, it does not go through the bastion
+            status = [tunnel.is_tunnel_active(local_port=entry["local_port"]) for entry in tunnels]
             if self.verbose in [2]:
-                print (f"-> tunnel status: {status}")
-            if status:
-                self.test_proxy(test_port=self.cfg.get("tunnel_port_test"), timeout=self.cfg.get("tunnel_timeout"))
+                print (f"-> tunnel status: {any(status)}, {status.count(True)} of {len(tunnels)} tunnels running")
+            if any(status):
+                self.test_proxy(test_port=self.cfg.get("tunnel_port_test"), timeout=self.cfg.get("tunnel_timeout"), tunnels=[entry for entry, active in zip(tunnels, status) if active])
             else:
                 self.logger.error(f"Application can not use the tunnel, it is not running, check tunnel status with 'cla tunnel status'")
                 if self.verbose in [1,2]:
@@ -37,18 +279,50 @@ class TunnelProxy():
             print (f"-> Tunnel to BastionHost is not configured, if needed please run 'cla tunnel setup'")
             self.logger.debug(f"Tunnel to BastionHost is not configured, if needed please run 'cla tunnel setup'")
 
+
+    def check_tunnels(self, tunnels: list, test_port, timeout, health: TunnelHealth) -> list:
+        tunnel = SetSocks5Tunnel(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        healthy = []
+        for entry in tunnels:
+            result = tunnel.test_proxy(timeout=timeout, test_port=test_port, local_port=entry["local_port"], bastion_host=entry["bastion_host"])
+            health.record(entry, result)
+            if result:
+                healthy.append(entry)
+        health.save()
+        return healthy
+
+
+    def refresh(self, tunnels: list, test_port, timeout, health: TunnelHealth) -> None:
+        # Tests the tunnels served from the state file in the background, the next invocations
+        # find them fresh. The thread does not keep the process alive when the run ends
+        self.logger.debug("Refreshing the tunnel state in the background, local-ports %s", [entry['local_port'] for entry in tunnels])
+        thread = threading.Thread(target=self.check_tunnels, args=(tunnels, test_port, timeout, health), name="cla-tunnel-health", daemon=True)
+        thread.start()
+
     
-    def test_proxy(self, test_port, timeout):
-        self.logger.debug(f"Testing the tunnel at remote-port {test_port}")
-        try:
-            socks.set_default_proxy(socks.SOCKS5, self.cfg.get("proxy_host"), self.cfg.get("tunnel_local_port"))
-            socket.socket = socks.socksocket
-            socket.setdefaulttimeout(timeout)
-            socket.socket().connect((self.cfg.get("bastion_host"), test_port))
-            self.logger.debug(f"Application ready to use the tunnel. Tunnel tested at remote-port {test_port}")
-            if self.verbose in [2]:
-                print (f"-> Application ready to use the tunnel. Tunnel tested at remote-port {test_port}") 
-        except (socks.ProxyConnectionError, socket.error):
-            self.logger.error(f"Application can not use the tunnel, tunnel is not running")
-            print (f"** Application can not use the tunnel, tunnel is not running. Start the tunnel with 'cla tunnel setup'")
-            sys.exit(1)
\ No newline at end of file
+    def test_proxy(self, test_port, timeout, tunnels):
+        # Health check of the running tunnels, the ones that pass make up the pool. Tunnels found
+        # healthy less than tunnel_state_ttl seconds ago are taken from the tunnel state file
+        self.logger.debug("Testing the tunnels at remote-port %s", test_port)
+        if TunnelSocket.pool is None:
+            health = TunnelHealth(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+            cached = [entry for entry in tunnels if health.fresh(entry)]
+            tested = self.check_tunnels([entry for entry in tunnels if entry not in cached], test_port, timeout, health) if len(cached) < len(tunnels) else []
+            healthy = [entry for entry in tunnels if entry in cached or entry in tested]
+            if cached:
+                self.logger.debug("Tunnels healthy in the last %ss, not tested: local-ports %s", health.ttl, [entry['local_port'] for entry in cached])
+                stale = [entry for entry in cached if health.age(entry) > health.ttl / 2]
+                if stale:
+                    self.refresh(stale, test_port, timeout, health)
+            if not healthy:
+                self.logger.error(f"Application can not use the tunnel, tunnel is not running")
+                print (f"** Application can not use the tunnel, tunnel is not running. Start the tunnel with 'cla tunnel setup'")
+                sys.exit(1)
+            TunnelSocket.pool = TunnelPool(healthy, self.logger, self.verbose, health)
+            if len(healthy) < len(configured_tunnels(self.cfg)):
+                self.logger.error(f"Tunnel pool reduced to {len(healthy)} of {len(configured_tunnels(self.cfg))} tunnels, check tunnel status with 'cla tunnel status'")
+                if self.verbose in [1,2]:
+                    print (f"** Tunnel pool reduced to {len(healthy)} of {len(configured_tunnels(self.cfg))} tunnels, check tunnel status with 'cla tunnel status'")
+        self.logger.debug("Application ready to use the tunnel pool, %s tunnels, balance: %s, subnets: %s. Tunnels tested at remote-port %s", len(TunnelSocket.pool.healthy()), TunnelSocket.pool.balance, self.cfg.get('tunnel_subnets') or 'all', test_port)
+        if self.verbose in [2]:
+            print (f"-> Application ready to use the tunnel pool, {len(TunnelSocket.pool.healthy())} tunnels. Tunnels tested at remote-port {test_port}")
@@ -0,0 +1,52 @@
+# Wave Rollout Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+from cli_automation import config_data
+
+
+class WaveRollout():
+    # Pushes go out in waves, a canary batch and then batches growing by wave_growth up to
+    # the ceiling. Before each wave starts, the failure rate of the previous one is checked
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.canary = inst_dict.get('canary') or config_data.get("wave_canary")
+        self.growth = config_data.get("wave_growth")
+        self.ceiling = config_data.get("wave_max") or inst_dict.get('workers') or config_data.get("workers")
+        self.max_failure_rate = inst_dict.get('max_failure_rate')
+        if self.max_failure_rate is None:
+            self.max_failure_rate = config_data.get("wave_failure_rate")
+        self.waves = []
+
+
+    def sizes(self, total: int) -> list:
+        sizes = []
+        size = min(self.canary, self.ceiling)
+        while total > 0:
+            sizes.append(min(size, total))
+            total -= sizes[-1]
+            size = min(max(size + 1, int(size * self.growth)), self.ceiling)
+        return sizes
+
+
+    def gate(self, wave: int, statuses: list) -> str | None:
+        # Returns why the rollout stops after this wave, None when the next wave can start
+        failed = len([status for status in statuses if status == "failed"])
+        rate = failed / len(statuses) if statuses else 0
+        self.waves.append({"wave": wave, "devices": len(statuses), "failed": failed})
+        self.logger.info(f"Rollout wave {wave}: {len(statuses)} devices, {failed} failed, failure rate {rate:.0%}")
+        if self.verbose in [1,2]:
+            print (f"\n-> Rollout wave {wave}: {len(statuses)} devices, {failed} failed")
+        if rate > self.max_failure_rate:
+            reason = f"stopped after wave {wave}, failure rate {rate:.0%} above {self.max_failure_rate:.0%}"
+            self.logger.error(f"Rollout {reason}")
+            return reason
+        return None
+
+
+    def stats(self) -> dict:
+        return {"waves": len(self.waves), "devices": sum(wave["devices"] for wave in self.waves), "failed": sum(wave["failed"] for wave in self.waves)}
@@ -0,0 +1,204 @@
+# Device Scheduler Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import time
+from contextlib import AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
+from cli_automation import config_data
+from .svc_timing import PhaseTimer, TimingSummary
+from .svc_preflight import PreflightProbe
+from .svc_profiles import DelayProfiles
+from .svc_proxy import tunnel_pool, via_tunnel
+
+
+class DeviceScheduler():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.workers = inst_dict.get('workers') or config_data.get("workers")
+        self.type_limits = config_data.get("workers_per_type") or {}
+        self.site_limits = config_data.get("workers_per_site") or {}
+        self.monitor_interval = config_data.get("scheduler_monitor_interval")
+        self.global_slots = asyncio.Semaphore(self.workers)
+        self.backlog = asyncio.Semaphore(max(self.workers, config_data.get("scheduler_backlog")))
+        # Tunneled devices also wait here for a channel of the tunnel pool, not in a worker thread
+        self.tunnel_slots = None
+        self.preflight = PreflightProbe(inst_dict=inst_dict) if inst_dict.get('preflight') else None
+        self.profiles = DelayProfiles(inst_dict=inst_dict)
+        self.monitor_task = None
+        self.pending = set()
+        self.timings = TimingSummary()
+        self.type_slots = {}
+        self.site_slots = {}
+        self.executor = None
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.peak_queued = 0
+        self.peak_in_flight = 0
+
+
+    def install_executor(self) -> None:
+        # asyncio.to_thread and run_in_executor(None, ...) use the loop default executor,
+        # size it to the worker limit instead of the implicit min(32, cpu+4) threads
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cla-worker")
+            asyncio.get_running_loop().set_default_executor(self.executor)
+            self.logger.debug("Scheduler executor ready, workers: %s, per-type limits: %s, per-site limits: %s", self.workers, self.type_limits, self.site_limits)
+
+
+    def get_slot(self, slots: dict, limits: dict, key: str) -> asyncio.Semaphore | None:
+        if key is None or key not in limits:
+            return None
+        if key not in slots:
+            slots[key] = asyncio.Semaphore(int(limits[key]))
+        return slots[key]
+
+
+    def get_tunnel_slot(self) -> asyncio.Semaphore | None:
+        # Sized on the first tunneled device, once the pool kept its healthy tunnels
+        pool = tunnel_pool()
+        if self.tunnel_slots is None and pool and pool.capacity():
+            self.tunnel_slots = asyncio.Semaphore(pool.capacity())
+        return self.tunnel_slots
+
+
+    def device_slots(self, device: dict) -> list:
+        # Specific limits are acquired before the global one, a device waiting for its
+        # device-type or site slot never holds a global worker
+        slots = [
+            self.get_slot(self.type_slots, self.type_limits, device.get('device_type')),
+            self.get_slot(self.site_slots, self.site_limits, device.get('site')),
+            self.get_tunnel_slot() if via_tunnel(device) else None,
+        ]
+        return [slot for slot in slots if slot is not None] + [self.global_slots]
+
+
+    async def run(self, device: dict, func, /, *args, **kwargs):
+        # A PhaseTimer passed to func as 'timer' also gets the preflight, queue and total times,
+        # and is added to the run summary once the device completes
+        timer = kwargs.get('timer') if isinstance(kwargs.get('timer'), PhaseTimer) else None
+        start = time.perf_counter()
+        self.install_executor()
+        self.profiles.apply(device)
+        if self.preflight:
+            reason = await self.preflight.check(device)
+            if timer:
+                timer.add("preflight", time.perf_counter() - start)
+            if reason:
+                self.completed += 1
+                if timer:
+                    timer.add("total", time.perf_counter() - start)
+                    self.timings.add(timer)
+                return f"** Error connecting to {device['host']}, unreachable: {reason}"
+        queue_start = time.perf_counter()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        waiting = True
+        try:
+            async with AsyncExitStack() as stack:
+                for slot in self.device_slots(device):
+                    await stack.enter_async_context(slot)
+                self.queued -= 1
+                waiting = False
+                if timer:
+                    timer.add("queue", time.perf_counter() - queue_start)
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.in_flight -= 1
+                    self.completed += 1
+                    if timer:
+                        timer.add("total", time.perf_counter() - start)
+                        self.timings.add(timer)
+                        self.profiles.record(device, timer)
+        finally:
+            if waiting:
+                self.queued -= 1
+
+
+    async def monitor(self) -> None:
+        while True:
+            await asyncio.sleep(self.monitor_interval)
+            self.logger.debug("Scheduler status: %s", self.stats())
+            if self.verbose in [2]:
+                print (f"\n-> Scheduler queued: {self.queued}, in-flight: {self.in_flight}, completed: {self.completed}")
+
+
+    async def start(self, job) -> asyncio.Task:
+        # Jobs start as soon as they are submitted, the backlog bounds how many are pending
+        # so a large inventory is not turned into tasks faster than devices complete
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.create_task(self.monitor())
+        await self.backlog.acquire()
+        task = asyncio.create_task(job)
+        self.pending.add(task)
+        task.add_done_callback(self.job_done)
+        return task
+
+
+    def job_done(self, task: asyncio.Task) -> None:
+        self.pending.discard(task)
+        self.backlog.release()
+
+
+    async def gather(self, jobs: list) -> list:
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.create_task(self.monitor())
+        try:
+            results = await asyncio.gather(*jobs)
+            # Jobs started without keeping their task, as streamed results, are awaited here
+            while self.pending:
+                await asyncio.wait(list(self.pending))
+            return results
+        finally:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+            self.summary()
+
+
+    def summary(self) -> None:
+        # At the end of a run, and from time to time in the cla agent, which never ends one
+        self.logger.info(f"Scheduler summary: {self.stats()}")
+        if self.profiles.applied:
+            self.logger.info(f"Delay profiles applied to {self.profiles.applied} devices")
+            if self.verbose in [1,2]:
+                print (f"\n-> Delay profiles applied to {self.profiles.applied} devices, from '{self.profiles.profile_file}'")
+        if self.profiles.learned:
+            self.profiles.save()
+            self.logger.info(f"Delay profiles: {self.profiles.stats()}")
+            if self.verbose in [1,2]:
+                print (f"\n-> Delay profiles learned for {self.profiles.learned} devices, saved to '{self.profiles.profile_file}'")
+        pool = tunnel_pool()
+        if pool and any(tunnel.opened + tunnel.failed for tunnel in pool.tunnels):
+            self.logger.info(f"Tunnel summary: {pool.stats()}, tunnels: {[tunnel.stats() for tunnel in pool.tunnels]}, timing (seconds): {pool.timings().report()}")
+            if self.verbose in [1,2]:
+                lines = "\n".join(f"   local-port {tunnel.local_port} ({tunnel.bastion_host}){'' if tunnel.healthy else ' dropped'}, max: {tunnel.max_channels}, opened: {tunnel.opened}, queued: {tunnel.queued}, failed: {tunnel.failed}, peak: {tunnel.peak_active}" for tunnel in pool.tunnels)
+                print (f"\n-> Tunnel pool of {len(pool.tunnels)} tunnels, balance: {pool.balance}\n{lines}\n{pool.timings().table()}")
+        if self.preflight:
+            self.logger.info(f"Pre-flight summary: {self.preflight.stats()}")
+            if self.verbose in [1,2]:
+                print (f"\n-> Pre-flight reachable: {self.preflight.reachable}, unreachable: {self.preflight.unreachable}")
+        report = self.timings.report()
+        if report:
+            self.logger.info(f"Timing summary (seconds): {report}")
+            if self.verbose in [1,2]:
+                print (f"\n-> Timing summary (seconds):\n{self.timings.table()}")
+
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "peak_queued": self.peak_queued,
+            "peak_in_flight": self.peak_in_flight
+        }
@@ -0,0 +1,173 @@
+# SSH Sessions Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import asynccontextmanager
+import paramiko
+from netmiko import ConnectHandler, NetMikoTimeoutException, NetmikoAuthenticationException
+from .svc_jump import JumpHosts, jump_route
+from .svc_model import connection_params
+from .svc_proxy import open_connection
+from .svc_timing import PhaseTimer, phase
+
+
+# The conn_timeout netmiko uses when the device does not set one
+CONN_TIMEOUT = 10
+
+
+class SessionError(Exception):
+    pass
+
+
+class NetmikoSessions():
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.persistent = inst_dict.get('persistent', False)
+        self.pool = {}
+        self.jumps = JumpHosts(inst_dict=inst_dict)
+
+
+    def establish(self, device: dict, timer: PhaseTimer | None) -> ConnectHandler:
+        params = connection_params(device)
+        route = jump_route(device)
+        if route:
+            # The jump host of the ssh config file is reached over its shared transport, the
+            # device gets a channel of it instead of an 'ssh -W' process authenticating again
+            params.update({"ssh_config_file": None, "host": route["host"], "port": route["port"], "username": params.get('username') or route["user"]})
+        sock = None
+        port = params.get('port') or 22
+        if route:
+            with phase(timer, "connect"):
+                try:
+                    sock = self.jumps.open_channel(route)
+                except paramiko.AuthenticationException as error:
+                    raise NetmikoAuthenticationException(f"Authentication to the jump host {route['jump']} failed: {error}")
+                except Exception as error:
+                    raise NetMikoTimeoutException(f"Connection to device through the jump host {route['jump']} failed, {params['host']}:{port}: {error}")
+        elif not params.get('ssh_config_file'):
+            # The TCP socket is opened here to time it apart from the SSH handshake,
+            # with an ssh_config_file netmiko opens it through the configured proxy
+            with phase(timer, "connect"):
+                try:
+                    sock = open_connection(device, port, params.get('conn_timeout') or CONN_TIMEOUT)
+                except OSError as error:
+                    raise NetMikoTimeoutException(f"TCP connection to device failed, {params['host']}:{port}: {error}")
+        with phase(timer, "auth"):
+            try:
+                connection = ConnectHandler(sock=sock, **params)
+            except Exception:
+                if sock is not None:
+                    sock.close()
+                raise
+        return connection
+
+
+    async def open(self, device: dict, timer: PhaseTimer = None) -> ConnectHandler:
+        connection = await asyncio.to_thread(self.establish, device, timer)
+        if connection.is_alive():
+            self.logger.debug("Connection to %s is active", device['host'])
+        else:
+            self.logger.debug("Connection to %s failed", device['host'])
+            await asyncio.to_thread(connection.disconnect)
+            raise SessionError(f"Connection to device {device['host']} failed")
+        with phase(timer, "enable"):
+            await asyncio.to_thread(connection.enable)
+        return connection
+
+
+    async def close(self, connection: ConnectHandler, timer: PhaseTimer = None) -> None:
+        try:
+            with phase(timer, "disconnect"):
+                await asyncio.to_thread(connection.disconnect)
+        except Exception as error:
+            self.logger.debug("Error closing the connection to %s: %s", connection.host, error)
+
+
+    async def call(self, connection: ConnectHandler, method: str, *args) -> any:
+        return await asyncio.to_thread(getattr(connection, method), *args)
+
+
+    def session_key(self, device: dict) -> str:
+        params = json.dumps(connection_params(device), sort_keys=True, default=str)
+        return hashlib.sha256(params.encode()).hexdigest()
+
+
+    @asynccontextmanager
+    async def connection(self, device: dict, timer: PhaseTimer = None):
+        if not self.persistent:
+            connection = await self.open(device, timer)
+            try:
+                yield connection
+            finally:
+                await self.close(connection, timer)
+            return
+
+        key = self.session_key(device)
+        session = self.pool.setdefault(key, {"host": device['host'], "connection": None, "lock": asyncio.Lock(), "last_used": time.monotonic(), "uses": 0})
+        async with session["lock"]:
+            connection = session["connection"]
+            if connection is None or not await asyncio.to_thread(connection.is_alive):
+                if connection is not None:
+                    self.logger.debug("Pooled session to %s is not alive, reconnecting", device['host'])
+                connection = await self.open(device, timer)
+                session["connection"] = connection
+            else:
+                self.logger.debug("Reusing pooled session to %s", device['host'])
+            try:
+                yield connection
+            except BaseException:
+                session["connection"] = None
+                await self.close(connection)
+                raise
+            finally:
+                session["last_used"] = time.monotonic()
+                session["uses"] += 1
+
+
+    async def evict_idle(self, idle_timeout: float) -> int:
+        now = time.monotonic()
+        evicted = 0
+        for key, session in list(self.pool.items()):
+            if session["lock"].locked() or now - session["last_used"] < idle_timeout:
+                continue
+            if session["connection"] is not None:
+                await self.close(session["connection"])
+            del self.pool[key]
+            evicted += 1
+            self.logger.debug("Idle session to %s evicted", session['host'])
+        return evicted
+
+
+    async def close_all(self) -> None:
+        for session in self.pool.values():
+            if session["connection"] is not None:
+                await self.close(session["connection"])
+        self.pool.clear()
+        await asyncio.to_thread(self.jumps.close_all)
+
+
+    async def finish(self) -> None:
+        # End of a run, the jump host transports stay open only in the persistent sessions of the agent
+        stats = self.jumps.stats()
+        if stats["authentications"]:
+            self.logger.info(f"Jump hosts: {stats['jump_hosts']}, authentications: {stats['authentications']}, device channels: {stats['channels']}")
+            if self.verbose in [1,2]:
+                print (f"-> Jump hosts: {stats['jump_hosts']}, authentications: {stats['authentications']}, device channels: {stats['channels']}")
+        if not self.persistent:
+            await asyncio.to_thread(self.jumps.close_all)
+
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [
+            {"host": session["host"], "connected": session["connection"] is not None, "busy": session["lock"].locked(), "uses": session["uses"], "idle": round(now - session["last_used"], 1)}
+            for session in self.pool.values()
+        ]
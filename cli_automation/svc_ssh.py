@@ -9,44 +9,115 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.
 
 import traceback
 import asyncio
-from netmiko import ConnectHandler, NetmikoAuthenticationException, NetMikoTimeoutException
+from netmiko import NetmikoAuthenticationException, NetMikoTimeoutException
 import paramiko
 from paramiko.ssh_exception import SSHException
 from pydantic import ValidationError
-from .svc_model import ModelMultipleSsh, ModelSingleSsh, ModelMultipleInteractive, ModelSingleInteractive
+from .svc_model import MultipleSsh, ModelSingleSsh, MultipleInteractive, ModelSingleInteractive
+from .svc_inventory import iterate
 from typing import List
 import json
 from .svc_proxy import TunnelProxy
+from .svc_scheduler import DeviceScheduler
+from .svc_files import StreamOutput
+from .svc_sessions import NetmikoSessions, SessionError
+from .svc_asyncssh import AsyncsshSessions
+from .svc_agent import AgentClient
+from .svc_textfsm import TextfsmParser, format_output
+from .svc_cache import OutputCache
+from .svc_delta import ConfigDelta
+from .svc_rollout import WaveRollout
+from .svc_classifier import output_classifier
+from .svc_timing import PhaseTimer
+from cli_automation import LogOutput
 import socket
 
+COMPLIANT = "Device already in compliance, nothing pushed"
+NOT_PUSHED = "Not pushed"
+
+
+def running_text(entry: dict, command: str) -> str:
+    # The running config as stored by format_output, or a raw entry of a deferred parse
+    output = entry.get(command)
+    return "\n".join(output) if isinstance(output, list) else str(output or "")
+
 
 class AsyncNetmikoPull():
     def __init__(self, inst_dict: dict):
         self.verbose = inst_dict.get('verbose')
         self.single_host = inst_dict.get('single_host')
         self.logger = inst_dict.get('logger')
+        self.scheduler = DeviceScheduler(inst_dict=inst_dict)
+        self.sessions = inst_dict.get('sessions') or (AsyncsshSessions(inst_dict=inst_dict) if inst_dict.get('engine') == "async" else NetmikoSessions(inst_dict=inst_dict))
+        self.agent = None if inst_dict.get('sessions') or inst_dict.get('engine') == "async" else AgentClient(inst_dict=inst_dict)
+        if self.agent and not self.agent.is_running():
+            self.agent = None
+        self.parser = TextfsmParser(inst_dict=inst_dict)
+        if not self.parser.deferred:
+            self.parser.templates.load_index()
+        self.cache = OutputCache(inst_dict=inst_dict) if inst_dict.get('cache') else None
         proxy = TunnelProxy(logger=self.logger, verbose=self.verbose)
         proxy.set_proxy()
 
 
-    async def netmiko_connection(self, device: dict, commands: List[str]) -> str:
+    async def cached_connection(self, device: dict, commands: List[str], timer: PhaseTimer = None) -> str:
+        if self.cache is None:
+            return await self.netmiko_connection(device, commands, timer)
+        output = {}
+        for command in commands:
+            entry = self.cache.get(device, command)
+            if entry is not None:
+                output[command] = entry
+        missing = [command for command in commands if command not in output]
+        if not missing:
+            self.logger.debug("All the commands for device %s served from the output cache", device['host'])
+        else:
+            result = await self.netmiko_connection(device, missing, timer)
+            if isinstance(result, str):
+                return result
+            for command, entry in zip(missing, result):
+                if entry.get("type") != "raw":
+                    self.cache.put(device, command, entry)
+                output[command] = {**entry, "cached": False}
+        return [output[command] for command in commands]
+
+
+    def cache_counts(self, output: any) -> dict:
+        entries = output if isinstance(output, list) else []
+        hits = len([entry for entry in entries if entry.get("cached")])
+        return {"hits": hits, "misses": len(entries) - hits}
+
+
+    async def netmiko_connection(self, device: dict, commands: List[str], timer: PhaseTimer = None) -> str:
+        timer = timer or PhaseTimer()
         try:
-            connection = await asyncio.to_thread(ConnectHandler, **device)
-            if connection.is_alive():
-                self.logger.debug(f"Connection to {device['host']} is active")
+            if self.agent:
+                # The cla agent returns raw outputs, they are parsed here with the --parse mode of this command
+                result = await self.agent.submit("pull", device, commands, timer)
+                if isinstance(result, str):
+                    return result
+                raw = [entry[command] for command, entry in zip(commands, result)]
             else:
-                self.logger.debug(f"Connection to {device['host']} failed")
-                connection.disconnect()
-                return f"** Connection to device {device['host']} failed"
-            connection.enable()
+                async with self.sessions.connection(device, timer) as connection:
+                    raw = []
+                    for command in commands:
+                        self.logger.debug("Executing command %s on device %s", command, device['host'])
+                        with timer.command(command):
+                            result = await self.sessions.call(connection, "send_command", command)
+                        self.logger.debug("Output: %s", LogOutput(result))
+                        raw.append(result)
+            # Parse stage, the session is closed (or back in the cla agent pool) before parsing
             output = []
-            for command in commands:
-                self.logger.debug(f"Executing command {command} on device {device['host']}")
-                result = await asyncio.to_thread(connection.send_command, command, use_textfsm=True)
-                self.logger.debug(f"Output: {result}")
+            for command, result in zip(commands, raw):
+                if self.parser.deferred:
+                    output.append({"type": "raw", "platform": device['device_type'], command: result})
+                    continue
+                with timer.phase("parse"):
+                    result = await self.parser.parse(device['device_type'], command, result)
                 output.append(self.format_output(command, result))
-            await asyncio.to_thread(connection.disconnect)
             return output
+        except SessionError as error:
+            return f"** {error}"
         except NetmikoAuthenticationException:
             self.logger.error(f"Error connecting to {device['host']}, authentication error")
             return f"** Error connecting to {device['host']}, authentication error"
@@ -67,53 +138,75 @@ class AsyncNetmikoPull():
             return f"** Error connecting to {device['host']}: unexpected {str(error).replace('\n', ' ')}"
         
        
-    def data_validation(self, data) -> None:
-        if self.verbose in [1,2]:
-            print ("->", f"About to execute Data Validation")
-        try:
-            if self.single_host:
+    def data_validation(self, data) -> bool:
+        if self.single_host:
+            if self.verbose in [1,2]:
+                print ("->", f"About to execute Data Validation")
+            try:
                 ModelSingleSsh(device=data.get('device'), commands=data.get('commands'))
-            else:
-                ModelMultipleSsh(device=data)
+            except ValidationError as error:
+                self.logger.error(f"Data validation error: {error}")
+                print (f"->, {error}")
+                sys.exit(1)
+            return True
+        try:
+            MultipleSsh(device=data.get('device'), commands=data.get('commands'))
+            return True
         except ValidationError as error:
-            self.logger.error(f"Data validation error: {error}")
-            print (f"->, {error}")
-            sys.exit(1)
+            host = data.get('device', {}).get('host') if isinstance(data.get('device'), dict) else None
+            self.logger.error(f"Data validation error for device {host}, skipped: {error}")
+            print (f"\n** Data validation error for device {host}, skipped: {str(error).replace('\n', ' ')}")
+            return False
 
 
-    async def run(self, data) -> dict:
-        self.data_validation(data)
+    async def run(self, data, stream: StreamOutput = None) -> dict:
         tasks = []
+        hosts = []
+        timers = []
         if self.single_host:
-            tasks.append(self.netmiko_connection(device=data.get('device'), commands=data.get('commands')))
+            self.data_validation(data)
+            timers.append(PhaseTimer())
+            tasks.append(await self.scheduler.start(self.scheduler.run(data.get('device'), self.cached_connection, device=data.get('device'), commands=data.get('commands'), timer=timers[-1])))
+            hosts.append(data.get('device').get('host'))
             if self.verbose in [1,2]:
                 print (f"-> Connecting to device {data.get('device').get('host')}, executing commands {data.get('commands')}")
             self.logger.info(f"Connecting to device {data.get('device')}, executing commands {data.get('commands')}")
         else:
-            for device in data:
-                tasks.append(self.netmiko_connection(device=device.get('device'), commands=device.get('commands')))
+            async for device in iterate(data):
+                if not self.data_validation(device):
+                    continue
+                timer = PhaseTimer()
+                job = self.scheduler.run(device.get('device'), self.cached_connection, device=device.get('device'), commands=device.get('commands'), timer=timer)
+                task = await self.scheduler.start(stream.collect(device.get('device').get('host'), job, timer) if stream else job)
+                if not stream:
+                    tasks.append(task)
+                    hosts.append(device.get('device').get('host'))
+                    timers.append(timer)
                 if self.verbose in [1,2]:
                     print (f"-> Connecting to device {device.get('device').get('host')}, executing commands {device.get('commands')}")
                 self.logger.info(f"Connecting to device {device.get('device').get('host')}, executing commands {device.get('commands')}")
-        results = await asyncio.gather(*tasks)
+        results = await self.scheduler.gather(tasks)
+        await self.sessions.finish()
+        self.parser.close()
+        if self.cache:
+            self.cache.save()
+            self.logger.info(f"Output cache: {self.cache.stats()}")
+            if self.verbose in [1,2]:
+                print (f"-> Output cache hits: {self.cache.hits}, misses: {self.cache.misses}, entries: {len(self.cache.entries)}")
+        if stream:
+            self.logger.info(f"{stream.count} results streamed to {stream.output.name}")
+            return None
         output_data = []
-        if self.single_host:
-            for output in results:
-                output_data.append({"Device": data.get('device').get('host'), "Output": output})
-        else:
-            for device, output in zip(data, results):
-                output_data.append({"Device": device.get('device').get('host'), "Output": output})
+        for host, output, timer in zip(hosts, results, timers):
+            output_data.append({"Device": host, "Output": output, "Timing": timer.result()})
+        if self.cache:
+            for output in output_data:
+                output["Cache"] = self.cache_counts(output["Output"])
         return json.dumps(output_data, indent=2)
 
 
     def format_output(self, command: str, output: any) -> dict:
-        if isinstance(output, str):
-            result = output.splitlines()
-            return {"type": "non-textfsm", command: result}
-        elif isinstance(output, list):
-            return {"type": "textfsm", command: output}
-        else:
-            return {"type": "non-textfsm", command: "Unknown output type"}
+        return format_output(command, output)
 
     
 class AsyncNetmikoPush():
@@ -121,28 +214,88 @@ class AsyncNetmikoPush():
         self.verbose = inst_dict.get('verbose')
         self.single_host = inst_dict.get('single_host')
         self.logger = inst_dict.get('logger')
+        self.scheduler = DeviceScheduler(inst_dict=inst_dict)
+        self.sessions = inst_dict.get('sessions') or (AsyncsshSessions(inst_dict=inst_dict) if inst_dict.get('engine') == "async" else NetmikoSessions(inst_dict=inst_dict))
+        self.agent = None if inst_dict.get('sessions') or inst_dict.get('engine') == "async" else AgentClient(inst_dict=inst_dict)
+        if self.agent and not self.agent.is_running():
+            self.agent = None
+        self.delta = inst_dict.get('delta')
+        self.cache = OutputCache(inst_dict=inst_dict) if self.delta and inst_dict.get('cache') else None
+        self.rollout = WaveRollout(inst_dict=inst_dict) if inst_dict.get('waves') and not self.single_host else None
         proxy = TunnelProxy(logger=self.logger, verbose=self.verbose)
         proxy.set_proxy()
-      
 
-    async def netmiko_connection(self, device: dict, commands: List[str]) -> str:
+
+    def cached_running(self, device: dict, delta: ConfigDelta) -> str | None:
+        if self.cache is None:
+            return None
+        entry = self.cache.get(device, delta.command)
+        if entry is None:
+            return None
+        self.logger.debug("Running config of device %s served from the output cache", device['host'])
+        return running_text(entry, delta.command)
+
+
+    def store_running(self, device: dict, delta: ConfigDelta, running: str) -> None:
+        if self.cache is not None:
+            self.cache.put(device, delta.command, format_output(delta.command, running))
+
+
+    def delta_commands(self, device: dict, commands: List[str], delta: ConfigDelta, running: str, pushed: list) -> List[str]:
+        missing = delta.missing(commands, running)
+        if delta.ambiguous:
+            # Flat lines that may be global or sub-commands, the full set of commands is pushed
+            self.logger.warning(f"Delta for device {device['host']} not computed, ambiguous flat commands {delta.ambiguous}, all the commands pushed")
+            if self.verbose in [1,2]:
+                print (f"-> Delta for device {device['host']} not computed, ambiguous flat commands: {delta.ambiguous}. Indent the sub-commands or close their context with '{delta.profile['exit']}'")
+        pushed.extend(missing)
+        if missing and self.cache is not None:
+            # The push changes the running config
+            self.cache.drop(device, delta.command)
+        self.logger.debug("Delta for device %s: %s of %s commands missing", device['host'], len(missing), len(commands))
+        return missing
+
+
+    async def netmiko_connection(self, device: dict, commands: List[str], timer: PhaseTimer = None, pushed: list = None) -> str:
+        timer = timer or PhaseTimer()
+        pushed = pushed if pushed is not None else []
+        delta = ConfigDelta(device['device_type']) if self.delta else None
+        if delta:
+            # A cached running config (or the cla agent pool) avoids a session of its own
+            running = self.cached_running(device, delta)
+            if running is None and self.agent:
+                result = await self.agent.submit("pull", device, [delta.command], timer)
+                if isinstance(result, str):
+                    return result
+                running = running_text(result[0], delta.command)
+                self.store_running(device, delta, running)
+            if running is not None:
+                commands = self.delta_commands(device, commands, delta, running, pushed)
+                if not commands:
+                    return COMPLIANT
+                delta = None
+        if self.agent:
+            return await self.agent.submit("push", device, commands, timer)
         try:
-            connection = await asyncio.to_thread(ConnectHandler, **device)
-            if connection.is_alive():
-                self.logger.debug(f"Connection to {device['host']} is active")
-            else:
-                self.logger.debug(f"Connection to {device['host']} failed")
-                connection.disconnect()
-                return f"** Connection to device {device['host']} failed"
-            connection.enable()
-            self.logger.debug(f"Detected prompt {connection.find_prompt()}")
-            output = []
-            self.logger.debug(f"Configuring the following commands {commands} on device {device['host']}")
-            result = await asyncio.to_thread(connection.send_config_set, commands)
-            self.logger.debug(f"Output: {result}")
-            output.append(result)
-            await asyncio.to_thread(connection.disconnect)
-            return output
+            async with self.sessions.connection(device, timer) as connection:
+                self.logger.debug("Detected prompt %s", await self.sessions.call(connection, "find_prompt"))
+                if delta:
+                    with timer.command(delta.command):
+                        running = await self.sessions.call(connection, "send_command", delta.command)
+                    self.store_running(device, delta, running)
+                    commands = self.delta_commands(device, commands, delta, running, pushed)
+                    if not commands:
+                        # Already in compliance, config mode is never entered
+                        return COMPLIANT
+                output = []
+                self.logger.debug("Configuring the following commands %s on device %s", commands, device['host'])
+                with timer.command("send_config_set"):
+                    result = await self.sessions.call(connection, "send_config_set", commands)
+                self.logger.debug("Output: %s", LogOutput(result))
+                output.append(result)
+                return output
+        except SessionError as error:
+            return f"** {error}"
         except NetmikoAuthenticationException:
             self.logger.error(f"Error connecting to {device['host']}, authentication error")
             return f"** Error connecting to {device['host']}, authentication error"
@@ -160,55 +313,127 @@ class AsyncNetmikoPush():
             return f"** Error connecting to {device['host']}: unexpected {str(error).replace('\n', ' ')}"
         
         
-    def data_validation(self, data) -> None:
-        if self.verbose in [1,2]:
-            print ("->", f"About to execute Data Validation")
-        try:
-            if self.single_host:
+    def data_validation(self, data) -> bool:
+        if self.single_host:
+            if self.verbose in [1,2]:
+                print ("->", f"About to execute Data Validation")
+            try:
                 ModelSingleSsh(device=data.get('device'), commands=data.get('commands'))
-            else:
-                ModelMultipleSsh(device=data)
+            except ValidationError as error:
+                self.logger.error(f"Data validation error: {error}")
+                print (f" ->, {error}")
+                sys.exit(1)
+            return True
+        try:
+            MultipleSsh(device=data.get('device'), commands=data.get('commands'))
+            return True
         except ValidationError as error:
-            self.logger.error(f"Data validation error: {error}")
-            print (f" ->, {error}")
-            sys.exit(1)
+            host = data.get('device', {}).get('host') if isinstance(data.get('device'), dict) else None
+            self.logger.error(f"Data validation error for device {host}, skipped: {error}")
+            print (f"\n** Data validation error for device {host}, skipped: {str(error).replace('\n', ' ')}")
+            return False
+
+
+    def push_status(self, output: any, device_type: str) -> tuple:
+        # The status of a push and the failures found in its whole output
+        if output == COMPLIANT:
+            return "compliant", []
+        if isinstance(output, str) and output.startswith(NOT_PUSHED):
+            return "skipped", []
+        if not isinstance(output, (list, str)):
+            return "unknown", []
+        failures = output_classifier(device_type).classify(output)
+        return ("failed" if failures else "successful"), failures
+
+
+    async def submit(self, device: dict, tasks: list, hosts: list, timers: list, deltas: list, platforms: list) -> None:
+        platforms.append(device.get('device').get('device_type'))
+        timers.append(PhaseTimer())
+        deltas.append([])
+        tasks.append(await self.scheduler.start(self.scheduler.run(device.get('device'), self.netmiko_connection, device=device.get('device'), commands=device.get('commands'), timer=timers[-1], pushed=deltas[-1])))
+        hosts.append(device.get('device').get('host'))
+        if self.verbose in [1,2]:
+            print (f"-> Connecting to device {device.get('device').get('host')}, configuring commands {device.get('commands')}")
+        self.logger.info(f"Connecting to device {device.get('device').get('host')}, executing commands {device.get('commands')}")
+
+
+    async def run_waves(self, devices: list, tasks: list, hosts: list, timers: list, deltas: list, platforms: list, waves: list) -> list:
+        # Returns the outputs of the devices left out when a wave fails the gate
+        start = 0
+        for number, size in enumerate(self.rollout.sizes(len(devices)), start=1):
+            first = len(tasks)
+            for device in devices[start:start + size]:
+                await self.submit(device, tasks, hosts, timers, deltas, platforms)
+                waves.append(number)
+            start += size
+            results = await asyncio.gather(*tasks[first:])
+            reason = self.rollout.gate(number, [self.push_status(output, platform)[0] for output, platform in zip(results, platforms[first:])])
+            if reason and start < len(devices):
+                if self.verbose in [1,2]:
+                    print (f"\n** Rollout {reason}, {len(devices) - start} devices not pushed")
+                for device in devices[start:]:
+                    hosts.append(device.get('device').get('host'))
+                    platforms.append(device.get('device').get('device_type'))
+                    timers.append(PhaseTimer())
+                    deltas.append([])
+                    waves.append(None)
+                return [f"{NOT_PUSHED}, rollout {reason}"] * (len(devices) - start)
+        return []
 
 
     async def run(self, data: dict) -> dict:
-        self.data_validation(data=data)   
         tasks = []
+        hosts = []
+        timers = []
+        deltas = []
+        platforms = []
+        waves = []
+        skipped = []
         if self.single_host:
-            tasks.append(self.netmiko_connection(device=data.get('device'), commands=data.get('commands')))
-            if self.verbose in [1,2]:
-                print (f"-> Connecting to device {data.get('device').get('host')}, configuring commands {data.get('commands')}")
-            self.logger.info(f"Connecting to device {data.get('device').get('host')}, executing commands {data.get('commands')}")
+            self.data_validation(data=data)
+            await self.submit(data, tasks, hosts, timers, deltas, platforms)
         else:
-            for device in data:
-                tasks.append(self.netmiko_connection(device=device.get('device'), commands=device.get('commands')))
-                if self.verbose in [1,2]:
-                    print (f"-> Connecting to device {device.get('device').get('host')}, configuring commands {device.get('commands')}")
-                self.logger.info(f"Connecting to device {device.get('device').get('host')}, executing commands {device.get('commands')}")
-        results = await asyncio.gather(*tasks)
+            devices = []
+            async for device in iterate(data):
+                if not self.data_validation(data=device):
+                    continue
+                if self.rollout:
+                    devices.append(device)
+                else:
+                    await self.submit(device, tasks, hosts, timers, deltas, platforms)
+            if self.rollout:
+                skipped = await self.run_waves(devices, tasks, hosts, timers, deltas, platforms, waves)
+        results = await self.scheduler.gather(tasks) + skipped
+        await self.sessions.finish()
+        if self.cache:
+            self.cache.save()
+            self.logger.info(f"Output cache: {self.cache.stats()}")
+        if self.rollout:
+            self.logger.info(f"Rollout summary: {self.rollout.stats()}")
         output_data = []
-        if self.single_host:
-            for output in results:
-                output_data.append({"Device": data.get('device').get('host'), "Output": output})
-        else:
-            for device, output in zip(data, results):
-                output_data.append({"Device": device.get('device').get('host'), "Output": output})
-
-        for output in output_data:
-            has_error = ["Invalid input", "Error", "Incomplete command", "Ambiguous command", "Authentication to device failed"]
-            if isinstance(output.get('Output'), list):
-                if not any(error in output.get('Output')[-1] for error in has_error):
-                    output['Output'] = "Successful configuration"
-                else: 
-                    output['Output'] = "Configuration failed, check the commands in the configuration file"
-            elif isinstance(output.get('Output'), str):
-                if not any(error in output.get('Output') for error in has_error):
-                    output['Output'] = "Successful configuration"
-                else: 
-                    output['Output'] = "Configuration failed, check the commands in the configuration file or credentials"
+        for host, output, timer, pushed in zip(hosts, results, timers, deltas):
+            output_data.append({"Device": host, "Output": output, "Timing": timer.result()})
+            if self.delta:
+                output_data[-1]["Delta"] = pushed
+        if self.rollout:
+            for output, wave in zip(output_data, waves):
+                output["Wave"] = wave
+        if self.delta:
+            compliant = len([output for output in output_data if output["Output"] == COMPLIANT])
+            self.logger.info(f"Delta push: {compliant} of {len(output_data)} devices already in compliance")
+            if self.verbose in [1,2]:
+                print (f"-> Delta push, devices already in compliance: {compliant} of {len(output_data)}")
+
+        for output, platform in zip(output_data, platforms):
+            status, failures = self.push_status(output.get('Output'), platform)
+            if status == "successful":
+                output['Output'] = "Successful configuration"
+            elif status == "failed" and isinstance(output.get('Output'), list):
+                output['Output'] = "Configuration failed, check the commands in the configuration file"
+                output['Failures'] = failures
+            elif status == "failed":
+                output['Output'] = "Configuration failed, check the commands in the configuration file or credentials"
+                output['Failures'] = failures
             
         return json.dumps(output_data, indent=2)
     
@@ -218,28 +443,31 @@ class AsyncNetmikoInteractive():
         self.verbose = inst_dict.get('verbose')
         self.single_host = inst_dict.get('single_host')
         self.logger = inst_dict.get('logger')
+        self.scheduler = DeviceScheduler(inst_dict=inst_dict)
+        self.sessions = inst_dict.get('sessions') or (AsyncsshSessions(inst_dict=inst_dict) if inst_dict.get('engine') == "async" else NetmikoSessions(inst_dict=inst_dict))
+        self.agent = None if inst_dict.get('sessions') or inst_dict.get('engine') == "async" else AgentClient(inst_dict=inst_dict)
+        if self.agent and not self.agent.is_running():
+            self.agent = None
         proxy = TunnelProxy(logger=self.logger, verbose=self.verbose)
         proxy.set_proxy()
 
 
-    async def netmiko_connection(self, device: dict, commands_pattern: List[str]) -> ConnectHandler:
+    async def netmiko_connection(self, device: dict, commands_pattern: List[str], timer: PhaseTimer = None) -> str:
+        timer = timer or PhaseTimer()
+        if self.agent:
+            return await self.agent.submit("interactive", device, commands_pattern, timer)
         try:
-            connection = await asyncio.to_thread(ConnectHandler, **device)
-            if connection.is_alive():
-                self.logger.debug(f"Connection to {device['host']} is active")
-            else:
-                self.logger.debug(f"Connection to {device['host']} failed")
-                connection.disconnect()
-                return f"** Connection to device {device['host']} failed"
-            connection.enable()
-            self.logger.debug(f"Detected prompt {connection.find_prompt()}")
-            output = []
-            self.logger.debug(f"Configuring the following commands and patterns {commands_pattern} on device {device['host']}")
-            result = await asyncio.to_thread(connection.send_multiline, commands_pattern)
-            self.logger.debug(f"Output: {result}")
-            output.append(result)
-            await asyncio.to_thread(connection.disconnect)
-            return output
+            async with self.sessions.connection(device, timer) as connection:
+                self.logger.debug("Detected prompt %s", await self.sessions.call(connection, "find_prompt"))
+                output = []
+                self.logger.debug("Configuring the following commands and patterns %s on device %s", commands_pattern, device['host'])
+                with timer.command("send_multiline"):
+                    result = await self.sessions.call(connection, "send_multiline", commands_pattern)
+                self.logger.debug("Output: %s", LogOutput(result))
+                output.append(result)
+                return output
+        except SessionError as error:
+            return f"** {error}"
         except NetmikoAuthenticationException:
             self.logger.error(f"Error connecting to {device['host']}, authentication error")
             return f"** Error connecting to {device['host']}, authentication error"
@@ -257,54 +485,69 @@ class AsyncNetmikoInteractive():
             return f"** Error connecting to {device['host']}: unexpected {str(error).replace('\n', ' ')}"
     
 
-    def data_validation(self, data) -> None:
-        if self.verbose in [1,2]:
-            print ("->", f"About to execute Data Validation")
-        try:
-            if self.single_host:
+    def data_validation(self, data) -> bool:
+        if self.single_host:
+            if self.verbose in [1,2]:
+                print ("->", f"About to execute Data Validation")
+            try:
                 ModelSingleInteractive(device=data.get('device'), commands=data.get('commands'))
-            else:
-                ModelMultipleInteractive(device=data)
+            except ValidationError as error:
+                self.logger.error(f"Data validation error: {error}")
+                print (f" ->, {error}")
+                sys.exit(1)
+            return True
+        try:
+            MultipleInteractive(device=data.get('device'), commands=data.get('commands'))
+            return True
         except ValidationError as error:
-            self.logger.error(f"Data validation error: {error}")
-            print (f" ->, {error}")
-            sys.exit(1)
+            host = data.get('device', {}).get('host') if isinstance(data.get('device'), dict) else None
+            self.logger.error(f"Data validation error for device {host}, skipped: {error}")
+            print (f"\n** Data validation error for device {host}, skipped: {str(error).replace('\n', ' ')}")
+            return False
 
 
     async def run(self, data: dict) -> dict:
-        self.data_validation(data=data)   
         tasks = []
+        hosts = []
+        timers = []
+        platforms = []
         if self.single_host:
-            tasks.append(self.netmiko_connection(device=data.get('device'), commands_pattern=data.get('commands')))
+            self.data_validation(data=data)
+            timers.append(PhaseTimer())
+            tasks.append(await self.scheduler.start(self.scheduler.run(data.get('device'), self.netmiko_connection, device=data.get('device'), commands_pattern=data.get('commands'), timer=timers[-1])))
+            hosts.append(data.get('device').get('host'))
+            platforms.append(data.get('device').get('device_type'))
             if self.verbose in [1,2]:
                 print (f"-> Connecting to device {data.get('device').get('host')}, configuring commands {data.get('commands')}")
             self.logger.info(f"Connecting to device {data.get('device').get('host')}, executing commands {data.get('commands')}")
         else:
-            for device in data:
-                tasks.append(self.netmiko_connection(device=device.get('device'), commands_pattern=device.get('commands')))
+            async for device in iterate(data):
+                if not self.data_validation(data=device):
+                    continue
+                timers.append(PhaseTimer())
+                tasks.append(await self.scheduler.start(self.scheduler.run(device.get('device'), self.netmiko_connection, device=device.get('device'), commands_pattern=device.get('commands'), timer=timers[-1])))
+                hosts.append(device.get('device').get('host'))
+                platforms.append(device.get('device').get('device_type'))
                 if self.verbose in [1,2]:
                     print (f"-> Connecting to device {device.get('device').get('host')}, configuring commands {device.get('commands')}")
                 self.logger.info(f"Connecting to device {device.get('device').get('host')}, executing commands {device.get('commands')}")
-        results = await asyncio.gather(*tasks)
+        results = await self.scheduler.gather(tasks)
+        await self.sessions.finish()
         output_data = []
-        if self.single_host:
-            for output in results:
-                output_data.append({"Device": data.get('device').get('host'), "Output": output})
-        else:
-            for device, output in zip(data, results):
-                output_data.append({"Device": device.get('device').get('host'), "Output": output})
-
-        for output in output_data:
-            has_error = ["Invalid input", "Error", "Incomplete command", "Ambiguous command", "Authentication to device failed"]
-            if isinstance(output.get('Output'), list):
-                if not any(error in output.get('Output')[-1] for error in has_error):
-                    output['Output'] = "Successful configuration"
-                else: 
-                    output['Output'] = "Configuration failed, check the commands in the configuration file"
-            elif isinstance(output.get('Output'), str):
-                if not any(error in output.get('Output') for error in has_error):
-                    output['Output'] = "Successful configuration"
-                else: 
-                    output['Output'] = "Configuration failed, check the commands in the configuration file or credentials"
+        for host, output, timer in zip(hosts, results, timers):
+            output_data.append({"Device": host, "Output": output, "Timing": timer.result()})
+
+        for output, platform in zip(output_data, platforms):
+            if not isinstance(output.get('Output'), (list, str)):
+                continue
+            failures = output_classifier(platform).classify(output.get('Output'))
+            if not failures:
+                output['Output'] = "Successful configuration"
+            elif isinstance(output.get('Output'), list):
+                output['Output'] = "Configuration failed, check the commands in the configuration file"
+                output['Failures'] = failures
+            else:
+                output['Output'] = "Configuration failed, check the commands in the configuration file or credentials"
+                output['Failures'] = failures
             
         return json.dumps(output_data, indent=2)
\ No newline at end of file
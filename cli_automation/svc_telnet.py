@@ -8,47 +8,225 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.
 import traceback
 import paramiko
 from paramiko.ssh_exception import SSHException
+import time
+import netmiko
 from netmiko import ConnectHandler, NetmikoAuthenticationException, NetMikoTimeoutException
+from netmiko.channel import TelnetChannel
+# The Telnet class netmiko checks its telnet connections against, the standard library one fails
+# those checks and is gone in Python 3.13
+from netmiko._telnetlib import telnetlib
 from pydantic import ValidationError
-from .svc_model import ModelTelnetPull, ModelTelnetPush
-from .svc_proxy import TunnelProxy
+from .svc_model import ModelTelnetPull, TelnetPush, connection_params
+from .svc_textfsm import TextfsmParser, format_output
+from .svc_classifier import output_classifier
+from .svc_inventory import iterate
+from .svc_proxy import TunnelProxy, open_connection
+from .svc_scheduler import DeviceScheduler
+from .svc_timing import PhaseTimer
+from .svc_sessions import SessionError
 import asyncio
 import paramiko
 from typing import List
 import json
-from .svc_files import ManageFiles
+from .svc_files import ManageFiles, StreamOutput
 import socket
-from cli_automation import config_data
+import re
+from functools import lru_cache
+from netmiko.exceptions import ReadTimeout
+from cli_automation import config_data, LogOutput
+
+USERNAME = r"(?i:user ?name|login)\s*:\s*$"
+PASSWORD = r"(?i:password)\s*:\s*$"
+LOGIN_FAILED = r"(?i:authentication failed|login invalid|access denied|bad password)"
+# Commands that ask for a confirmation, '[confirm]' or 'Destination filename [startup-config]? ',
+# their read also ends at a last line ending in '?' or ']' with nothing after it
+CONFIRM_COMMANDS = re.compile(r"^\s*(?:copy|write|wr|reload|delete|erase|clear|format|squeeze|undelete|save|reset|reboot)\b", re.IGNORECASE)
+CONFIRM_PROMPT = r"\n[^\n]*[?\]]:?[ \t]*\Z"
+
+
+# The netmiko releases the telnet transport below is known to work with, it relies on the
+# telnetlib copy netmiko ships, a release outside the range is refused instead of failing later
+NETMIKO_TELNET_RANGE = ((4, 4), (5, 0))
+
+
+@lru_cache(maxsize=None)
+def netmiko_supported(version: str) -> bool:
+    low, high = NETMIKO_TELNET_RANGE
+    return low <= tuple(int(part) for part in re.findall(r"\d+", version)[:2]) < high
+
+
+def telnet_connection(params: dict) -> ConnectHandler:
+    # generic_telnet connection over a socket opened by CLA, through the tunnel pool or straight
+    # to the device, instead of the one telnetlib would open with socket.create_connection
+    if not netmiko_supported(netmiko.__version__):
+        low, high = (".".join(map(str, version)) for version in NETMIKO_TELNET_RANGE)
+        raise SessionError(f"Telnet is not supported with netmiko {netmiko.__version__}, it requires netmiko >= {low} and < {high}")
+    connection = ConnectHandler(auto_connect=False, **connection_params(params))
+    transport = telnetlib.Telnet()
+    transport.host, transport.port, transport.timeout = connection.host, connection.port, connection.conn_timeout
+    transport.sock = open_connection(params, connection.port, connection.conn_timeout)
+    connection.remote_conn = transport
+    connection.channel = TelnetChannel(conn=transport, encoding=connection.encoding)
+    try:
+        # session_preparation needs data on the channel
+        connection.write_channel(connection.RETURN)
+        time.sleep(0.1)
+        connection.session_preparation()
+    except Exception:
+        connection.disconnect()
+        raise
+    return connection
+
+
+@lru_cache(maxsize=None)
+def prompt_tokens(prompts: tuple) -> str:
+    # The telnet_prompts of config.json as one alternation, longest first so '(config)#' wins over '#'
+    return "(?:" + "|".join(re.escape(prompt) for prompt in sorted(set(prompts), key=len, reverse=True)) + ")"
+
+
+class TelnetSession():
+    # Drives a generic_telnet connection by prompts, each read returns as soon as the username,
+    # password or device prompt shows up instead of waiting for the output to be quiet
+    def __init__(self, connection, device: dict, prompts: List[str], logger):
+        self.connection = connection
+        self.device = device
+        self.logger = logger
+        self.read_timeout = device.get('read_timeout') or config_data.get("telnet_read_timeout")
+        self.tokens = prompt_tokens(tuple(prompts))
+        self.any_prompt = self.tokens + r"[ \t]*$"
+        self.prompt = ""
+        self.prompt_pattern = self.any_prompt
+
+
+    def read_until(self, pattern: str, timeout: float = None) -> str:
+        try:
+            data = self.connection.read_until_pattern(pattern=pattern, read_timeout=timeout or self.read_timeout)
+        except EOFError:
+            if not self.prompt:
+                # Devices close the connection after a failed login
+                raise NetmikoAuthenticationException(f"Connection to device {self.device['host']} closed during login")
+            raise SSHException(f"Connection to device {self.device['host']} closed")
+        return data.replace("\r", "")
+
+
+    def set_prompt(self, data: str) -> str:
+        # The prompt found after login anchors the command reads, 'Router#' also matches 'Router(config-if)#'
+        self.prompt = data.strip().splitlines()[-1].strip() if data.strip() else ""
+        base = re.sub(self.any_prompt, "", self.prompt)
+        base = re.sub(r"\(.*\)$", "", base).lstrip("<[")
+        if base:
+            self.prompt_pattern = r"(?:^|\n)[<\[]?" + re.escape(base) + r"[^\n]{0,64}?" + self.tokens + r"[ \t]*$"
+        return self.prompt
+
+
+    def login(self) -> str:
+        pattern = f"{USERNAME}|{PASSWORD}|{LOGIN_FAILED}|{self.any_prompt}"
+        sent_username = sent_password = confirmed = False
+        try:
+            data = self.read_until(pattern, timeout=min(2, self.read_timeout))
+        except ReadTimeout:
+            # Some devices show nothing until they get a first line
+            self.connection.write_channel("\n")
+            data = self.read_until(pattern)
+        while True:
+            if re.search(LOGIN_FAILED, data):
+                raise NetmikoAuthenticationException(f"Authentication to device {self.device['host']} failed")
+            if re.search(PASSWORD, data):
+                if sent_password:
+                    raise NetmikoAuthenticationException(f"Authentication to device {self.device['host']} failed")
+                self.connection.write_channel(f"{self.device.get('password')}\n")
+                sent_password, confirmed = True, False
+            elif re.search(USERNAME, data):
+                if sent_username:
+                    raise NetmikoAuthenticationException(f"Authentication to device {self.device['host']} failed")
+                self.connection.write_channel(f"{self.device.get('username')}\n")
+                sent_username, confirmed = True, False
+            elif confirmed:
+                return self.set_prompt(data)
+            else:
+                # A banner line can end like a prompt, the answer to an empty line is the prompt itself
+                self.connection.write_channel("\n")
+                confirmed = True
+            data = self.read_until(pattern)
+
+
+    def enable(self) -> None:
+        if not self.prompt.endswith(">"):
+            return
+        self.connection.write_channel("enable\n")
+        data = self.read_until(f"{PASSWORD}|{self.any_prompt}")
+        if re.search(PASSWORD, data):
+            self.connection.write_channel(f"{self.device.get('secret') or ''}\n")
+            data = self.read_until(self.any_prompt)
+        if self.set_prompt(data).endswith(">"):
+            raise NetmikoAuthenticationException(f"Failed to enter enable mode on device {self.device['host']}")
+
+
+    def send_command(self, command: str, expect_string: str = None) -> str:
+        # The read ends at the device prompt, or at expect_string, the confirmation prompts
+        # are only expected after the commands known to ask for one
+        pattern = self.prompt_pattern
+        if expect_string:
+            pattern = f"{pattern}|{expect_string}"
+        elif CONFIRM_COMMANDS.match(command):
+            pattern = f"{pattern}|{CONFIRM_PROMPT}"
+        self.connection.write_channel(f"{command}\n")
+        lines = self.read_until(pattern).split("\n")
+        if lines and command.strip() and command.strip() in lines[0]:
+            lines = lines[1:]
+        if lines and re.search(self.prompt_pattern, lines[-1]):
+            lines = lines[:-1]
+        return "\n".join(lines)
 
 class AsyncNetmikoTelnetPull():
     def __init__(self, inst_dict: dict):
         self.verbose = inst_dict.get('verbose')
         self.logger = inst_dict.get('logger')
+        self.scheduler = DeviceScheduler(inst_dict={**inst_dict, "protocol": "telnet"})
+        self.parser = TextfsmParser(inst_dict=inst_dict)
         proxy = TunnelProxy(logger=self.logger, verbose=self.verbose)
         proxy.set_proxy()
 
 
-    async def device_connect(self, device: dict, command: str) -> str:
+    async def device_connect(self, device: dict, commands: List[str], timer: PhaseTimer) -> list | str:
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, self.connect, device, command)
+        raw = await loop.run_in_executor(None, self.connect, device, commands, timer)
+        if isinstance(raw, str):
+            return raw
+        # Parse stage, after the session is closed, with the templates of the real device type
+        output = []
+        for command, result in zip(commands, raw):
+            with timer.phase("parse"):
+                result = await self.parser.parse(device['device_type'], command, result)
+            output.append(format_output(command, result))
+        return output
 
 
-    def connect(self, device: dict, command: str) -> str:
+    def connect(self, device: dict, commands: List[str], timer: PhaseTimer) -> list | str:
         try:
-            device['device_type'] = 'generic_telnet'
-            device["global_delay_factor"] = 2
-            connection = ConnectHandler(**device)
-            connection.send_command_timing(device.get('username'))
-            connection.send_command_timing(device.get('password'))
-            self.logger.debug(f"Sending user {device.get('username')} and password {device.get('password')} to device")
+            params = {**device, "device_type": "generic_telnet", "global_delay_factor": device.get("global_delay_factor") or 2}
+            with timer.phase("connect"):
+                connection = telnet_connection(params)
+            session = TelnetSession(connection, device, config_data.get("telnet_prompts"), self.logger)
+            with timer.phase("auth"):
+                session.login()
+            self.logger.debug("Logged in to device %s as user %s, prompt %s", device['host'], device.get('username'), session.prompt)
             if device.get('secret'):
-                connection.enable()
-            connection.clear_buffer()
-            self.logger.debug(f"Executing command {command} on device {device['host']}")
-            output = connection.send_command_timing(command)
-            self.logger.debug(f"Output: {output}")
-            connection.disconnect()
-            return f"\nDevice: {device['host']}\n{output.strip()}"
+                with timer.phase("enable"):
+                    session.enable()
+            output = []
+            for command in commands:
+                self.logger.debug("Executing command %s on device %s", command, device['host'])
+                with timer.command(command):
+                    result = session.send_command(command)
+                self.logger.debug("Output: %s", LogOutput(result))
+                output.append(result.strip())
+            with timer.phase("disconnect"):
+                connection.disconnect()
+            return output
+        except SessionError as error:
+            self.logger.error(str(error))
+            return f"** Error connecting to {device['host']}, {error}"
         except NetmikoAuthenticationException:
             self.logger.error(f"Error connecting to {device['host']}, authentication error")
             return f"** Error connecting to {device['host']}, authentication error"
@@ -61,40 +239,60 @@ class AsyncNetmikoTelnetPull():
         except (SSHException, socket.timeout, socket.error) as error:
             self.logger.error(f"Error connecting to {device['host']}, SSH error: {error}")
             return f"** Error connecting to {device['host']}, SSH error: {error}"
+        except ReadTimeout:
+            self.logger.error(f"Error connecting to {device['host']}, Timeout error, no prompt received")
+            return f"** Error connecting to {device['host']}, Timeout error, no prompt received"
         except Exception as error:
             self.logger.error(f"Error connecting to {device['host']}: unexpected {error}\n{traceback.format_exc()}")
             return f"** Error connecting to {device['host']}: unexpected {str(error).replace('\n', ' ')}"
 
 
-    def data_validation(self, data: ModelTelnetPull) -> None:
-        if self.verbose in [1,2]:
-            print(f"-> About to execute Data Validation")
+    def data_validation(self, data: dict) -> bool:
         try:
-            ModelTelnetPull(devices=data.get('devices'), command=data.get('command'))
+            ModelTelnetPull(device=data.get('device'), commands=data.get('commands'))
+            return True
         except ValidationError as error:
-            self.logger.error(f"Data validation error: {error}")
-            print(f" -> {error}")
-            sys.exit(1)
+            host = data.get('device', {}).get('host') if isinstance(data.get('device'), dict) else None
+            self.logger.error(f"Data validation error for device {host}, skipped: {error}")
+            print (f"\n** Data validation error for device {host}, skipped: {str(error).replace('\n', ' ')}")
+            return False
 
 
-    async def run(self, data: dict) -> str:
-        self.data_validation(data=data)
-        output = []
+    async def run(self, data: List[dict], stream: StreamOutput = None) -> str:
         tasks = []
-        for device in data.get('devices'):
-            tasks.append(self.device_connect(device, data.get('command')))
+        hosts = []
+        timers = []
+        async for device in iterate(data):
+            if not self.data_validation(data=device):
+                continue
+            dev = device.get('device')
+            cmds = device.get('commands')
+            timer = PhaseTimer()
+            job = self.scheduler.run(dev, self.device_connect, dev, cmds, timer=timer)
+            task = await self.scheduler.start(stream.collect(dev['host'], job, timer) if stream else job)
+            if not stream:
+                tasks.append(task)
+                hosts.append(dev['host'])
+                timers.append(timer)
             if self.verbose in [1,2]:
-                print(f"-> Connecting to device {device['host']}, executing command {data.get('command')}")
-            self.logger.debug(f"Connecting to device {device['host']}, executing command {data.get('command')}")
-        results = await asyncio.gather(*tasks)
-        output.extend(results)
-        return "\n".join(output)
+                print(f"-> Connecting to device {dev['host']}, executing commands {cmds}")
+            self.logger.debug("Connecting to device %s, executing commands %s", dev['host'], cmds)
+        results = await self.scheduler.gather(tasks)
+        self.parser.close()
+        if stream:
+            self.logger.info(f"{stream.count} results streamed to {stream.output.name}")
+            return None
+        output_data = []
+        for host, output, timer in zip(hosts, results, timers):
+            output_data.append({"Device": host, "Output": output, "Timing": timer.result()})
+        return json.dumps(output_data, indent=2)
     
 
 class AsyncNetmikoTelnetPush():
     def __init__(self, inst_dict: dict):
         self.verbose = inst_dict.get('verbose')
         self.logger = inst_dict.get('logger')
+        self.scheduler = DeviceScheduler(inst_dict={**inst_dict, "protocol": "telnet"})
         proxy = TunnelProxy(logger=self.logger, verbose=self.verbose)
         proxy.set_proxy()
 
@@ -104,45 +302,49 @@ class AsyncNetmikoTelnetPush():
         return content
 
 
-    async def device_connect(self, device: dict, command: List[str], prompts: List[str]) -> str:
+    async def device_connect(self, device: dict, command: List[str], prompts: List[str], timer: PhaseTimer) -> str:
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, self.connect, device, command, prompts)
+        return await loop.run_in_executor(None, self.connect, device, command, prompts, timer)
 
 
-    def connect(self, device: dict, commands: str, prompts: List[str]) -> str:
+    def connect(self, device: dict, commands: List[str], prompts: List[str], timer: PhaseTimer) -> str | List[str]:
         try:
-            device["device_type"] = "generic_telnet"
-            device["global_delay_factor"] = 2
-            connection = ConnectHandler(**device)
-            connection.send_command_timing(device.get('username'))
-            connection.send_command_timing(device.get('password'))
-            self.logger.debug(f"Sending user {device.get('username')} and password {device.get('password')} to device")
-            aut = False
-            output = ""
-            for prompt in prompts:
-                if prompt in connection.find_prompt():
-                    aut = True
-                    output = (f"Login valid")
-                    self.logger.debug(f"Login: {output}")
-                    break
-            if not aut:
+            params = {**device, "device_type": "generic_telnet", "global_delay_factor": device.get("global_delay_factor") or 2}
+            classifier = output_classifier(device['device_type'])
+            with timer.phase("connect"):
+                connection = telnet_connection(params)
+            session = TelnetSession(connection, params, prompts, self.logger)
+            try:
+                with timer.phase("auth"):
+                    session.login()
+                self.logger.debug("Login: Login valid, prompt %s", session.prompt)
+            except NetmikoAuthenticationException as error:
                 output = (f"Login invalid")
-                connection.disconnect()
-                self.logger.debug(f"Login: {output}")
+                with timer.phase("disconnect"):
+                    connection.disconnect()
+                self.logger.debug("Login: %s, %s", output, error)
                 return f"Output, {output.strip()}"
             if device.get('secret'):
-                connection.enable()
-            output = ""
+                with timer.phase("enable"):
+                    session.enable()
+            output = []
             for cmd in commands:
-                self.logger.debug(f"Executing command {cmd} on device {device['host']}")
-                result = connection.send_command_timing(cmd)
-                self.logger.debug(f"Output: {result}")
-                if "Invalid input" in result or "Error" in result:
-                    output = (f"Invalid input, {cmd}")
-                    self.logger.debug(f"Output: {output}")
+                self.logger.debug("Executing command %s on device %s", cmd, device['host'])
+                with timer.command(cmd):
+                    result = session.send_command(cmd)
+                self.logger.debug("Output: %s", LogOutput(result))
+                output.append(result)
+                failure = classifier.search(result)
+                if failure:
+                    # The commands after a failed one are not sent
+                    self.logger.debug("Command %s failed on device %s: %s", cmd, device['host'], failure['error'])
                     break
-            connection.disconnect()
-            return f"Output {output.strip()}"
+            with timer.phase("disconnect"):
+                connection.disconnect()
+            return output
+        except SessionError as error:
+            self.logger.error(str(error))
+            return f"** Error connecting to {device['host']}, {error}"
         except NetmikoAuthenticationException:
             self.logger.error(f"Error connecting to {device['host']}, authentication error")
             return f"** Error connecting to {device['host']}, authentication error"
@@ -155,49 +357,62 @@ class AsyncNetmikoTelnetPush():
         except SSHException as ssh_error:
             self.logger.error(f"Error connecting to {device['host']}, SSH error: {ssh_error}")
             return f"** Error connecting to {device['host']}, SSH error: {ssh_error}"
+        except ReadTimeout:
+            self.logger.error(f"Error connecting to {device['host']}, Timeout error, no prompt received")
+            return f"** Error connecting to {device['host']}, Timeout error, no prompt received"
         except Exception as error:
             self.logger.error(f"Error connecting to {device['host']}: unexpected {error}\n{traceback.format_exc()}")
             return f"** Error connecting to {device['host']}: unexpected {str(error).replace('\n', ' ')}"
 
 
-    def data_validation(self, data: ModelTelnetPush) -> None:
-        if self.verbose in [1,2]:
-                print(f"-> About to execute Data Validation")
+    def data_validation(self, data: dict) -> bool:
         try:
-            ModelTelnetPush(device=data)
+            TelnetPush(device=data.get('device'), commands=data.get('commands'))
+            return True
         except ValidationError as error:
-            self.logger.error(f"Data validation error: {error}")
-            print (f" ->, {error}")
-            sys.exit(1)
+            host = data.get('device', {}).get('host') if isinstance(data.get('device'), dict) else None
+            self.logger.error(f"Data validation error for device {host}, skipped: {error}")
+            print (f"\n** Data validation error for device {host}, skipped: {str(error).replace('\n', ' ')}")
+            return False
 
     
     async def run(self, data: List[dict]) -> dict:
-        self.data_validation(data=data)
         prompts = config_data.get("telnet_prompts")
         tasks = []
-        print ("\n")
-        for device in data:
+        hosts = []
+        timers = []
+        commands = []
+        async for device in iterate(data):
+            if not self.data_validation(data=device):
+                continue
             dev = device.get('device')
             cmd = device.get('commands')
-            tasks.append(self.device_connect(device=dev, command=cmd, prompts=prompts))
+            timers.append(PhaseTimer())
+            tasks.append(await self.scheduler.start(self.scheduler.run(dev, self.device_connect, device=dev, command=cmd, prompts=prompts, timer=timers[-1])))
+            hosts.append(dev.get('host'))
+            commands.append((dev.get('device_type'), cmd))
             if self.verbose in [1,2]:
                 print (f"-> Connecting to device {dev.get('host')}, configuring commands {cmd}")
             self.logger.info(f"Connecting to device {dev.get('host')}, executing command {cmd}")
-        results = await asyncio.gather(*tasks)
+        results = await self.scheduler.gather(tasks)
         output_data = []
-        for device, output in zip(data, results):
-            output_data.append({"Device": device.get('device').get('host'), "Output": output})
-        for output in output_data:
-            if isinstance(output.get('Output'), str):
-                if ("Invalid input" or "Error") in output.get('Output'):
+        for host, output, timer in zip(hosts, results, timers):
+            output_data.append({"Device": host, "Output": output, "Timing": timer.result()})
+        for output, (platform, cmd) in zip(output_data, commands):
+            classifier = output_classifier(platform)
+            if isinstance(output.get('Output'), list):
+                failures = classifier.classify_commands(cmd, output.get('Output'))
+                if failures:
                     output['Output'] = "Configuration failed, check the commands in the configuration file"
-                elif "Login invalid" in output["Output"]:
-                    output['Output'] = "Authentication to device failed"
-                else: 
+                    output['Failures'] = failures
+                else:
                     output['Output'] = "Configuration successfully applied"
+            elif isinstance(output.get('Output'), str):
+                if "Login invalid" in output["Output"]:
+                    output['Output'] = "Authentication to device failed"
+                else:
+                    output['Failures'] = classifier.classify(output.get('Output'))
+                    output['Output'] = "Configuration failed, check the commands in the configuration file or credentials"
             else:
-                output['Output'] = "Unknown configuration status" 
-        dict_output = {}
-        for device in output_data:
-            dict_output.update({"Device": device["Device"], "Result": device["Output"]})
+                output['Output'] = "Unknown configuration status"
         return json.dumps(output_data, indent=2, ensure_ascii=False)
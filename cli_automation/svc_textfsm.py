@@ -0,0 +1,206 @@
+# TextFSM Templates Cache Service Class
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import textfsm
+from textfsm import clitable
+from netmiko.utilities import get_template_dir, get_structured_data
+from cli_automation import config_data
+
+def index_cache() -> Path:
+    # Next to the other cache and state files, never inside the installed package
+    return Path(config_data.get("textfsm_index_file"))
+
+
+class TemplateCache():
+    # Process wide, each template is compiled once and shared by all the devices
+    index = None
+    platforms = {}
+    templates = {}
+    lock = threading.Lock()
+
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+
+
+    def load_index(self) -> None:
+        with TemplateCache.lock:
+            if TemplateCache.index is not None:
+                return
+            try:
+                template_dir = get_template_dir()
+            except ValueError as error:
+                self.logger.error(f"TextFSM templates not found: {error}")
+                TemplateCache.index = {"template_dir": None, "rows": []}
+                return
+            index_file = os.path.join(template_dir, "index")
+            source = {"index_file": index_file, "mtime": os.path.getmtime(index_file)}
+            try:
+                cached = json.loads(index_cache().read_text())
+                if cached.get("source") == source:
+                    TemplateCache.index = cached
+                    self.logger.debug(f"TextFSM precompiled index loaded from {index_cache()}")
+                    return
+            except (OSError, ValueError):
+                pass
+            TemplateCache.index = self.build_index(template_dir, index_file, source)
+
+
+    def build_index(self, template_dir: str, index_file: str, source: dict) -> dict:
+        # CliTable expands the '[[...]]' command completions of the ntc-templates index,
+        # the expanded regexes are stored so the next runs skip the index parsing
+        table = clitable.CliTable("index", template_dir)
+        rows = []
+        for row in table.index.index:
+            rows.append({"platform": row["Platform"], "command": row["Command"], "templates": row["Template"]})
+        index = {"source": source, "template_dir": template_dir, "rows": rows}
+        cache_file = index_cache()
+        try:
+            cache_file.write_text(json.dumps(index))
+            self.logger.debug(f"TextFSM precompiled index written to {cache_file}")
+        except OSError as error:
+            self.logger.debug(f"TextFSM precompiled index not written to {cache_file}: {error}")
+        return index
+
+
+    def platform_rows(self, platform: str) -> list:
+        rows = TemplateCache.platforms.get(platform)
+        if rows is None:
+            rows = [
+                (re.compile(row["command"]), row["templates"])
+                for row in TemplateCache.index["rows"]
+                if row["platform"] and re.match(row["platform"], platform)
+            ]
+            TemplateCache.platforms[platform] = rows
+        return rows
+
+
+    def template(self, platform: str, command: str) -> dict | None:
+        key = (platform, command)
+        if key in TemplateCache.templates:
+            return TemplateCache.templates[key]
+        self.load_index()
+        with TemplateCache.lock:
+            if key in TemplateCache.templates:
+                return TemplateCache.templates[key]
+            entry = None
+            for command_regex, templates in self.platform_rows(platform):
+                if command_regex.match(command):
+                    entry = {"templates": templates, "fsm": None, "lock": threading.Lock()}
+                    if ":" not in templates:
+                        with open(os.path.join(TemplateCache.index["template_dir"], templates)) as template_file:
+                            entry["fsm"] = textfsm.TextFSM(template_file)
+                        self.logger.debug(f"TextFSM template {templates} compiled for platform {platform}, command '{command}'")
+                    break
+            TemplateCache.templates[key] = entry
+            return entry
+
+
+    def parse_template(self, platform: str, command: str, output: str) -> str | list:
+        entry = self.template(platform, command)
+        if entry is None:
+            return output
+        if entry["fsm"] is None:
+            # Commands mapped to several templates are merged by CliTable
+            return get_structured_data(output, platform=platform, command=command)
+        fsm = entry["fsm"]
+        with entry["lock"]:
+            fsm.Reset()
+            records = fsm.ParseText(output)
+        header = [name.lower() for name in fsm.header]
+        structured = [dict(zip(header, record)) for record in records]
+        return structured if structured else output
+
+
+    def parse(self, platform: str, command: str, output: str) -> str | list:
+        result = self.parse_template(platform, command, output)
+        if "cisco_xe" in platform and not isinstance(result, list):
+            result = self.parse_template("cisco_ios", command, output)
+        return result
+
+
+def format_output(command: str, output: any) -> dict:
+    if isinstance(output, str):
+        result = output.splitlines()
+        return {"type": "non-textfsm", command: result}
+    elif isinstance(output, list):
+        return {"type": "textfsm", command: output}
+    else:
+        return {"type": "non-textfsm", command: "Unknown output type"}
+
+
+def parse_worker(platform: str, command: str, output: str) -> str | list:
+    # Runs in the parse processes, each one compiles the templates it uses once
+    return TemplateCache({"logger": logging.getLogger("ClaLogger")}).parse(platform, command, output)
+
+
+class TextfsmParser():
+    # Parse stage of pullconfig: inline runs in a worker thread, process sends large
+    # outputs to a process pool so parsing does not compete for the GIL with the
+    # SSH sessions, deferred keeps the raw text to be parsed later by 'cla ssh parse'
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.mode = inst_dict.get('parse') or config_data.get("parse")
+        self.min_chars = config_data.get("parse_pool_min_chars")
+        self.workers = config_data.get("parse_workers") or os.cpu_count()
+        self.templates = TemplateCache(inst_dict=inst_dict)
+        self.pool = None
+        self.pooled = 0
+
+
+    @property
+    def deferred(self) -> bool:
+        return self.mode == "deferred"
+
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            # forkserver, forking a process that already runs the session threads could copy a held lock
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+            self.logger.debug(f"TextFSM parse pool started, processes: {self.workers}")
+        return self.pool
+
+
+    async def parse(self, platform: str, command: str, output: str) -> str | list:
+        if self.mode == "process" and len(output) >= self.min_chars:
+            # Small outputs cost more to send to another process than to parse
+            self.pooled += 1
+            return await asyncio.get_running_loop().run_in_executor(self.get_pool(), parse_worker, platform, command, output)
+        return await asyncio.to_thread(self.templates.parse, platform, command, output)
+
+
+    async def parse_results(self, results: list) -> list:
+        # Results of a pullconfig run with deferred parsing, only the raw entries are parsed
+        jobs = []
+        for result in results:
+            if not isinstance(result.get("Output"), list):
+                continue
+            for index, entry in enumerate(result["Output"]):
+                if isinstance(entry, dict) and entry.get("type") == "raw":
+                    command = next(key for key in entry if key not in ("type", "platform"))
+                    jobs.append((result["Output"], index, command, self.parse(entry["platform"], command, entry[command])))
+        parsed = await asyncio.gather(*(job[3] for job in jobs))
+        for (output, index, command, _), structured in zip(jobs, parsed):
+            output[index] = format_output(command, structured)
+        self.close()
+        return results
+
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.logger.debug(f"TextFSM parse pool stopped, outputs parsed in the pool: {self.pooled}")
+            self.pool = None
@@ -0,0 +1,104 @@
+# Device Timing Service Classes
+# Ed Scrimaglia
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.')))
+
+import math
+import time
+from contextlib import contextmanager, nullcontext
+
+PHASES = ["preflight", "queue", "connect", "auth", "enable", "command", "parse", "disconnect", "total"]
+PERCENTILES = [50, 95, 99]
+
+
+class PhaseTimer():
+    def __init__(self):
+        self.phases = {}
+        self.commands = {}
+
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+    @contextmanager
+    def phase(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+
+    @contextmanager
+    def command(self, command: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.commands[command] = self.commands.get(command, 0.0) + seconds
+            self.add("command", seconds)
+
+
+    def merge(self, timing: dict | None) -> None:
+        # Timings measured by the cla agent, which runs the device phases in its own process
+        if not timing:
+            return
+        for phase, seconds in timing.items():
+            if phase == "commands":
+                for command, command_seconds in seconds.items():
+                    self.commands[command] = self.commands.get(command, 0.0) + command_seconds
+            elif phase != "total":
+                self.add(phase, seconds)
+
+
+    def result(self) -> dict:
+        timing = {phase: round(self.phases[phase], 4) for phase in PHASES if phase in self.phases}
+        if self.commands:
+            timing["commands"] = {command: round(seconds, 4) for command, seconds in self.commands.items()}
+        return timing
+
+
+class TimingSummary():
+    def __init__(self):
+        self.samples = {phase: [] for phase in PHASES}
+
+
+    def add(self, timer: PhaseTimer) -> None:
+        for phase, seconds in timer.phases.items():
+            if phase == "command":
+                # Each command is one sample, a device running many commands is not a single slow one
+                self.samples[phase].extend(timer.commands.values())
+            else:
+                self.samples.setdefault(phase, []).append(seconds)
+
+
+    def percentile(self, samples: list, percent: int) -> float:
+        # Nearest rank, samples must be sorted
+        rank = max(1, math.ceil(percent / 100 * len(samples)))
+        return samples[rank - 1]
+
+
+    def report(self) -> dict:
+        report = {}
+        for phase, samples in self.samples.items():
+            if not samples:
+                continue
+            samples = sorted(samples)
+            report[phase] = {"count": len(samples), **{f"p{percent}": round(self.percentile(samples, percent), 4) for percent in PERCENTILES}, "max": round(samples[-1], 4)}
+        return report
+
+
+    def table(self) -> str:
+        lines = [f"{'phase':<12}{'count':>8}" + "".join(f"{'p' + str(percent):>10}" for percent in PERCENTILES) + f"{'max':>10}"]
+        for phase, values in self.report().items():
+            lines.append(f"{phase:<12}{values['count']:>8}" + "".join(f"{values['p' + str(percent)]:>10.3f}" for percent in PERCENTILES) + f"{values['max']:>10.3f}")
+        return "\n".join(lines)
+
+
+def phase(timer: PhaseTimer | None, name: str):
+    # Sessions can also be opened without a timer
+    return timer.phase(name) if timer else nullcontext()
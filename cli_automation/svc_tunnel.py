@@ -7,6 +7,9 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.
 
 import asyncio
 import json
+import threading
+import time
+from pathlib import Path
 from .svc_files import ManageFiles
 from cli_automation import config_data
 import socket
@@ -15,6 +18,84 @@ import subprocess
 import socks
 
 
+def configured_tunnels(cfg: dict) -> list:
+    # The tunnels of the pool, [{"bastion_host", "bastion_user", "local_port"}]. Configs
+    # written before the pool existed describe a single tunnel with the bastion_* keys
+    if cfg.get("tunnels"):
+        return cfg.get("tunnels")
+    if cfg.get("bastion_host"):
+        return [{"bastion_host": cfg.get("bastion_host"), "bastion_user": cfg.get("bastion_user"), "local_port": cfg.get("tunnel_local_port")}]
+    return []
+
+
+class TunnelHealth():
+    # The last health check of each tunnel, shared by the cla invocations through the
+    # tunnel_state_file. A tunnel found healthy less than tunnel_state_ttl seconds ago is not
+    # tested through the bastion again, failed checks are recorded so the next run tests it
+    def __init__(self, inst_dict: dict):
+        self.verbose = inst_dict.get('verbose')
+        self.logger = inst_dict.get('logger')
+        self.state_file = Path(config_data.get("tunnel_state_file"))
+        self.ttl = config_data.get("tunnel_state_ttl") or 0
+        self.lock = threading.Lock()
+        self.state = self.load()
+
+
+    def load(self) -> dict:
+        try:
+            return json.loads(self.state_file.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            self.logger.error(f"Tunnel state {self.state_file} not loaded, starting empty: {error}")
+            return {}
+
+
+    def save(self) -> None:
+        # Merged with the file, another invocation may have checked other tunnels meanwhile
+        with self.lock:
+            state = self.load()
+            for key, entry in self.state.items():
+                if key not in state or state[key]["checked"] <= entry["checked"]:
+                    state[key] = entry
+            self.state = state
+            temp_file = self.state_file.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                temp_file.write_text(json.dumps(state, indent=2))
+                os.replace(temp_file, self.state_file)
+                self.logger.debug(f"Tunnel state saved to {self.state_file}, {len(state)} tunnels")
+            except OSError as error:
+                self.logger.error(f"Tunnel state {self.state_file} not saved: {error}")
+
+
+    def key(self, tunnel: dict) -> str:
+        return f"{tunnel['bastion_host']}:{tunnel['local_port']}"
+
+
+    def age(self, tunnel: dict) -> float | None:
+        # Seconds since the tunnel was found healthy, None when its last check failed
+        entry = self.state.get(self.key(tunnel))
+        if not entry or not entry.get("healthy"):
+            return None
+        return time.time() - entry["checked"]
+
+
+    def fresh(self, tunnel: dict) -> bool:
+        age = self.age(tunnel)
+        return age is not None and age < self.ttl
+
+
+    def record(self, tunnel: dict, healthy: bool) -> None:
+        with self.lock:
+            self.state[self.key(tunnel)] = {"healthy": healthy, "checked": round(time.time(), 3)}
+
+
+    def forget(self, tunnels: list) -> None:
+        with self.lock:
+            for tunnel in tunnels:
+                self.state[self.key(tunnel)] = {"healthy": False, "checked": round(time.time(), 3)}
+
+
 class SetSocks5Tunnel():
     def __init__(self, inst_dict: dict):
         self.verbose = inst_dict.get('verbose')
@@ -36,20 +117,20 @@ class SetSocks5Tunnel():
         try:
             ip = requests.get("https://api64.ipify.org", proxies=proxies, timeout=5).text
             if self.verbose in [2]:
-                print(f"\n** The public IP through the tunnel is: {ip}")
-            self.logger.debug(f"The public IP through the tunnel is: {ip}")
+                print(f"\n** The public IP through the tunnel at local-port {local_port} is: {ip}")
+            self.logger.debug(f"The public IP through the tunnel at local-port {local_port} is: {ip}")
         except requests.RequestException:
             if self.verbose in [2]:
-                print("\n** Failed to obtain the IP through the tunnel")
-            self.logger.error("Failed to obtain the IP through the tunnel")
+                print(f"\n** Failed to obtain the IP through the tunnel at local-port {local_port}")
+            self.logger.error(f"Failed to obtain the IP through the tunnel at local-port {local_port}")
 
 
-    def get_pid(self):
-        command_pre = ["lsof", "-t", f"-i:{self.cfg.get("tunnel_local_port")}"]
+    def get_pid(self, local_port):
+        command_pre = ["lsof", "-t", f"-i:{local_port}"]
         try:
             result = subprocess.run(command_pre, capture_output=True, text=True)
             pid = result.stdout.strip() if result.stdout.strip() else None
-            self.logger.debug(f"Getting tunnel process PID. PID found: {pid}")
+            self.logger.debug(f"Getting tunnel process PID, local-port {local_port}. PID found: {pid}")
             return pid
         except subprocess.CalledProcessError as error:
             print (f"\n** Error checking the PID: {error.stderr}")
@@ -57,12 +138,25 @@ class SetSocks5Tunnel():
             sys.exit(1)
 
 
+    async def save_tunnels(self, tunnels: list) -> None:
+        # The first tunnel is also kept in the single tunnel keys, for the older releases
+        self.cfg['tunnels'] = tunnels
+        self.cfg['tunnel'] = bool(tunnels)
+        if tunnels:
+            self.cfg['bastion_host'] = tunnels[0]["bastion_host"]
+            self.cfg['bastion_user'] = tunnels[0]["bastion_user"]
+            self.cfg['tunnel_local_port'] = tunnels[0]["local_port"]
+        config_data_file = self.cfg.copy()
+        self.logger.debug(f"Tunnel status updated to {self.cfg['tunnel']}, tunnels in the pool: {len(tunnels)}")
+        await self.file.create_file("config.json", json.dumps(config_data_file, indent=2))
+
+
     async def start_socks5_tunnel(self, timeout, bastion_user, bastion_host, local_port):
         self.logger.debug(f"Starting the tunnel to the Bastion Host {bastion_host}, user: {bastion_user}, local-port: {local_port}")
         command = f"ssh -N -D {local_port} -f {bastion_user}@{bastion_host}"
         try:
             subprocess.run(command, shell=True, check=True, timeout=timeout)
-            pid = self.get_pid()
+            pid = self.get_pid(local_port=local_port)
             if self.verbose in [1,2]:
                 print(f"-> Tunnel process PID {pid}")
             return pid, None
@@ -77,33 +171,75 @@ class SetSocks5Tunnel():
         self.logger.info(f"Setting up the tunnel to the Bastion Host {bastion_host}, user: {bastion_user}, local-port: {local_port}")
         self.logger.debug(f"Checking if tunnel is up, local-port: {local_port}, status: {self.is_tunnel_active(local_port=local_port)}")
         if self.is_tunnel_active(local_port=local_port):
-            pid = self.get_pid()
+            pid = self.get_pid(local_port=local_port)
             self.logger.info(f"Tunnel already running (PID {pid})")
             return pid, f"-> Tunnel already running (PID {pid})"
         else:
             pid, msg = await self.start_socks5_tunnel(timeout=timeout, bastion_user=bastion_user, bastion_host=bastion_host, local_port=local_port)
             self.logger.debug(f"Checking if tunnel is up, local-port: {local_port}, status: {self.is_tunnel_active(local_port=local_port)}")
             if self.is_tunnel_active(local_port=local_port):
-                self.cfg['bastion_host'] = bastion_host
-                self.cfg['bastion_user'] = bastion_user
-                self.cfg['tunnel_local_port'] = local_port
-                self.cfg['tunnel'] = True
-                config_data_file = self.cfg.copy()
-                self.logger.debug(f"Tunnel status updated to True")
-                await self.file.create_file("config.json", json.dumps(config_data_file, indent=2))
                 self.logger.debug(f"Tunnel started successfully for user: {bastion_user}, bastion host: {bastion_host}, local-port: {local_port}, PID: {pid}")
                 await self.check_remote_ip(local_port=local_port)
             return pid, msg
 
 
-    async def kill_tunnel(self):
-        pid_result = subprocess.run(["lsof", "-t", f"-i:{self.cfg.get("tunnel_local_port")}"], capture_output=True, text=True)
+    async def start_tunnels(self, timeout, bastion_user, bastion_hosts, local_port, count):
+        # 'count' tunnels to each bastion, on consecutive local ports from local_port. The
+        # tunnels that start make up the pool, they replace the tunnels of the previous setup
+        results = []
+        port = local_port
+        for bastion_host in bastion_hosts:
+            for _ in range(count):
+                pid, msg = await self.start_tunnel(timeout=timeout, bastion_user=bastion_user, bastion_host=bastion_host, local_port=port)
+                results.append({"bastion_host": bastion_host, "bastion_user": bastion_user, "local_port": port, "pid": pid, "msg": msg})
+                port += 1
+        tunnels = [{key: result[key] for key in ("bastion_host", "bastion_user", "local_port")} for result in results if result["pid"]]
+        if tunnels:
+            await self.save_tunnels(tunnels)
+            # New tunnels are tested by the next run, whatever was recorded for their ports
+            health = TunnelHealth(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+            health.forget(tunnels)
+            health.save()
+        return results
+
+
+    async def start_daemon(self, timeout, bastion_user, bastion_hosts, local_port, count):
+        # The same pool of tunnels, run by the cla tunnel daemon instead of ssh processes. A daemon
+        # already running is restarted with the new tunnels
+        from .svc_forwarder import TunnelDaemonClient
+        client = TunnelDaemonClient(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        tunnels = [{"bastion_host": bastion_host, "bastion_user": bastion_user, "local_port": local_port + index * count + number} for index, bastion_host in enumerate(bastion_hosts) for number in range(count)]
+        if client.is_running() or client.pid_file.exists():
+            await client.stop()
+        busy = [tunnel["local_port"] for tunnel in tunnels if self.is_tunnel_active(local_port=tunnel["local_port"])]
+        if busy:
+            self.logger.error(f"Tunnel daemon not started, local-ports {busy} already in use")
+            return [{**tunnel, "pid": None, "msg": f"** Local-port {tunnel['local_port']} already in use, kill the tunnel running there"} for tunnel in tunnels]
+        if self.verbose in [1,2]:
+            print(f"-> Setting up the tunnel daemon, {len(tunnels)} tunnels to {', '.join(bastion_hosts)}")
+        await self.save_tunnels(tunnels)
+        health = TunnelHealth(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        health.forget(tunnels)
+        health.save()
+        if not await client.start(timeout=timeout):
+            self.logger.error(f"Tunnel daemon failed to start, socket {client.socket_path}")
+            return [{**tunnel, "pid": None, "msg": f"** The tunnel daemon failed to start, check the log file"} for tunnel in tunnels]
+        pid = (await client.request({"action": "status"})).get("output", {}).get("pid")
+        results = []
+        for tunnel in await client.wait_up(timeout=timeout):
+            up = tunnel["state"] == "up"
+            results.append({**{key: tunnel[key] for key in ("bastion_host", "bastion_user", "local_port")}, "pid": pid if up else None, "msg": None if up else f"** Tunnel {tunnel['state']} in the tunnel daemon (PID {pid}), last error: {tunnel['last_error']}. The daemon keeps retrying"})
+        return results
+
+
+    async def kill_port(self, local_port):
+        pid_result = subprocess.run(["lsof", "-t", f"-i:{local_port}"], capture_output=True, text=True)
         pid = pid_result.stdout.strip()
         if pid:
             try:
-                command = ["kill", "-9", pid]
-                print (f"-> Killing the tunnel to the Bastion Host, local port {self.cfg.get("tunnel_local_port")}, process {pid}")
-                self.logger.info(f"Killing the tunnel to the Bastion Host, local port {self.cfg.get("tunnel_local_port")}, process {pid}")
+                command = ["kill", "-9", *pid.split()]
+                print (f"-> Killing the tunnel to the Bastion Host, local port {local_port}, process {pid}")
+                self.logger.info(f"Killing the tunnel to the Bastion Host, local port {local_port}, process {pid}")
                 process = await asyncio.create_subprocess_exec(
                     *command,
                     stdout=asyncio.subprocess.PIPE,
@@ -111,12 +247,9 @@ class SetSocks5Tunnel():
                 )
                 stdout, stderr = await process.communicate()
                 if process.returncode == 0:
-                    self.cfg['tunnel'] = False
-                    config_data_file = self.cfg.copy()
-                    await self.file.create_file("config.json", json.dumps(config_data_file, indent=2))
-                    self.logger.debug(f"Tunnel status updated to False")
                     print (f"\n** Tunnel (PID {pid}) killed successfully")
                     self.logger.debug(f"Tunnel (PID {pid}) killed successfully")
+                    return True
                 else:
                     print (f"** Error executing the command: {stderr.decode().strip()}")
                     self.logger.error(f"Error executing the command: {stderr.decode().strip()}")
@@ -125,45 +258,89 @@ class SetSocks5Tunnel():
                 self.logger.error(f"Error executing the command: {error}")
                 sys.exit(1)
         else:
-            print (f"** No tunnel to kill at local-port {self.cfg.get("tunnel_local_port")}")
-            self.logger.debug(f"No tunnel to kill at local-port {self.cfg.get("tunnel_local_port")}")
+            print (f"** No tunnel to kill at local-port {local_port}")
+            self.logger.debug(f"No tunnel to kill at local-port {local_port}")
+        return False
 
-    async def tunnel_status(self, timeout, test_port, local_port):
-        self.logger.info(f"Checking if tunnel is up, local-port: {local_port}, status: {self.is_tunnel_active(local_port=local_port)}")
-        if self.is_tunnel_active(local_port=local_port):
-            self.logger.debug(f"Checking if proxy is active, local-port: {local_port}, test-port: {test_port}, timeout: {timeout}")
-            if self.test_proxy(timeout=timeout, test_port=test_port, local_port=local_port):
-                self.logger.debug(f"Tunnel is running at local-port {local_port}")
-                self.cfg['tunnel'] = True
-                config_data_file = self.cfg.copy()
-                self.logger.debug(f"Tunnel status updated to True")
-                await self.file.create_file("config.json", json.dumps(config_data_file, indent=2))
-                return True
+
+    async def kill_tunnel(self):
+        from .svc_forwarder import TunnelDaemonClient
+        tunnels = configured_tunnels(self.cfg)
+        client = TunnelDaemonClient(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        if client.is_running() or client.pid_file.exists():
+            if await client.stop():
+                print (f"\n** Tunnel daemon stopped, {len(tunnels)} tunnels closed")
+                self.logger.info(f"Tunnel daemon stopped, {len(tunnels)} tunnels closed")
+                await self.save_tunnels([])
             else:
-                self.logger.error(f"Application can not use the tunnel, bastion-host not reachable. Start the tunnel")
-                self.kill_tunnel()
-                return False
-        else:
-            self.logger.debug(f"Tunnel is not running at local-port {local_port}")
-            self.cfg['tunnel'] = False
-            config_data_file = self.cfg.copy()
-            self.logger.debug(f"Tunnel status updated to False")
-            await self.file.create_file("config.json", json.dumps(config_data_file, indent=2))
-            return False
+                print (f"** No tunnel daemon to stop, PID file {client.pid_file} was stale")
+            return
+        if not tunnels:
+            print (f"** No tunnel to kill, no tunnel is configured")
+            self.logger.debug(f"No tunnel to kill, no tunnel is configured")
+            return
+        for tunnel in tunnels:
+            await self.kill_port(local_port=tunnel["local_port"])
+        health = TunnelHealth(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        health.forget(tunnels)
+        health.save()
+        await self.save_tunnels([])
+
+
+    async def tunnel_status(self, timeout, test_port, local_port=None):
+        # Health check of every tunnel of the pool, or only the one at local_port. The results go
+        # to the tunnel state file, config.json is only rewritten when the pool changes: the
+        # tunnels that fail are killed and dropped from it
+        from .svc_forwarder import TunnelDaemonClient
+        tunnels = configured_tunnels(self.cfg)
+        client = TunnelDaemonClient(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        if client.is_running():
+            # The daemon knows the state of its tunnels, nothing is tested and they are not dropped
+            daemon = (await client.request({"action": "status"})).get("output", {})
+            self.logger.info(f"Tunnel daemon status: {daemon}")
+            return [{**tunnel, "healthy": tunnel["state"] == "up", "pid": daemon.get("pid")} for tunnel in daemon.get("tunnels", []) if local_port is None or tunnel["local_port"] == local_port]
+        checked = [tunnel for tunnel in tunnels if local_port is None or tunnel["local_port"] == local_port]
+        if local_port is not None and not checked:
+            checked = [{"bastion_host": self.cfg.get("bastion_host"), "bastion_user": self.cfg.get("bastion_user"), "local_port": local_port}]
+        health = TunnelHealth(inst_dict={'verbose': self.verbose, 'logger': self.logger})
+        status = []
+        for tunnel in checked:
+            active = self.is_tunnel_active(local_port=tunnel["local_port"])
+            self.logger.info(f"Checking if tunnel is up, local-port: {tunnel['local_port']}, status: {active}")
+            healthy = False
+            if active:
+                self.logger.debug(f"Checking if proxy is active, local-port: {tunnel['local_port']}, test-port: {test_port}, timeout: {timeout}")
+                healthy = self.test_proxy(timeout=timeout, test_port=test_port, local_port=tunnel["local_port"], bastion_host=tunnel["bastion_host"])
+                if healthy:
+                    self.logger.debug(f"Tunnel is running at local-port {tunnel['local_port']}")
+                else:
+                    self.logger.error(f"Application can not use the tunnel at local-port {tunnel['local_port']}, bastion-host not reachable. Start the tunnel")
+                    await self.kill_port(local_port=tunnel["local_port"])
+            else:
+                self.logger.debug(f"Tunnel is not running at local-port {tunnel['local_port']}")
+            health.record(tunnel, healthy)
+            status.append({**tunnel, "healthy": healthy})
+        health.save()
+        failed = [tunnel["local_port"] for tunnel in status if not tunnel["healthy"]]
+        pool = [tunnel for tunnel in tunnels if tunnel["local_port"] not in failed]
+        if pool != self.cfg.get("tunnels") or self.cfg.get("tunnel") != bool(pool):
+            await self.save_tunnels(pool)
+        return status
      
 
-    def test_proxy(self, timeout, test_port, local_port):
-        self.logger.debug(f"Testing the tunnel at remote-port: {test_port}, local-port: {local_port}, timeout: {timeout}, proxy: {self.cfg.get("proxy_host")}, bastion: {self.cfg.get("bastion_host")}")
+    def test_proxy(self, timeout, test_port, local_port, bastion_host):
+        # A proxied socket of its own, the process wide socket.socket is left as it is
+        self.logger.debug(f"Testing the tunnel at remote-port: {test_port}, local-port: {local_port}, timeout: {timeout}, proxy: {self.cfg.get("proxy_host")}, bastion: {bastion_host}")
         try:
-            socks.set_default_proxy(socks.SOCKS5, self.cfg.get("proxy_host"), local_port)
-            socket.socket = socks.socksocket
-            socket.setdefaulttimeout(timeout)
-            socket.socket().connect((self.cfg.get("bastion_host"), test_port))
-            self.logger.debug(f"Application ready to use the tunnel. Tunnel tested at remote-port {test_port}")
+            with socks.socksocket() as sock:
+                sock.set_proxy(socks.SOCKS5, self.cfg.get("proxy_host"), local_port)
+                sock.settimeout(timeout)
+                sock.connect((bastion_host, test_port))
+            self.logger.debug(f"Application ready to use the tunnel at local-port {local_port}. Tunnel tested at remote-port {test_port}")
             return True
-        except (socks.ProxyConnectionError, socket.error):
-            self.logger.error(f"Application can not use the tunnel. Tunnel not tested at remote-port {test_port}")
+        except (socks.ProxyError, socket.error):
+            self.logger.error(f"Application can not use the tunnel at local-port {local_port}. Tunnel not tested at remote-port {test_port}")
             return False
         except Exception as error:
-            self.logger.error(f"Application can not use the tunnel. Error: {error}")
-            return False
\ No newline at end of file
+            self.logger.error(f"Application can not use the tunnel at local-port {local_port}. Error: {error}")
+            return False